@@ -1,91 +1,221 @@
 # Need to use pigpio for HW dimmer control.  Software libraries such as lgpio results in major flicking.
+#
+# The dimmer module isn't zero-crossing: the lowest duty cycles give no light and the highest all look the same.  A
+# calibration (set from the Dimmer Calibration menu) marks the first duty cycle giving light and the one where the
+# lamp saturates.  The levels are then indexes into a table of duty cycles between the two, evenly spaced in perceived
+# brightness and each at least one duty cycle apart, so every ramp step is a visible change.  Uncalibrated, the level
+# is the duty cycle.
 
+import json
+import logging
+from typing import Callable, ClassVar, List, NamedTuple
 
 import pigpio
-from mypyc.primitives.set_ops import new_set_op
+
+from sunrise_metrics import registry
+from sunrise_pigpio import PigpioConnection, shared_connection
+
+CALIBRATION_FILENAME = 'dimmer_calibration.json'
+# Calibrated levels per duty cycle between the visible and saturation duty cycles.  Below 1 so that the levels can
+# follow the perceived brightness curve rather than every duty cycle in turn.
+CALIBRATION_LEVELS_PER_DUTY_CYCLE: float = 0.5
+
+dimmer_level = registry.gauge('sunrise_dimmer_level', 'Current dimmer duty cycle')
+
+logger = logging.getLogger(__name__)
+
+
+class DimmerCalibration(NamedTuple):
+    # First duty cycle giving any light
+    visible: int
+    # Duty cycle above which the lamp gets no brighter
+    saturated: int
+
+
+def lightness_to_luminance(lightness: float) -> float:
+    """ CIE 1976 lightness (0-100, perceived brightness) to relative luminance (0-1). """
+    if lightness > 8:
+        return ((lightness + 16) / 116) ** 3
+    return lightness / 903.3
+
+
+def duty_cycle_table(calibration: DimmerCalibration | None) -> List[int]:
+    """
+    The duty cycle for each level, level 0 is off.
+    :param calibration: Visible and saturation duty cycles, None for a level per duty cycle
+    :return: Duty cycles, strictly increasing
+    """
+    if calibration is None:
+        return list(range(Dimmer.__min_duty_cycle__, Dimmer.__max_duty_cycle__ + 1))
+    span = calibration.saturated - calibration.visible
+    num_levels = max(1, round(span * CALIBRATION_LEVELS_PER_DUTY_CYCLE))
+    table = [Dimmer.__min_duty_cycle__, calibration.visible]
+    for level in range(1, num_levels + 1):
+        duty_cycle = calibration.visible + round(span * lightness_to_luminance(100 * level / num_levels))
+        # Where the curve is flatter than the duty cycle resolution, go up one duty cycle at a time
+        table.append(min(max(duty_cycle, table[-1] + 1), calibration.saturated))
+    return table
+
+
+def load_calibration(filename: str) -> DimmerCalibration | None:
+    try:
+        with open(filename) as f:
+            values = json.load(f)
+        calibration = DimmerCalibration(int(values['visible_duty_cycle']), int(values['saturation_duty_cycle']))
+        check_calibration(calibration)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        logger.error('Ignoring dimmer calibration in %s: %s', filename, e)
+        return None
+    return calibration
+
+
+def save_calibration(calibration: DimmerCalibration, filename: str):
+    with open(filename, 'wt') as f:
+        json.dump({'visible_duty_cycle': calibration.visible, 'saturation_duty_cycle': calibration.saturated}, f)
+
+
+def check_calibration(calibration: DimmerCalibration):
+    """ :raises: ValueError unless 0 < visible < saturated <= 255 """
+    if not Dimmer.__min_duty_cycle__ < calibration.visible < calibration.saturated <= Dimmer.__max_duty_cycle__:
+        raise ValueError(f'visible duty cycle {calibration.visible} must be above 0 and below the saturation duty '
+                         f'cycle {calibration.saturated}, at most {Dimmer.__max_duty_cycle__}')
 
 
 class Dimmer:
-    __frequency__: int = 1000
-    __max_duty_cycle__: int = 255
-    __min_duty_cycle__: int = 0
-    __duty_cycle_range__: int = __max_duty_cycle__ - __min_duty_cycle__
+    __slots__ = ('enabled', 'pwm_gpio', 'level', 'connection', 'pi', 'output_level', 'level_listeners', 'calibration',
+                 'calibration_filename', 'duty_table', 'max_level')
+    __frequency__: ClassVar[int] = 1000
+    __max_duty_cycle__: ClassVar[int] = 255
+    __min_duty_cycle__: ClassVar[int] = 0
 
-    def __init__(self):
-        self.is_enabled: bool = False
+    def __init__(self, pi: pigpio.pi | None = None, calibration_filename: str | None = None):
+        """
+        :param pi: Connection to the pigpio daemon, the shared connection by default
+        :param calibration_filename: Where the calibration is kept.  None for an uncalibrated dimmer that doesn't
+            save its calibration, e.g., in the simulator.
+        """
+        self.enabled: bool = False
         self.pwm_gpio = 13
-        self.duty_cycle: int = 0
-        self.pi = pigpio.pi()
+        self.level: int = 0
+        self.calibration_filename = calibration_filename
+        self.calibration: DimmerCalibration | None = load_calibration(calibration_filename) \
+            if calibration_filename else None
+        self.duty_table: List[int] = duty_cycle_table(self.calibration)
+        self.max_level: int = len(self.duty_table) - 1
+        # PWM writes are queued and pipelined by the connection, see sunrise_pigpio.py
+        self.connection: PigpioConnection = PigpioConnection(pi) if pi else shared_connection()
+        self.pi = self.connection.pi
+        # Last duty cycle written to the PWM output, and who to tell when it changes
+        self.output_level: int | None = None
+        self.level_listeners: List[Callable[[int], None]] = []
         self.pi.set_PWM_frequency(self.pwm_gpio, self.__frequency__)
-        self.pi.set_PWM_dutycycle(self.pwm_gpio, 0)
+        self.write_duty_cycle(0)
+
+    def write_duty_cycle(self, duty_cycle: int):
+        self.connection.set_PWM_dutycycle(self.pwm_gpio, duty_cycle)
+        dimmer_level.set(duty_cycle)
+        if duty_cycle != self.output_level:
+            self.output_level = duty_cycle
+            for listener in self.level_listeners:
+                listener(duty_cycle)
+
+    def write_level(self, level: int):
+        self.level = level
+        self.write_duty_cycle(self.duty_table[level])
+
+    def restore_level(self):
+        """ Writes the duty cycle of the current level again, after the output was set directly. """
+        self.write_duty_cycle(self.duty_table[self.level])
+
+    def add_level_listener(self, listener: Callable[[int], None]):
+        self.level_listeners.append(listener)
+
+    def calibrate(self, calibration: DimmerCalibration):
+        """
+        Replaces the calibration and saves it.  The lamp keeps about the same brightness, on the new levels.
+        :param calibration: New visible and saturation duty cycles
+        :raises: ValueError for an invalid calibration
+        :return: None
+        """
+        check_calibration(calibration)
+        fraction = self.level / self.max_level
+        self.calibration = calibration
+        self.duty_table = duty_cycle_table(calibration)
+        self.max_level = len(self.duty_table) - 1
+        logger.info('Dimmer calibration %s, %s levels', calibration, self.max_level)
+        self.write_level(max(1, round(fraction * self.max_level)) if self.level else 0)
+        if self.calibration_filename:
+            try:
+                save_calibration(calibration, self.calibration_filename)
+            except OSError as e:
+                logger.error('Unable to save dimmer calibration: %s', e)
 
-    def set_level(self, level) -> None:
+    def set_level(self, level: int) -> None:
         """
-        Sets the dimming level.  The level must range from 0 to 255 inclusive.
+        Sets the dimming level.  The level must range from 0 to get_max_level() inclusive.
 
-        :param level: Value from 0 (off) through 255 (full brightness).
+        :param level: Value from 0 (off) through get_max_level() (full brightness).
         :raises: ValueError
         :return: None
         """
-        if self.is_enabled:
-            if 0 <= level <= self.__max_duty_cycle__:
-                self.duty_cycle = level
-                self.pi.set_PWM_dutycycle(self.pwm_gpio, level)
+        if self.enabled:
+            if 0 <= level <= self.max_level:
+                self.write_level(level)
             else:
                 raise ValueError
         else:
             # Not enabled, set to off
-            if self.duty_cycle > 0:
-                self.duty_cycle = 0
-                self.pi.set_PWM_dutycycle(self.pwm_gpio, self.duty_cycle)
+            if self.level > 0:
+                self.write_level(0)
 
     def get_level(self) -> int:
-        return self.duty_cycle
+        return self.level
 
     def is_on(self) -> bool:
-        return self.duty_cycle > self.__min_duty_cycle__
+        return self.level > 0
 
     def enable(self):
-        self.is_enabled = True
+        self.enabled = True
 
     def disable(self):
-        self.is_enabled = False
+        self.enabled = False
 
-    def is_enabled(self):
-        return self.is_enabled
+    def is_enabled(self) -> bool:
+        return self.enabled
 
     def shutdown(self):
-        self.pi.set_PWM_dutycycle(self.pwm_gpio, self.duty_cycle)
+        self.write_level(self.level)
+        # Queued writes go out before PWM is stopped
+        self.connection.flush()
         self.pi.set_PWM_frequency(self.pwm_gpio, 0)
-        self.pi.stop()
+        self.connection.stop()
 
     def get_max_level(self) -> int:
-        return self.__max_duty_cycle__
+        return self.max_level
 
     def get_min_level(self) -> int:
-        return self.__min_duty_cycle__
+        return 0
 
     def turn_off(self):
-        self.pi.set_PWM_dutycycle(self.pwm_gpio, self.__min_duty_cycle__)
-        self.duty_cycle = self.__min_duty_cycle__
+        self.write_level(0)
 
     def turn_on(self):
-        self.pi.set_PWM_dutycycle(self.pwm_gpio, self.__max_duty_cycle__)
-        self.duty_cycle = self.__max_duty_cycle__
+        self.write_level(self.max_level)
 
     def get_num_steps(self) -> int:
-        return self.__duty_cycle_range__
+        return self.max_level
 
     # Positive or negative change in brightness level.  Returns False if unable to change the
     # brightness level due to already being at maximum or minimum.
     def increment_level(self, steps: int = 1) -> bool:
-        new_duty_cycle = self.duty_cycle + steps
-        if new_duty_cycle > self.__max_duty_cycle__ or new_duty_cycle < self.__min_duty_cycle__:
+        new_level = self.level + steps
+        if new_level > self.max_level or new_level < 0:
             return False
 
-        self.duty_cycle = new_duty_cycle
-        #print(f'Changing duty cycle to {self.duty_cycle}')
-        self.pi.set_PWM_dutycycle(self.pwm_gpio, self.duty_cycle)
+        logger.debug('Changing level to %s', new_level)
+        self.write_level(new_level)
         return True
 
     # Increase the brightness level, if possible, by the percentage specified.  Returns the new
@@ -94,16 +224,16 @@ class Dimmer:
         if percentage < 0:
             return -1
 
-        dc_increment = percentage * 0.01 * self.__duty_cycle_range__
+        level_increment = percentage * 0.01 * self.max_level
 
-        new_duty_cycle = self.duty_cycle + dc_increment
-        if new_duty_cycle > self.__max_duty_cycle__:
-            new_duty_cycle = self.__max_duty_cycle__
+        # Levels are whole numbers
+        new_level = round(self.level + level_increment)
+        if new_level > self.max_level:
+            new_level = self.max_level
 
-        self.duty_cycle = new_duty_cycle
-        new_percent_brightness = 100 * (new_duty_cycle / self.__duty_cycle_range__)
-        print(f'Increasing duty cycle to {self.duty_cycle}, brightness to {new_percent_brightness}%')
-        self.pi.set_PWM_dutycycle(self.pwm_gpio, self.duty_cycle)
+        new_percent_brightness = 100 * (new_level / self.max_level)
+        logger.debug('Increasing level to %s, brightness to %s%%', new_level, new_percent_brightness)
+        self.write_level(new_level)
 
         return int(new_percent_brightness)
 
@@ -113,15 +243,14 @@ class Dimmer:
         if percentage < 0:
             return -1
 
-        dc_increment = percentage * 0.01 * self.__duty_cycle_range__
+        level_increment = percentage * 0.01 * self.max_level
 
-        new_duty_cycle = self.duty_cycle - dc_increment
-        if new_duty_cycle < self.__min_duty_cycle__:
-            new_duty_cycle = self.__min_duty_cycle__
+        new_level = round(self.level - level_increment)
+        if new_level < 0:
+            new_level = 0
 
-        self.duty_cycle = new_duty_cycle
-        current_percent_brightness = 100 * (new_duty_cycle / self.__duty_cycle_range__)
-        print(f'Decreasing duty cycle to {self.duty_cycle}, brightness to {current_percent_brightness}%')
-        self.pi.set_PWM_dutycycle(self.pwm_gpio, self.duty_cycle)
+        current_percent_brightness = 100 * (new_level / self.max_level)
+        logger.debug('Decreasing level to %s, brightness to %s%%', new_level, current_percent_brightness)
+        self.write_level(new_level)
 
         return int(current_percent_brightness)
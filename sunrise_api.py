@@ -0,0 +1,349 @@
+# Local HTTP/JSON control API for home automation.  The server runs its own asyncio event loop in a separate thread
+# so that any number of clients can be connected with little overhead.  Requests that change anything are handed to
+# the controller's dispatch thread (the same thread that handles button presses) and awaited, so the API never
+# touches controller state concurrently with the buttons and never runs on the ramp or display threads.
+#
+#   GET  /status                         Lamp level, running state, next sunrise
+#   POST /lamp        {"on": true}       Lamp on or off (cancels a running sunrise)
+#   POST /brightness  {"level": 128}     Set the dimmer level 0-lamp_max_level, or {"change_percent": -5} to step it
+#   POST /cancel                         Cancel a running sunrise
+#   GET  /schedule                       Current schedule settings
+#   PUT  /schedule    {...}              Change any of the schedule settings, e.g. {"start_time": {"0": "06:45"}}
+#   GET  /events                         Server-sent event stream of state changes, so dashboards don't need to poll
+#
+# The event stream sends a "snapshot" event with the full status on connect, then a "delta" event with only the
+# fields that changed (lamp level, running state, next sunrise status, ...).  Changes arriving within
+# API_EVENT_COALESCE_SEC are sent as one delta, e.g., a ramp step that also updates the status line.  Each delta is
+# encoded once and the same bytes are queued to every subscriber, so the cost does not grow with the number of
+# subscribers beyond a buffer append each.  A subscriber that stops reading is dropped instead of buffering forever.
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from http import HTTPStatus
+from typing import Any, Dict, Tuple
+
+from sunrise_metrics import registry
+from sunrise_watchdog import watchdog
+
+# Loopback by default, SUNRISE_API_HOST=0.0.0.0 lets home automation on the network reach the unit
+API_HOST: str = os.environ.get('SUNRISE_API_HOST', '127.0.0.1')
+API_PORT: int = int(os.environ.get('SUNRISE_API_PORT', 8080))
+# If set, clients must send "Authorization: Bearer <token>"
+API_TOKEN: str | None = os.environ.get('SUNRISE_API_TOKEN')
+API_COMMAND_TIMEOUT_SEC: float = 5.0
+API_IDLE_TIMEOUT_SEC: float = 60.0
+API_MAX_BODY: int = 16 * 1024
+API_EVENT_COALESCE_SEC: float = 0.1
+API_EVENT_KEEPALIVE_SEC: float = 15.0
+# Drop an event stream subscriber once this much is waiting to be sent to it
+API_EVENT_MAX_BUFFER: int = 64 * 1024
+# Fields of get_status() that are pushed as deltas
+API_EVENT_FIELDS: Tuple[str, ...] = ('lamp_level', 'lamp_on', 'running', 'status', 'running_start',
+                                     'running_duration_minutes')
+
+api_requests = registry.counter('sunrise_api_requests_total', 'Control API requests')
+api_errors = registry.counter('sunrise_api_errors_total', 'Control API requests that failed')
+api_request_seconds = registry.histogram('sunrise_api_request_seconds', 'Control API request handling time')
+api_clients = registry.gauge('sunrise_api_clients', 'Connected control API clients')
+api_subscribers = registry.gauge('sunrise_api_event_subscribers', 'Connected event stream subscribers')
+api_events = registry.counter('sunrise_api_events_total', 'State change events published')
+api_subscribers_dropped = registry.counter('sunrise_api_event_subscribers_dropped_total',
+                                           'Event stream subscribers dropped for not keeping up')
+
+logger = logging.getLogger(__name__)
+
+
+class ApiError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def local_ip_address() -> str:
+    """ Best guess at the address other machines on the network use to reach us. """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            # No packets are sent for a UDP connect
+            s.connect(('10.255.255.255', 1))
+            return s.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+
+
+class ControlApiServer(threading.Thread):
+    def __init__(self, controller, host: str = API_HOST, port: int = API_PORT):
+        threading.Thread.__init__(self, name='ControlApi', daemon=True)
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.server: asyncio.Server | None = None
+        self.ready = threading.Event()
+        self.num_clients = 0
+        self.num_requests = 0
+        # Event stream subscribers, only touched on the event loop thread
+        self.subscribers: set[asyncio.StreamWriter] = set()
+        self.event_id = 0
+        self.last_event_state: Dict[str, Any] = {}
+        self.publish_pending = False
+        # (method, path) -> handler
+        self.routes = {
+            ('GET', '/status'): self.get_status,
+            ('POST', '/lamp'): self.post_lamp,
+            ('POST', '/brightness'): self.post_brightness,
+            ('POST', '/cancel'): self.post_cancel,
+            ('GET', '/schedule'): self.get_schedule,
+            ('PUT', '/schedule'): self.put_schedule,
+            ('POST', '/schedule'): self.put_schedule,
+        }
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_client, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info('Control API listening on %s:%s', self.host, self.port)
+        if not API_TOKEN and not self.host.startswith('127.') and self.host not in ('localhost', '::1'):
+            logger.warning('Control API is reachable from the network without SUNRISE_API_TOKEN')
+        self.last_event_state = self.event_state()
+        self.controller.add_state_listener(self.state_changed)
+        self.loop.call_later(API_EVENT_KEEPALIVE_SEC, self.send_keepalive)
+        watchdog.heartbeat('api', probe=self.loop.call_soon_threadsafe)
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def address(self) -> str:
+        host = local_ip_address() if self.host == '0.0.0.0' else self.host
+        return f'{host}:{self.port}'
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.num_clients += 1
+        api_clients.set(self.num_clients)
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await asyncio.wait_for(self.read_request(reader), API_IDLE_TIMEOUT_SEC)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if method == 'GET' and path == '/events':
+                    await self.stream_events(headers, reader, writer)
+                    return
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                status, response = await self.handle_request(method, path, headers, body)
+                self.write_response(writer, status, response, keep_alive)
+                await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ApiError as e:
+            # Malformed request, can't trust the rest of the stream
+            self.write_response(writer, e.status, {'error': str(e)}, False)
+        finally:
+            self.num_clients -= 1
+            api_clients.set(self.num_clients)
+            writer.close()
+
+    @staticmethod
+    async def read_line(reader: asyncio.StreamReader, status: HTTPStatus) -> bytes:
+        """ A line of the request head.  A line longer than the stream's limit is answered with status. """
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            raise ApiError(status, 'line too long')
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str], bytes] | None:
+        request_line = await ControlApiServer.read_line(reader, HTTPStatus.REQUEST_URI_TOO_LONG)
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise ApiError(HTTPStatus.BAD_REQUEST, 'malformed request line')
+
+        headers = {}
+        while True:
+            line = await ControlApiServer.read_line(reader, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 64:
+                raise ApiError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'too many headers')
+
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            raise ApiError(HTTPStatus.BAD_REQUEST, 'bad Content-Length')
+        if length < 0:
+            raise ApiError(HTTPStatus.BAD_REQUEST, 'bad Content-Length')
+        if length > API_MAX_BODY:
+            raise ApiError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'request body too large')
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), target.split('?', 1)[0], headers, body
+
+    async def handle_request(self, method: str, path: str, headers: Dict[str, str],
+                             body: bytes) -> Tuple[HTTPStatus, Any]:
+        start_time = time.perf_counter()
+        self.num_requests += 1
+        api_requests.inc()
+        try:
+            if API_TOKEN and headers.get('authorization') != f'Bearer {API_TOKEN}':
+                raise ApiError(HTTPStatus.UNAUTHORIZED, 'missing or bad token')
+            handler = self.routes.get((method, path))
+            if handler is None:
+                if any(p == path for _, p in self.routes):
+                    raise ApiError(HTTPStatus.METHOD_NOT_ALLOWED, f'{method} not allowed for {path}')
+                raise ApiError(HTTPStatus.NOT_FOUND, f'unknown path {path}')
+            try:
+                request = json.loads(body) if body else {}
+            except ValueError:
+                raise ApiError(HTTPStatus.BAD_REQUEST, 'body is not valid JSON')
+            if not isinstance(request, dict):
+                raise ApiError(HTTPStatus.BAD_REQUEST, 'body must be a JSON object')
+            return HTTPStatus.OK, await handler(request)
+        except ApiError as e:
+            api_errors.inc()
+            return e.status, {'error': str(e)}
+        except Exception as e:
+            api_errors.inc()
+            logger.exception('Control API error on %s %s: %s', method, path, e)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}
+        finally:
+            api_request_seconds.observe(time.perf_counter() - start_time)
+
+    @staticmethod
+    def write_response(writer: asyncio.StreamWriter, status: HTTPStatus, response: Any, keep_alive: bool):
+        body = json.dumps(response).encode('utf-8')
+        connection = 'keep-alive' if keep_alive else 'close'
+        writer.write(f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                     f'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     f'Connection: {connection}\r\n\r\n'.encode('latin-1') + body)
+
+    def event_state(self) -> Dict[str, Any]:
+        status = self.controller.get_status()
+        return {name: status.get(name) for name in API_EVENT_FIELDS}
+
+    def state_changed(self):
+        """ Controller state listener, called from any thread. """
+        self.loop.call_soon_threadsafe(self.schedule_publish)
+
+    def schedule_publish(self):
+        # Changes arriving before the pending publish runs are folded into it
+        if not self.publish_pending:
+            self.publish_pending = True
+            self.loop.call_later(API_EVENT_COALESCE_SEC, self.publish)
+
+    def publish(self):
+        self.publish_pending = False
+        state = self.event_state()
+        delta = {name: value for name, value in state.items() if value != self.last_event_state.get(name)}
+        # Always keep the latest state for new subscribers' snapshot, even if nobody is listening
+        self.last_event_state = state
+        if not delta:
+            return
+        self.event_id += 1
+        api_events.inc()
+        self.broadcast(self.encode_event('delta', delta))
+
+    def encode_event(self, event: str, data: Dict[str, Any]) -> bytes:
+        return f'id: {self.event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+    def broadcast(self, message: bytes):
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > API_EVENT_MAX_BUFFER:
+                logger.warning('Dropping event subscriber %s, not keeping up', writer.get_extra_info('peername'))
+                api_subscribers_dropped.inc()
+                self.subscribers.discard(writer)
+                writer.transport.abort()
+            else:
+                writer.write(message)
+
+    def send_keepalive(self):
+        # A comment line keeps proxies and idle timeouts from closing quiet streams
+        if self.subscribers:
+            self.broadcast(b': ping\n\n')
+        self.loop.call_later(API_EVENT_KEEPALIVE_SEC, self.send_keepalive)
+
+    async def stream_events(self, headers: Dict[str, str], reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter):
+        self.num_requests += 1
+        api_requests.inc()
+        if API_TOKEN and headers.get('authorization') != f'Bearer {API_TOKEN}':
+            api_errors.inc()
+            self.write_response(writer, HTTPStatus.UNAUTHORIZED, {'error': 'missing or bad token'}, False)
+            return
+
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Connection: keep-alive\r\n\r\n')
+        writer.write(self.encode_event('snapshot', self.controller.get_status()))
+        self.subscribers.add(writer)
+        api_subscribers.set(len(self.subscribers))
+        try:
+            # Nothing more is expected from the client, this just waits for it to go away
+            while await reader.read(1024):
+                pass
+        finally:
+            self.subscribers.discard(writer)
+            api_subscribers.set(len(self.subscribers))
+
+    async def run_command(self, fn, *args) -> Any:
+        """ Runs a controller operation on its dispatch thread and waits for the result. """
+        future = asyncio.wrap_future(self.controller.submit(fn, *args))
+        try:
+            return await asyncio.wait_for(future, API_COMMAND_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            raise ApiError(HTTPStatus.SERVICE_UNAVAILABLE, 'controller busy, try again')
+        except ValueError as e:
+            raise ApiError(HTTPStatus.BAD_REQUEST, str(e))
+
+    async def get_status(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        return self.controller.get_status()
+
+    async def post_lamp(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        on = request.get('on')
+        if not isinstance(on, bool):
+            raise ApiError(HTTPStatus.BAD_REQUEST, '"on" must be true or false')
+        await self.run_command(self.controller.set_lamp, on)
+        return self.controller.get_status()
+
+    async def post_brightness(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        level = request.get('level')
+        change_percent = request.get('change_percent')
+        max_level = self.controller.dimmer.get_max_level()
+        if isinstance(level, int) and not isinstance(level, bool) and 0 <= level <= max_level:
+            await self.run_command(self.controller.set_lamp_level, level)
+        elif isinstance(change_percent, int) and not isinstance(change_percent, bool) and -100 <= change_percent <= 100:
+            await self.run_command(self.controller.change_brightness, change_percent)
+        else:
+            raise ApiError(HTTPStatus.BAD_REQUEST,
+                           f'need "level" (0-{max_level}) or "change_percent" (-100 to 100)')
+        return self.controller.get_status()
+
+    async def post_cancel(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        await self.run_command(self.controller.cancel_running_schedule)
+        return self.controller.get_status()
+
+    async def get_schedule(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        return self.controller.data.settings_dict()
+
+    async def put_schedule(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        await self.run_command(self.controller.update_settings, request)
+        return self.controller.data.settings_dict() | {'status': self.controller.get_status()['status']}
@@ -0,0 +1,221 @@
+# Button input handling.  Raw edges from the pigpio callback thread are queued to a dispatcher thread which runs a
+# small debounce state machine per button and turns the edges into press, long-press and auto-repeat events.
+# Other sources of controller commands (the control API, sync, ramp timers and the sunrise start) queue them to the same
+# thread so that all of them are handled one at a time, in order, with the button presses.  It is the only thread that
+# changes controller state, see SunriseController.on_dispatcher().
+
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Callable, Dict
+
+from sunrise_metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Time a button level must be stable before a press is reported.
+BUTTON_SETTLE_SEC: float = 0.02
+# Hold time before a long-press is reported and auto-repeat starts.
+BUTTON_LONG_PRESS_SEC: float = 0.5
+# Auto-repeat starts at this interval and shrinks by the acceleration factor on each repeat down to the minimum.
+BUTTON_REPEAT_START_SEC: float = 0.25
+BUTTON_REPEAT_MIN_SEC: float = 0.04
+BUTTON_REPEAT_ACCEL: float = 0.85
+BUTTON_TIMING_HISTORY: int = 64
+
+# Buttons are pulled up, so a low level means pressed
+PRESSED_LEVEL = 0
+
+class ButtonEvent(Enum):
+    press = 1
+    long_press = 2
+    repeat = 3
+
+
+button_queue_wait_seconds = registry.histogram('sunrise_button_queue_wait_seconds',
+                                               'Time a button edge waits in the intake queue')
+button_handle_seconds = registry.histogram('sunrise_button_handle_seconds', 'Time to handle a button event')
+button_events = {event: registry.counter('sunrise_button_events_total', 'Button events handled',
+                                         {'event': event.name}) for event in ButtonEvent}
+
+
+class ButtonState(Enum):
+    up = 1
+    settling = 2
+    down = 3
+
+
+class ButtonDebouncer:
+    """
+    Debounce state machine for a single button.  Edges are fed in with edge(), and poll() is called whenever the
+    time returned by next_deadline() has been reached to pick up any press, long-press or repeat event.
+    """
+
+    def __init__(self, btn: int):
+        self.btn = btn
+        self.state = ButtonState.up
+        self.deadline: float | None = None
+        self.long_press_reported = False
+        self.repeat_interval = BUTTON_REPEAT_START_SEC
+        self.repeat_count = 0
+
+    def edge(self, level: int, t: float):
+        if level == PRESSED_LEVEL:
+            if self.state == ButtonState.up:
+                self.state = ButtonState.settling
+                self.deadline = t + BUTTON_SETTLE_SEC
+            # Bounce while settling or already down - nothing to do
+        else:
+            # Released (or a glitch released a settling press)
+            self.state = ButtonState.up
+            self.deadline = None
+
+    def next_deadline(self) -> float | None:
+        return self.deadline
+
+    def poll(self, t: float) -> ButtonEvent | None:
+        if self.deadline is None or t < self.deadline:
+            return None
+
+        if self.state == ButtonState.settling:
+            # Level held long enough, it is a real press
+            self.state = ButtonState.down
+            self.long_press_reported = False
+            self.repeat_interval = BUTTON_REPEAT_START_SEC
+            self.repeat_count = 0
+            self.deadline = self.deadline + BUTTON_LONG_PRESS_SEC
+            return ButtonEvent.press
+
+        # Still held down
+        if not self.long_press_reported:
+            self.long_press_reported = True
+            self.deadline = self.deadline + self.repeat_interval
+            return ButtonEvent.long_press
+
+        self.repeat_count += 1
+        self.repeat_interval = max(BUTTON_REPEAT_MIN_SEC, self.repeat_interval * BUTTON_REPEAT_ACCEL)
+        # Don't try to catch up on repeats if we fell behind
+        self.deadline = max(self.deadline + self.repeat_interval, t)
+        return ButtonEvent.repeat
+
+
+class Command:
+    __slots__ = ('fn', 'args', 'future')
+
+    def __init__(self, fn: Callable, args: tuple):
+        self.fn = fn
+        self.args = args
+        self.future: concurrent.futures.Future[Any] = concurrent.futures.Future()
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            self.future.set_result(self.fn(*self.args))
+        except Exception as e:
+            # The submitter gets the exception through the future
+            logger.warning('Command %s failed: %s', getattr(self.fn, '__name__', self.fn), e)
+            self.future.set_exception(e)
+
+
+@dataclass(slots=True)
+class ButtonTiming:
+    btn: int
+    event: ButtonEvent
+    tick: int
+    queue_wait_sec: float
+    handle_sec: float
+
+
+class ButtonDispatchThread(threading.Thread):
+    """
+    Button edges are queued up by the pigpio callback thread and handled here so that slow menu work (settings
+    writes, rescheduling, display updates) never delays the next edge callback.
+    """
+
+    def __init__(self, button_map: Dict[int, int], handler: Callable[[int, ButtonEvent], None]):
+        threading.Thread.__init__(self, daemon=True)
+        self.button_map = button_map
+        self.handler = handler
+        self.debouncers: Dict[int, ButtonDebouncer] = {gpio: ButtonDebouncer(btn) for gpio, btn in button_map.items()}
+        # SimpleQueue put() never blocks and is safe to call from the pigpio callback thread
+        self.intake: queue.SimpleQueue[Command | tuple | None] = queue.SimpleQueue()
+        self.timings: collections.deque[ButtonTiming] = collections.deque(maxlen=BUTTON_TIMING_HISTORY)
+        self.last_tick: Dict[int, int] = {}
+        self.last_queue_wait: Dict[int, float] = {}
+
+    def put_edge(self, gpio: int, level: int, tick: int):
+        """ pigpio callback - only timestamps and queues the edge. """
+        self.intake.put((gpio, level, tick, time.perf_counter()))
+
+    def submit(self, fn: Callable[..., Any], *args) -> concurrent.futures.Future:
+        """ Runs fn(*args) on the dispatcher thread.  Safe to call from any thread. """
+        command = Command(fn, args)
+        self.intake.put(command)
+        return command.future
+
+    def stop(self):
+        self.intake.put(None)
+
+    def is_down(self, btn: int) -> bool:
+        """ Whether the button is being held down, for button combinations. """
+        return any(d.btn == btn and d.state == ButtonState.down for d in self.debouncers.values())
+
+    def next_timeout(self) -> float | None:
+        deadlines = [d.deadline for d in self.debouncers.values() if d.deadline is not None]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.perf_counter())
+
+    def run(self):
+        while True:
+            try:
+                edge = self.intake.get(True, self.next_timeout())
+                if edge is None:
+                    return
+                if isinstance(edge, Command):
+                    # A steady stream of commands must not hold back a press or long press that is due
+                    edge.run()
+                else:
+                    gpio, level, tick, queued_time = edge
+                    debouncer = self.debouncers.get(gpio)
+                    if debouncer:
+                        debouncer.edge(level, queued_time)
+                        self.last_tick[gpio] = tick
+                        self.last_queue_wait[gpio] = time.perf_counter() - queued_time
+                        button_queue_wait_seconds.observe(self.last_queue_wait[gpio])
+            except queue.Empty:
+                # A debounce deadline was reached
+                pass
+
+            now = time.perf_counter()
+            for gpio, debouncer in self.debouncers.items():
+                event = debouncer.poll(now)
+                if event:
+                    self.dispatch(gpio, debouncer.btn, event)
+
+    def dispatch(self, gpio: int, btn: int, event: ButtonEvent):
+        start_time = time.perf_counter()
+        try:
+            self.handler(btn, event)
+        except Exception as e:
+            logger.exception('Error handling button %s %s: %s', btn, event.name, e)
+        end_time = time.perf_counter()
+        button_handle_seconds.observe(end_time - start_time)
+        button_events[event].inc()
+        self.timings.append(ButtonTiming(btn, event, self.last_tick.get(gpio, 0), self.last_queue_wait.get(gpio, 0.0),
+                                         end_time - start_time))
+
+    def timing_summary(self) -> str:
+        timings = list(self.timings)
+        if not timings:
+            return 'No button presses recorded'
+        waits = [t.queue_wait_sec * 1000 for t in timings]
+        handles = [t.handle_sec * 1000 for t in timings]
+        return (f'{len(timings)} events: queue wait avg {sum(waits) / len(waits):.2f} ms, max {max(waits):.2f} ms; '
+                f'handle avg {sum(handles) / len(handles):.2f} ms, max {max(handles):.2f} ms')
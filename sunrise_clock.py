@@ -0,0 +1,157 @@
+# Time source for the controller.  Everything the controller does with the time - reading it, scheduling the next
+# sunrise, timing ramp steps - goes through a Clock so that the simulator (sunrise_sim.py) can swap in a VirtualClock
+# and run weeks of schedules in seconds of wall time.  The real Clock behaves exactly as the controller always has:
+# sched.scheduler on its own thread for the sunrise start and a threading.Timer per ramp step.
+
+import datetime as dt
+import heapq
+import itertools
+import sched
+import threading
+import time
+from typing import Any, Callable, List, Tuple
+
+
+class SchedulingThread(threading.Thread):
+    def __init__(self, scheduler):
+        threading.Thread.__init__(self)
+        self.scheduler = scheduler
+
+    def run(self):
+        # This call will block until finished or cancelled
+        self.scheduler.run()
+
+
+class ScheduledCall:
+    """ A call at an absolute time, run by its own scheduler thread. """
+
+    def __init__(self, epoch: float, fn: Callable, args: tuple):
+        self.scheduler = sched.scheduler(time.time, time.sleep)
+        self.event = self.scheduler.enterabs(epoch, 1, fn, args)
+        # Start the scheduler in its own thread so the caller doesn't block
+        self.thread = SchedulingThread(self.scheduler)
+        self.thread.start()
+
+    def cancel(self):
+        try:
+            self.scheduler.cancel(self.event)
+        except ValueError:
+            # Already ran or cancelled
+            pass
+
+
+class Clock:
+    """ The real wall clock. """
+
+    def time(self) -> float:
+        return time.time()
+
+    def now(self) -> dt.datetime:
+        """ Local time, like dt.datetime.now(). """
+        return dt.datetime.fromtimestamp(self.time())
+
+    def call_later(self, delay: float, fn: Callable, *args) -> 'threading.Timer | VirtualTimer':
+        """ Runs fn(*args) after delay seconds on a timer thread.  The returned timer can be cancelled. """
+        timer = threading.Timer(delay, fn, args)
+        # Required so that cancel works
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def call_at(self, epoch: float, fn: Callable, *args) -> 'ScheduledCall | VirtualTimer':
+        """ Runs fn(*args) at the given epoch time.  The returned call can be cancelled. """
+        return ScheduledCall(epoch, fn, args)
+
+
+class VirtualTimer:
+    """ A pending call on a VirtualClock.  Has the parts of the threading.Timer interface the controller uses. """
+    __slots__ = ('when', 'fn', 'args', 'cancelled')
+
+    def __init__(self, when: float, fn: Callable, args: tuple):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def join(self, timeout: float | None = None):
+        # Calls run synchronously on the simulation thread, there is never anything to wait for
+        pass
+
+    def is_alive(self) -> bool:
+        return False
+
+
+class VirtualClock(Clock):
+    """
+    Simulated time.  Time only moves when the owner calls run_next() or run_until(), which jump straight to the next
+    pending call and run it on the calling thread, so a simulation is deterministic and runs as fast as the calls do.
+    now() is still local time, so setting TZ (and calling time.tzset()) simulates daylight saving time changes.
+    """
+
+    def __init__(self, start_epoch: float):
+        self.epoch = start_epoch
+        # (when, sequence, timer) - the sequence keeps calls due at the same time in the order they were made
+        self.pending: List[Tuple[float, int, VirtualTimer]] = []
+        self.sequence = itertools.count()
+        self.calls_run = 0
+
+    def time(self) -> float:
+        return self.epoch
+
+    def call_later(self, delay: float, fn: Callable, *args) -> VirtualTimer:
+        return self.call_at(self.epoch + max(0.0, delay), fn, *args)
+
+    def call_at(self, epoch: float, fn: Callable, *args) -> VirtualTimer:
+        timer = VirtualTimer(max(epoch, self.epoch), fn, args)
+        heapq.heappush(self.pending, (timer.when, next(self.sequence), timer))
+        return timer
+
+    def next_time(self) -> float | None:
+        """ When the next pending call is due, None if nothing is pending. """
+        while self.pending and self.pending[0][2].cancelled:
+            heapq.heappop(self.pending)
+        return self.pending[0][0] if self.pending else None
+
+    def run_next(self) -> Any:
+        """ Advances to the next pending call and runs it. """
+        when = self.next_time()
+        if when is None:
+            raise IndexError('no pending calls')
+        _, _, timer = heapq.heappop(self.pending)
+        self.epoch = when
+        self.calls_run += 1
+        return timer.fn(*timer.args)
+
+    def set_time(self, epoch: float):
+        """ Moves the clock forward without running anything, for running calls in an order decided elsewhere. """
+        self.epoch = max(self.epoch, epoch)
+
+    def find_call(self, match: Callable[[VirtualTimer], bool]) -> VirtualTimer | None:
+        """ The earliest pending call that matches, None if there isn't one. """
+        found = min((p for p in self.pending if not p[2].cancelled and match(p[2])), key=lambda p: p[:2], default=None)
+        return found[2] if found else None
+
+    def run_call(self, timer: VirtualTimer) -> Any:
+        """ Runs a pending call now, due or not.  It is removed from the pending calls. """
+        timer.cancelled = True
+        self.calls_run += 1
+        return timer.fn(*timer.args)
+
+    def run_until(self, epoch: float, after_each: Callable[[], None] | None = None):
+        """
+        Runs every call due before the given time, in time order, then advances the clock to it.
+        :param epoch: Time to stop at
+        :param after_each: Called after each call, e.g., to check invariants
+        :return: None
+        """
+        while True:
+            when = self.next_time()
+            if when is None or when > epoch:
+                break
+            self.run_next()
+            if after_each:
+                after_each()
+        self.epoch = max(self.epoch, epoch)
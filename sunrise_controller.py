@@ -1,25 +1,40 @@
 import calendar
 import datetime as dt
-import queue
+import logging
+import math
 import threading
-import time
 from abc import ABC, abstractmethod
 from calendar import MONDAY, FRIDAY, SATURDAY, SUNDAY
 from dataclasses import dataclass
 from enum import Enum
-from sched import scheduler, Event
-from threading import Timer
-from typing import List, Dict, Any, Self
+from concurrent.futures import Future
+from typing import List, Dict, Any, Callable, TYPE_CHECKING
 
 import pigpio
 
-from dimmer import Dimmer
-from sunrise_data import SunriseData, SunriseSettings
-from sunrise_view import OledDisplay
+from dimmer import Dimmer, DimmerCalibration
+from sunrise_buttons import ButtonDispatchThread, ButtonEvent
+from sunrise_clock import Clock, ScheduledCall, VirtualTimer
+from sunrise_data import SunriseData, SunriseSettings, MAX_DURATION_MINUTES, MAX_AUTO_OFF_MINUTES
+from sunrise_display import DisplayThread
+from sunrise_history import EventHistory, EventType
+from sunrise_journal import RunJournal, RunState
+from sunrise_log import fields
+from sunrise_metrics import registry
+from sunrise_pigpio import shared_connection
+from sunrise_profile import profiler
+from sunrise_ramp import RampRecorder
+from sunrise_trace import TraceWriter, TracingClock, REC_STARTUP
+from sunrise_watchdog import watchdog
+
+if TYPE_CHECKING:
+    # Only needed for type hints, so the controller can be run headless (see sunrise_sim.py) without the display libraries
+    from sunrise_api import ControlApiServer
+    from sunrise_view import View
 
 BRIGHTNESS_CHANGE_PERCENT: int = 5
-DISPLAY_MSG_Q_SIZE: int = 12
-SWITCH_DEBOUNCE_MS: int = 600
+# pigpio glitch filter only removes electrical spikes, real debouncing is done by the ButtonDebouncer
+SWITCH_GLITCH_FILTER_US: int = 300
 DEFAULT_BUTTON_LABEL = 'X     <     >    Prev'
 TIME_SET_BUTTON_LABEL = 'Select   -   +   Save'
 
@@ -28,6 +43,17 @@ btn2_gpio = 16
 btn3_gpio = 20
 btn4_gpio = 21
 button_map = {btn1_gpio: 1, btn2_gpio: 2, btn3_gpio: 3, btn4_gpio: 4}
+# Held together start or stop the profiler (see sunrise_profile.py): Menu, then Prev
+PROFILE_BUTTON_COMBO = (1, 4)
+
+ramp_step_lateness_seconds = registry.histogram('sunrise_ramp_step_lateness_seconds',
+                                                'How late each sunrise ramp step ran compared to plan')
+ramp_steps = registry.counter('sunrise_ramp_steps_total', 'Sunrise ramp steps run')
+stale_timer_calls = registry.counter('sunrise_stale_timer_calls_total',
+                                     'Ramp steps and sunrise starts dropped because their ramp or schedule was replaced')
+sunrise_running = registry.gauge('sunrise_running', '1 while a sunrise is running')
+
+logger = logging.getLogger(__name__)
 
 
 class MenuName(Enum):
@@ -42,6 +68,7 @@ class MenuName(Enum):
     set_duration = 'Duration'
     enable = 'Enable Schedule'
     display_timer = "Display Auto-Off"
+    calibrate = 'Dimmer Calibration'
     enable_sub = 'Weekday   Weekend   Daily'
     monday = 'Monday'
     tuesday = 'Tuesday'
@@ -54,215 +81,113 @@ class MenuName(Enum):
     network = 'Network Settings'
 
 
-def calc_start_datetime(start_time: str, increment_from_today: int) -> dt.datetime:
+def calc_start_datetime(start_time: str, increment_from_today: int, now: dt.datetime) -> dt.datetime:
     """ Settings for start are day of week and hour:minute. To figure out actual date/time of start, need to
         add in the number of days from today's date.  E.g., if it is Tuesday and next sunrise is next Tuesday, the
         increment will be 7 days.
     """
-    month = dt.datetime.now().month
-    day = dt.datetime.now().day
-    year = dt.datetime.now().year
-
-    start = f'{month} {day} {year} {start_time}'
-    wtm = time.strptime(start, '%m %d %Y %H:%M')
-    epoch_start = time.mktime(wtm)
-    dt_start = dt.datetime.fromtimestamp(epoch_start)
-
-    dt_start = dt_start + dt.timedelta(days=increment_from_today)
-    return dt_start
-
-
-class SchedulingThread(threading.Thread):
-    def __init__(self, scheduler):
-        threading.Thread.__init__(self)
-        self.scheduler = scheduler
-
-    def run(self):
-        # This call will block until finished or cancelled
-        self.scheduler.run()
-
-
-class DisplayThread(threading.Thread):
-    def __init__(self, view, data, event):
-        threading.Thread.__init__(self)
-        self._view = view
-        self.data = data
-        self.event = event
-        self.auto_off_minutes = 1
-        self.line1 = ''
-        self.line2 = ''
-        self.line3 = ''
-        self.line4 = ''
-        self.status = ''
-        self.scroll = True
-        self.at_end = False
-        self.update_made = False
-        self.msg_q = queue.Queue(DISPLAY_MSG_Q_SIZE)
-
-    class DisplayThreadMessages(Enum):
-        Wake = 1
-        Update = 2
-        AutoOff = 3
-
-    wake = DisplayThreadMessages.Wake
-    update = DisplayThreadMessages.Update
-    auto_off = DisplayThreadMessages.AutoOff
-
-    def run(self):
-        print("ENTER DisplayThread run()")
-        # Display event loop - updates display while it is on
-        self._view.turn_display_on()
-        self._view.set_display_lines(self.line1, self.line2, self.line3, self.line4)
-        self._view.update_display()
-        self.at_end = False
-        while True:
-            while self._view.is_display_on():
-                self.update_made = False
-                if self.event.is_set():
-                    print('DisplayThread got event, exiting...')
-                    return
-
-                max_wait_time = 1
-                if self.scroll:
-                    if self.at_end:
-                        incremental_wait_time = 2.0
-                    else:
-                        incremental_wait_time = 0.1
-                    try:
-                        msg = self.msg_q.get(True, incremental_wait_time)
-                        if msg == self.update:
-                            self._view.update_display()
-                            self.update_made = True
-                    except queue.Empty:
-                        # Okay for no display changes
-                        self.at_end = self._view.scroll_line3()
-                        self.update_made = True
-                        pass
-                else:
-                    # Delay display update unless someone gives us a new update
-                    try:
-                        msg = self.msg_q.get(True, max_wait_time)
-                        if msg == self.update:
-                            self._view.update_display()
-                            self.update_made = True
-                        elif msg == self.auto_off:
-                            self._view.set_auto_off_minutes(self)
-                        else:
-                            print(f'ERROR - unknown message received in DisplayThread: {msg}')
-                    except queue.Empty:
-                        # Okay for no display changes
-                        pass
-
-                # If a non-urgent display update was made, pick it up before starting next scroll
-                self._view.set_display_lines(self.line1, self.line2, self.line3, self.line4)
-                self._view.set_status_display_line(self.status)
-                # If no recent display update, update now to ensure any changes, including clock time are shown
-                if not self.update_made:
-                    self._view.update_display()
-
-                self._view.check_display_idle_off()
-
-            # Wait for something to wake up the display or other message
-            msg = self.msg_q.get(True)
-            if msg == self.wake:
-                print('Waking Display...')
-                self._view.turn_display_on()
-            elif msg == self.auto_off:
-                self._view.set_auto_off_minutes(self)
-            else:
-                print(f'ERROR - unknown message received in DisplayThread: {msg}')
-
-    # Send a message to unblock the display thread and start display updates again.
-    def turn_on_display(self):
-        self.msg_q.put(self.wake, False)
-
-    def update_auto_off(self, ao_minutes: int):
-        self.auto_off_minutes = ao_minutes
-        self.msg_q.put(self.auto_off, False)
-
-    def update_display(self):
-        self._view.set_display_lines(self.line1, self.line2, self.line3, self.line4)
-        self._view.scroll = self.scroll
-        self.msg_q.put(self.update, False)
-
-    def update_line2_display(self, line2):
-        self.line2 = line2
-        self._view.set_line2(line2)
-        self.msg_q.put(self.update, False)
-
-    def update_line3_display(self, line3):
-        self.line3 = line3
-        self._view.set_line3(line3)
-        self.msg_q.put(self.update, False)
-
-    def update_line4_display(self, line4):
-        self.line4 = line4
-        self._view.set_line4(line4)
-        self.msg_q.put(self.update, False)
-
-    def update_status_line(self, status):
-        self._view.set_status_display_line(status)
-        self.msg_q.put(self.update, False)
-
-    def enable_status(self):
-        self._view.enable_status_display()
-
-    def disable_status(self):
-        self._view.disable_status_display()
-
-    def center_line(self, line: str) -> str:
-        return self._view.center_line(line)
+    # Move to the start day before setting the time, otherwise a time that doesn't exist today (skipped by a daylight
+    # saving change) would be shifted and carried over to the start day.
+    start_day = now.date() + dt.timedelta(days=increment_from_today)
+    dt_start = dt.datetime.combine(start_day, dt.datetime.strptime(start_time, '%H:%M').time())
+    # Round trip through epoch time so a skipped time on the start day becomes the equivalent time after the change
+    return dt.datetime.fromtimestamp(dt_start.timestamp())
 
 
 class SunriseController:
-    sunrise_event: Event | None
+    sunrise_event: ScheduledCall | VirtualTimer | None
 
-    def __init__(self, view: OledDisplay, data: SunriseData, dimmer: Dimmer):
-        self.running_duration_minutes = None
-        self.disp_thread = None
+    def __init__(self, view: 'View', data: SunriseData, dimmer: Dimmer, clock: Clock | None = None,
+                 pi: pigpio.pi | None = None, journal: RunJournal | None = None, history: EventHistory | None = None,
+                 tracer: TraceWriter | None = None):
         global btn1_gpio, btn2_gpio, btn3_gpio, btn4_gpio
-        threading.Thread.__init__(self)
         self.dimmer_step_size: int = 1
-        self.pi = pigpio.pi()
-        self.sunrise_scheduler = None
-        self.running_sunrise_timer = None
+        # All time keeping goes through the clock so that it can be simulated
+        self.clock: Clock = clock or Clock()
+        # Records every input for replay (see sunrise_trace.py), through the clock for timers and the button callback
+        self.tracer = tracer
+        if tracer:
+            self.clock = TracingClock(self.clock, tracer)
+            tracer.record_settings(data)
+        # The same daemon connection as the dimmer
+        self.pi = pi or shared_connection().pi
+        # Controller state is only changed on the button dispatch thread, see on_dispatcher().  Timers are tagged
+        # with the generation they were set up in, a cancelled or replaced ramp or schedule moves on to the next
+        # generation so that a call already on its way to the dispatcher is dropped when it gets there.
+        self.sunrise_event: ScheduledCall | VirtualTimer | None = None
+        self.schedule_generation: int = 0
+        self.running_sunrise_timer: threading.Timer | VirtualTimer | None = None
+        self.ramp_generation: int = 0
         # All view control should be through the Display thread
-        self._view = view
+        self._view: 'View' = view
         self.data: SunriseData = data
         self.settings: SunriseSettings = data.settings
         self.dimmer: Dimmer = dimmer
-        self.cancel: bool = False
-        self.sec_per_step: int = 0
+        # Seconds between ramp steps, set when a ramp starts or is joined
+        self.sec_per_step: float = 0.0
+        # When the next ramp step is due, used to measure timer lateness
+        self.next_step_time: float | None = None
+        # Planned vs actual time of every ramp step, summarized into the history at the end of each sunrise
+        self.ramp_recorder = RampRecorder()
         self.is_running: bool = False
-        self.running_start_time: dt.datetime = dt.datetime.now()
+        # True while the running ramp is another unit's, see sunrise_sync.py
+        self.following: bool = False
+        self.running_start_time: dt.datetime = self.clock.now()
         self.running_duration_minutes: int = 0
         self.ctrl_event: threading.Event = threading.Event()
-        self.current_menu: Menu = TopMenu(self)
+        # Started by startup(), menus queue their display updates to it from the start
+        self.disp_thread: DisplayThread = DisplayThread(view, data, self.ctrl_event)
+        self.journal: RunJournal = journal or RunJournal()
+        if tracer:
+            tracer.record_journal(self.journal.load())
+        self.history: EventHistory = history or EventHistory(time_fn=self.clock.time)
+        self.history.append(EventType.startup)
+        # The whole menu tree is built once and reused
+        self.top_menu: Menu = build_menu(self, MENU_TREE)
+        self.current_menu: Menu = self.top_menu
+        # Set by the control API server when it is running, shown in the network menu
+        self.api_server: 'ControlApiServer | None' = None
+        # Called (from any thread) whenever the lamp level, running state or status changes
+        self.state_listeners: List[Callable[[], None]] = []
+        self.dimmer.add_level_listener(self.level_changed)
+        # Button whose press woke up the display - its long-press and repeats are ignored until released
+        self.wake_button: int | None = None
+        # Set once a button combination has been acted on, so the other button's long press doesn't repeat it
+        self.combo_handled: bool = False
+        self.button_dispatcher = ButtonDispatchThread(button_map, self.button_event)
+        # The start of the next sunrise and each ramp step are expected on time, buttons are probed through the
+        # dispatcher queue
+        self.scheduler_heartbeat = watchdog.heartbeat('scheduler')
+        self.ramp_heartbeat = watchdog.heartbeat('ramp')
+        watchdog.heartbeat('buttons', probe=self.button_dispatcher.submit)
         self.hookup_buttons(self.pi, [btn1_gpio, btn2_gpio, btn3_gpio, btn4_gpio])
 
     def hookup_buttons(self, pi, gpio_list: List[int]):
         for gpio in gpio_list:
             pi.set_pull_up_down(gpio, pigpio.PUD_UP)
-            # Debounce the switches
-            pi.set_glitch_filter(gpio, SWITCH_DEBOUNCE_MS)
-            pi.callback(gpio, pigpio.FALLING_EDGE, self.button_press)
+            pi.set_glitch_filter(gpio, SWITCH_GLITCH_FILTER_US)
+            # Both edges are needed to debounce and to detect long presses
+            put_edge = self.tracer.edge_callback(self.button_dispatcher.put_edge) if self.tracer \
+                else self.button_dispatcher.put_edge
+            pi.callback(gpio, pigpio.EITHER_EDGE, put_edge)
 
     def startup(self):
         # Start display thread
-        self.disp_thread = DisplayThread(self._view, self.data, self.ctrl_event)
         self.disp_thread.start()
-        print(f'current_menu_name: {self.current_menu.get_menu_name().value}')
-        self.current_menu.update_display()
+        # Button edges received before now are waiting in the dispatcher queue
+        self.button_dispatcher.start()
+        logger.debug('current_menu_name: %s', self.current_menu.get_menu_name().value)
+        self.submit(self.current_menu.update_display)
 
-        print("Entering Event loop...")
+        logger.info('Entering Event loop...')
         # This event loop does not have any events to process but could be added in the future.
         # Its primary purpose is to block so that a keyboard interrupt can be used to shut everything down.
         while True:
-            self.startup_check_schedule()
-            print("Event Loop: Waiting for event....")
+            self.submit(self.startup_check_schedule).result()
+            logger.debug('Event Loop: Waiting for event....')
             # Block and wait for an event that, right now, will never come
             self.ctrl_event.wait()
-            print("GOT EVENT!!!!!!!!!!!!")
+            logger.debug('Event loop got event')
             self.ctrl_event.clear()
 
     def is_schedule_enabled(self) -> bool:
@@ -279,13 +204,19 @@ class SunriseController:
         return True
 
     def startup_check_schedule(self):
+        if self.tracer:
+            self.tracer.record(REC_STARTUP)
         # Default to idle
-        self.is_running = False
-        now = dt.datetime.now()
+        self.set_running(False)
+        now = self.clock.now()
         today = now.weekday()
 
         # No need to check for pending schedule during startup
 
+        # If we went down in the middle of a sunrise, the journal knows exactly where the ramp was
+        if self.resume_journaled_sunrise():
+            return
+
         # No need for any checks if not enabled for sunrise
         if not self.is_schedule_enabled():
             return
@@ -294,13 +225,13 @@ class SunriseController:
             # There is a sunrise scheduled for today.
             # Handle 2 cases: 1) In the middle of a sunrise , 2) scheduled for later today.
             # No need to do anything if already missed today's schedule sunrise.
-            dt_start = calc_start_datetime(self.settings.start_time[today], 0)
+            dt_start = calc_start_datetime(self.settings.start_time[today], 0, now)
 
             # Sunrise resolution is 1 minute so don't include last minute duration in check to prevent race conditions.
             if dt_start < now < (dt_start + dt.timedelta(minutes=self.settings.duration_minutes[today] - 1)):
                 # In the middle of a sunrise, set to proper level
-                print('In the middle of sunrise...')
-                self.is_running = True
+                logger.info('In the middle of sunrise...')
+                self.set_running(True)
                 self.running_start_time = now
                 minutes_remaining = (now - dt.timedelta(minutes=self.settings.duration_minutes[today])).minute
                 if minutes_remaining > 0:
@@ -318,8 +249,8 @@ class SunriseController:
     def handle_schedule_change(self):
         """ Called whenever a change is made to the saved schedule. """
 
-        print('Checking for schedule change...')
-        now = dt.datetime.now()
+        logger.debug('Checking for schedule change...')
+        now = self.clock.now()
         today = now.weekday()
 
         # Since a change might have affected a scheduled sunrise, go ahead and cancel.  It will get re-scheduled
@@ -335,7 +266,7 @@ class SunriseController:
             # Tack on seconds to setting for unusual case where cancel happens seconds after start - we don't want
             # to reschedule the cancelled sunrise
             start_time = f'{self.settings.start_time[today]}:00'
-            dt_start = calc_start_datetime(self.settings.start_time[today], 0)
+            dt_start = calc_start_datetime(self.settings.start_time[today], 0, now)
             # See if already missed today's schedule sunrise.
             if dt_start > now:
                 # Sunrise start is for later today - set up an event to start it
@@ -346,65 +277,87 @@ class SunriseController:
         self.schedule_future_sunrise_event()
 
     def schedule_today_sunrise_event(self, dt_start: dt.datetime):
-        today = dt.datetime.now().weekday()
+        today = self.clock.now().weekday()
         self.schedule_sunrise_start(dt_start, self.settings.duration_minutes[today])
         t = dt.datetime.strptime(self.settings.start_time[today], "%H:%M")
         t2 = t.strftime("%I:%M %p")
-        print(f'Scheduling start today at: {t2}, duration: {self.settings.duration_minutes[today]} minutes')
-        self.disp_thread.status = f'Next sunrise: today at {t2}'
+        logger.info('Scheduling start today at: %s, duration: %s minutes', t2, self.settings.duration_minutes[today])
+        self.set_status(f'Next sunrise: today at {t2}')
 
     def schedule_future_sunrise_event(self):
         # Go through every day of the week starting tomorrow and wrap around to hit every day
         # of the week including the day of week that matches today to cover the case where next sunrise is next week
         # on the same day (E.g., It's Tuesday and next sunrise is 7 days from now on next Tuesday).
-        today = dt.datetime.now().weekday()
+        now = self.clock.now()
+        today = now.weekday()
         have_scheduled_start = False
         day_index = (today + 1) % (SUNDAY + 1)
         day_increment = 1
         for day in range(SUNDAY):
             if self.is_schedule_enabled_for_day(day_index):
                 have_scheduled_start = True
-                dt_start = calc_start_datetime(self.settings.start_time[day_index], day_increment)
+                dt_start = calc_start_datetime(self.settings.start_time[day_index], day_increment, now)
                 t = dt.datetime.strftime(dt_start, "%I:%M %p")
-                print(
-                    f'Scheduling future start: {calendar.day_name[dt_start.weekday()]} at {t}, duration: {self.settings.duration_minutes[day_index]} minutes')
+                logger.info('Scheduling future start: %s at %s, duration: %s minutes',
+                            calendar.day_name[dt_start.weekday()], t, self.settings.duration_minutes[day_index])
                 self.schedule_sunrise_start(dt_start, self.settings.duration_minutes[day_index])
-                self.disp_thread.status = f'Next sunrise: {calendar.day_name[dt_start.weekday()]} at {t}'
+                self.set_status(f'Next sunrise: {calendar.day_name[dt_start.weekday()]} at {t}')
                 break
             day_index = (day_index + 1) % (SUNDAY + 1)
             day_increment = day_increment + 1
 
         if not have_scheduled_start:
-            self.disp_thread.status = 'Idle, no sunrise scheduled'
+            self.set_status('Idle, no sunrise scheduled')
 
-    def start_schedule(self, duration_minutes: int, starting_percentage: int = 0):
+    def start_schedule(self, duration_minutes: int, starting_percentage: int = 0, generation: int | None = None):
         """
-        Called from an event thread or directly.
+        Called by the sunrise start timer or directly.
         :param duration_minutes:
         :param starting_percentage:
+        :param generation: Schedule generation of the timer, None when called directly
         :return:
         """
-        print('Sunrise starting....')
-        self.is_running = True
+        if not self.on_dispatcher():
+            # Scheduler thread
+            self.submit(self.start_schedule, duration_minutes, starting_percentage, generation)
+            return
+        if generation is not None and generation != self.schedule_generation:
+            logger.debug('Dropping the start of a cancelled sunrise')
+            stale_timer_calls.inc()
+            return
+        if self.following and self.is_running:
+            logger.info('Following another unit\'s sunrise, not starting our own')
+            self.sunrise_event = None
+            return
+        logger.info('Sunrise starting', extra=fields(duration_minutes=duration_minutes,
+                                                     starting_percentage=starting_percentage))
+        self.set_running(True)
+        self.scheduler_heartbeat.beat()
+        self.next_step_time = None
         self.sunrise_event = None
+        self.ramp_generation += 1
         self.dimmer.enable()
         # Calculate the end time based upon current time and duration setting.
-        self.running_start_time = dt.datetime.now()
+        self.running_start_time = self.clock.now()
         self.running_duration_minutes = duration_minutes
-        self.sec_per_step: int = int((duration_minutes * 60) / self.dimmer.get_num_steps())
-        self.dimmer_step_size = 1
-
-        # If duration is too short for number of steps, calculate step size and set minimum seconds per step.
-        if self.sec_per_step == 0:
-            self.sec_per_step = 1
-            self.dimmer_step_size = int(self.dimmer.get_num_steps() / (duration_minutes * 60))
-
         start_level = self.dimmer.get_min_level() + 1
         if starting_percentage > 0:
             start_level = int(self.dimmer.get_max_level() * (starting_percentage * 0.01))
+        # The first step is taken right away and the ramp ends a step after reaching the top, so the steps from the
+        # start level fill the whole duration.  A calibrated dimmer has fewer, longer steps.  A sunrise too short for
+        # a step a second per level takes bigger steps, the last one only up to the top.
+        levels = max(1, self.dimmer.get_max_level() - start_level)
+        self.dimmer_step_size = math.ceil(levels / (duration_minutes * 60))
+        self.sec_per_step = duration_minutes * 60 / math.ceil(levels / self.dimmer_step_size)
+
         self.dimmer.set_level(start_level)
+        self.journal.record_start(self.running_start_time.timestamp(), duration_minutes, start_level,
+                                  self.dimmer_step_size, self.sec_per_step)
+        self.ramp_recorder.start(self.running_start_time.timestamp(), self.sec_per_step, duration_minutes)
+        self.history.append(EventType.sunrise_start, arg=duration_minutes, value=start_level)
+        self.disp_thread.start_progress(duration_minutes * 60, self.dimmer.get_max_level(), self.dimmer.get_level())
 
-        print(f'start_schedule() - start_level={start_level}, level={self.dimmer.get_level()}')
+        logger.debug('start_schedule() - start_level=%s, level=%s', start_level, self.dimmer.get_level())
         # If display is off, go to the top menu and turn on the display.
         if not self._view.is_display_on():
             self.display_on()
@@ -414,142 +367,363 @@ class SunriseController:
 
         self.periodic_run_sunrise()
 
-    def periodic_run_sunrise(self):
+    def resume_journaled_sunrise(self) -> bool:
+        """
+        Picks up a sunrise that was running when the process died.  The lamp is set to the level the ramp should be
+        at right now and the ramp continues on its original step grid so that it still ends at the original time.
+        :return: True if a sunrise was resumed
+        """
+        state: RunState | None = self.journal.load()
+        if state is None or not state.is_running():
+            return False
+
+        now = self.clock.time()
+        if not (state.start_epoch <= now < state.end_epoch()) or state.sec_per_step <= 0:
+            # Sunrise would have already finished (or journal is bogus)
+            self.journal.clear()
+            return False
+
+        level = self.join_ramp(state, now)
+        logger.info('Resumed sunrise from journal', extra=fields(journal_level=state.level, level=level,
+                                                                 duration_minutes=state.duration_minutes))
+        self.history.append(EventType.sunrise_resume, arg=state.duration_minutes, value=level, value2=state.level)
+        return True
+
+    def follow_ramp(self, plan: RunState) -> bool:
         """
-        Increments the dimmer level during a sunrise.  Also checks for cancel and end of sunrise.
+        Joins a sunrise ramp run by another unit (see sunrise_sync.py).  Any ramp of our own is dropped and the lamp
+        follows the other unit's plan, on the same step grid.
+        :param plan: The other unit's ramp, with times already converted to our clock
+        :return: True if the ramp was joined
+        """
+        now = self.clock.time()
+        if not (plan.start_epoch <= now < plan.end_epoch()) or plan.sec_per_step <= 0:
+            return False
+        if self.is_running and self.running_sunrise_timer:
+            # join_ramp() moves to a new ramp generation, a step of the old ramp that already fired is dropped
+            self.running_sunrise_timer.cancel()
+            self.record_ramp_summary(False)
+
+        self.journal.record_start(plan.start_epoch, plan.duration_minutes, plan.start_level, plan.step_size,
+                                  plan.sec_per_step)
+        level = self.join_ramp(plan, now)
+        self.following = True
+        logger.info('Following sunrise of another unit', extra=fields(level=level,
+                                                                      duration_minutes=plan.duration_minutes))
+        self.history.append(EventType.sunrise_follow, arg=plan.duration_minutes, value=level)
+        return True
+
+    def set_followed_level(self, level: int):
+        """ Corrects the lamp level while following another unit's ramp.  The ramp carries on from there. """
+        if self.following and self.is_running:
+            self.dimmer.set_level(min(level, self.dimmer.get_max_level()))
+            now = self.clock.time()
+            self.journal.record_level(self.dimmer.get_level(), now)
+            self.disp_thread.update_progress(now - self.running_start_time.timestamp(), self.dimmer.get_level())
+
+    def stop_following(self):
+        """ The unit being followed stopped its sunrise early. """
+        if self.following and self.is_running:
+            self.cancel_running_schedule()
+
+    def join_ramp(self, state: RunState, now: float) -> int:
+        """
+        Sets the lamp to the level the given ramp should be at right now and continues the ramp on its step grid so
+        that it ends when the ramp was planned to end.
+        :return: The level the lamp was set to
+        """
+        elapsed_steps = int((now - state.start_epoch) / state.sec_per_step)
+        # The first step runs right at the start, so step n has taken the level n + 1 steps past the start level
+        level = min(state.start_level + (elapsed_steps + 1) * state.step_size, self.dimmer.get_max_level())
+
+        self.set_running(True)
+        self.sunrise_event = None
+        self.ramp_generation += 1
+        self.dimmer.enable()
+        self.running_start_time = dt.datetime.fromtimestamp(state.start_epoch)
+        self.running_duration_minutes = state.duration_minutes
+        self.sec_per_step = state.sec_per_step
+        self.dimmer_step_size = state.step_size
+        self.dimmer.set_level(level)
+        self.journal.record_level(level, now)
+        self.ramp_recorder.start(state.start_epoch, state.sec_per_step, state.duration_minutes, elapsed_steps + 1)
+        # The part of the ramp that was missed is drawn as a straight line
+        self.disp_thread.start_progress(state.duration_minutes * 60, self.dimmer.get_max_level(), state.start_level)
+        self.disp_thread.update_progress(now - state.start_epoch, level)
+
+        if not self._view.is_display_on():
+            self.display_on()
+        elif self.current_menu.get_menu_name() == MenuName.top:
+            self.current_menu.update_display()
+
+        # Next step lands where it would have if we never went down
+        next_step_delay = state.start_epoch + (elapsed_steps + 1) * state.sec_per_step - now
+        self.next_step_time = now + next_step_delay
+        self.running_sunrise_timer = self.clock.call_later(next_step_delay, self.periodic_run_sunrise,
+                                                           self.ramp_generation)
+        self.ramp_heartbeat.expect(next_step_delay)
+        return level
+
+    def periodic_run_sunrise(self, generation: int | None = None):
+        """
+        Increments the dimmer level during a sunrise.  Also checks for end of sunrise.
         At the end of the sunrise, runs the check for scheduling the next sunrise.
         Called initially from start_schedule() then schedules itself to be called periodically.
+        :param generation: Ramp generation of the timer, None when called directly
         :return: None
         """
-        if self.cancel:
-            print('check_schedule(): CANCELLED!!!')
-
-        if self.dimmer.increment_level(self.dimmer_step_size) and not self.cancel:
+        if not self.on_dispatcher():
+            # Ramp timer thread
+            self.submit(self.periodic_run_sunrise, generation)
+            return
+        if generation is not None and generation != self.ramp_generation:
+            logger.debug('Dropping a step of an ended ramp')
+            stale_timer_calls.inc()
+            return
+        if self.next_step_time is not None:
+            ramp_step_lateness_seconds.observe(max(0.0, self.clock.time() - self.next_step_time))
+        ramp_steps.inc()
+
+        # The last step of a ramp with bigger steps may be short, so the ramp ends at the top on time
+        step = min(self.dimmer_step_size, self.dimmer.get_max_level() - self.dimmer.get_level())
+        if step > 0 and self.dimmer.increment_level(step):
+            now = self.clock.time()
+            self.ramp_recorder.record(self.dimmer.get_level(), now)
+            self.journal.record_level(self.dimmer.get_level(), now)
+            self.disp_thread.update_progress(now - self.running_start_time.timestamp(), self.dimmer.get_level())
             minutes_remain = int((self.sec_per_step * (
                     (self.dimmer.get_max_level() - self.dimmer.get_level()) / self.dimmer_step_size)) / 60)
             if minutes_remain == 1:
-                self.disp_thread.status = 'Sunrise in progress, 1 minute remaining'
+                self.set_status('Sunrise in progress, 1 minute remaining')
             elif minutes_remain > 1:
-                self.disp_thread.status = f'Sunrise in progress, {minutes_remain} minutes remaining'
+                self.set_status(f'Sunrise in progress, {minutes_remain} minutes remaining')
             else:
-                self.disp_thread.status = 'Sunrise in progress, less than 1 minute remaining'
+                self.set_status('Sunrise in progress, less than 1 minute remaining')
 
-            self.running_sunrise_timer = Timer(self.sec_per_step, self.periodic_run_sunrise)
-            self.running_sunrise_timer.daemon = True  # required so that cancel works
-            self.running_sunrise_timer.start()
+            self.next_step_time = self.clock.time() + self.sec_per_step
+            self.running_sunrise_timer = self.clock.call_later(self.sec_per_step, self.periodic_run_sunrise,
+                                                               self.ramp_generation)
+            self.ramp_heartbeat.beat(self.sec_per_step)
         else:
-            # Either we are done or were cancelled
-            if self.cancel:
-                print("Sunrise cancelled")
-                self.cancel = False
-            else:
-                print("Sunrise complete")
-
-            self.handle_sunrise_end()
+            logger.info('Sunrise complete', extra=fields(duration_minutes=self.running_duration_minutes,
+                                                         level=self.dimmer.get_level()))
+            self.history.append(EventType.sunrise_complete, arg=self.running_duration_minutes,
+                                value=self.dimmer.get_level())
+            self.handle_sunrise_end(True)
 
     def cancel_pending_schedule(self):
-        # If queue already created and a scheduled event is queued up to run, cancel it
-        if self.sunrise_scheduler and self.sunrise_scheduler.queue:
-            try:
-                if self.sunrise_event:
-                    self.sunrise_scheduler.cancel(self.sunrise_event)
-                    # scheduler.cancel(self.sunrise_event)
-                    self.sunrise_event = None
-            except ValueError:
-                # no event in the queue to cancel
-                pass
+        # If a sunrise start is queued up to run, cancel it.  A start that already fired is dropped.
+        self.schedule_generation += 1
+        if self.sunrise_event:
+            self.sunrise_event.cancel()
+            self.sunrise_event = None
+            self.scheduler_heartbeat.idle()
 
     def cancel_running_schedule(self):
         if not self.is_running:
             return
 
         # Scheduled event is running, stop it
-        print('Cancelling running schedule')
-        try:
+        logger.info('Cancelling running schedule')
+        # Make sure a cancelled sunrise is never resumed after a restart
+        self.journal.clear()
+        elapsed_minutes = (self.clock.now() - self.running_start_time).total_seconds() / 60
+        self.history.append(EventType.sunrise_cancel, arg=self.running_duration_minutes, value=self.dimmer.get_level(),
+                            value2=elapsed_minutes)
+        # No need to wait for the timer thread, a step that already fired is dropped (handle_sunrise_end() moves on
+        # to a new ramp generation)
+        if self.running_sunrise_timer:
             self.running_sunrise_timer.cancel()
-            self.running_sunrise_timer.join()
-            if self.running_sunrise_timer.is_alive():
-                print('ERROR, unable to cancel sunrise timer!')
-            else:
-                print('Sunrise timer successfully cancelled')
-                self.handle_sunrise_end()
-                return
-        except Exception as e:
-            print('ERROR trying to cancel dimming schedule:')
-            print(e)
-
-        # If we made it here, we were unable to cancel.
-        # Set the cancel flag so that the periodic routine cancels itself when it runs but turn off the dimmer now.
-        self.cancel = True
-        self.dimmer.turn_off()
-
-        # If at top menu, update it so that On/Off label reflects that the dimmer is off.
-        if self.current_menu.get_menu_name() == MenuName.top:
-            self.current_menu.update_display()
+        self.handle_sunrise_end()
 
-    def handle_sunrise_end(self):
-        self.is_running = False
+    def handle_sunrise_end(self, completed: bool = False):
+        self.record_ramp_summary(completed)
+        self.ramp_generation += 1
+        self.running_sunrise_timer = None
+        self.following = False
+        self.set_running(False)
+        self.ramp_heartbeat.beat()
+        self.next_step_time = None
+        self.journal.clear()
         self.dimmer.turn_off()
+        self.disp_thread.end_progress()
         if self.current_menu.get_menu_name() == MenuName.top:
             self.current_menu.update_display()
         # Queue up the next sunrise event
         self.handle_schedule_change()
 
-    def schedule_sunrise_start(self, start_time: dt.datetime, duration_minutes: int):
-        # Create a new scheduler
-        self.sunrise_scheduler = scheduler(time.time, time.sleep)
+    def record_ramp_summary(self, completed: bool):
+        summary = self.ramp_recorder.finish(completed)
+        if summary is None:
+            return
+        logger.info('Ramp timing: %s', summary)
+        self.history.append(EventType.ramp_timing, source=min(summary.missed_steps, 255),
+                            arg=min(int(summary.jitter_p99 * 1000), 32767), value=summary.drift,
+                            value2=summary.end_error)
 
+    def schedule_sunrise_start(self, start_time: dt.datetime, duration_minutes: int):
         # Schedule the start
         epoch_start_time = start_time.timestamp()
-        print('Creating new sunrise event')
-        self.sunrise_event = self.sunrise_scheduler.enterabs(epoch_start_time, 1,
-                                                             self.start_schedule, (duration_minutes,))
-
-        # Start the scheduler in its own thread so we don't block here
-        st = SchedulingThread(self.sunrise_scheduler)
-        st.start()
+        logger.debug('Creating new sunrise event')
+        self.schedule_generation += 1
+        self.sunrise_event = self.clock.call_at(epoch_start_time, self.start_schedule, duration_minutes, 0,
+                                                self.schedule_generation)
+        self.scheduler_heartbeat.expect(epoch_start_time - self.clock.time())
 
     def set_clock(self):
         pass
 
+    def center_line(self, line: str) -> str:
+        return self._view.center_line(line)
+
     def display_on(self):
-        self.current_menu = TopMenu(self)
+        self.current_menu = self.top_menu.enter()
         self.disp_thread.turn_on_display()
         self.current_menu.update_display()
 
-    def button_press(self, gpio, level, tick):
-        global button_map
-        btn = button_map[gpio]
-        print(f'Button {btn} pressed...')
-        # If display is off, any button press will go back to the top menu and turn on the display
-        if not self._view.is_display_on():
-            self.display_on()
-            if self.current_menu.get_menu_name() != MenuName.top:
-                self.current_menu = TopMenu(self)
-                self.current_menu.update_display()
-
+    def button_event(self, btn: int, event: ButtonEvent):
+        """ Runs on the button dispatch thread, never on the pigpio callback thread. """
+        if event == ButtonEvent.press:
+            logger.debug('Button %s pressed...', btn)
+            self.history.append(EventType.button_press, source=btn)
+            self.wake_button = None
+            self.combo_handled = False
+            # If display is off, any button press will go back to the top menu and turn on the display
+            if not self._view.is_display_on():
+                self.wake_button = btn
+                self.display_on()
+                return
+        elif btn == self.wake_button:
+            # Still holding the button that woke up the display
             return
 
         # Display was already on, reset the idle timer
         self._view.display_idle_time_reset()
-        # Call the handler for the current menu
-        new_menu = self.current_menu.button_handler(btn)
+        if event != ButtonEvent.press and btn in PROFILE_BUTTON_COMBO and \
+                all(self.button_dispatcher.is_down(b) for b in PROFILE_BUTTON_COMBO):
+            if not self.combo_handled:
+                self.combo_handled = True
+                profiler.toggle()
+            return
+        if event == ButtonEvent.long_press and btn == 4 and self.current_menu is not self.top_menu:
+            # Holding Prev goes all the way back to the top menu
+            new_menu = self.top_menu.enter()
+        elif event == ButtonEvent.press or self.current_menu.handles_repeat:
+            # Call the handler for the current menu
+            new_menu = self.current_menu.button_handler(btn, event)
+        else:
+            return
         # if button action changed the menu, update the display with new menu
-        print(f'current_menu name = {self.current_menu.get_menu_name().value}')
-        print(f'new_menu_name = {new_menu.get_menu_name().value}')
+        logger.debug('current_menu name = %s, new_menu_name = %s', self.current_menu.label, new_menu.label)
 
         # If the menu changed, record it as the current and update the display to reflect the new menu
-        if new_menu.get_menu_name() != self.current_menu.get_menu_name():
+        if new_menu is not self.current_menu:
             self.current_menu = new_menu
             self.current_menu.update_display()
 
     def shutdown(self):
+        self.button_dispatcher.stop()
+        logger.info('Button timing: %s', self.button_dispatcher.timing_summary())
         self.dimmer.shutdown()
+        self.journal.close()
+        self.history.close()
+
+    def add_state_listener(self, listener: Callable[[], None]):
+        self.state_listeners.append(listener)
+
+    def notify_state_change(self):
+        for listener in self.state_listeners:
+            listener()
+
+    def level_changed(self, level: int):
+        self.notify_state_change()
+
+    def set_running(self, running: bool):
+        changed = running != self.is_running
+        self.is_running = running
+        sunrise_running.set(1 if running else 0)
+        if changed:
+            self.notify_state_change()
+
+    def set_status(self, status: str):
+        """ Sets the status line shown on the top menu, e.g., when the next sunrise is. """
+        if status != self.disp_thread.status:
+            self.disp_thread.status = status
+            self.notify_state_change()
+
+    def submit(self, fn, *args) -> Future:
+        """ Runs fn(*args) on the button dispatch thread, one at a time along with button presses. """
+        return self.button_dispatcher.submit(fn, *args)
+
+    def on_dispatcher(self) -> bool:
+        """
+        Whether controller state can be changed from this thread.  Everything that changes it (buttons, the API,
+        sync, ramp steps and the sunrise start) runs on the button dispatch thread, so none of it needs a lock.
+        Until the dispatcher is started, and in the simulator where it never is, the one calling thread owns it.
+        """
+        return threading.current_thread() is self.button_dispatcher or not self.button_dispatcher.is_alive()
+
+    def get_status(self) -> Dict[str, Any]:
+        """ Snapshot of the controller state, safe to call from any thread. """
+        status = {
+            'lamp_level': int(self.dimmer.get_level()),
+            'lamp_max_level': self.dimmer.get_max_level(),
+            'lamp_on': self.dimmer.is_on(),
+            'running': self.is_running,
+            'status': self.disp_thread.status if self.disp_thread else '',
+            'menu': self.current_menu.label,
+        }
+        if self.is_running:
+            status['running_start'] = self.running_start_time.isoformat(timespec='seconds')
+            status['running_duration_minutes'] = self.running_duration_minutes
+        return status
+
+    def refresh_top_menu(self):
+        """ Updates the top menu on/off label after the lamp was changed by something other than the buttons. """
+        if self.disp_thread and self.current_menu is self.top_menu:
+            self.current_menu.update_display()
+
+    def set_lamp(self, on: bool):
+        if self.is_running:
+            self.cancel_running_schedule()
+        if on:
+            self.dimmer.turn_on()
+        else:
+            self.dimmer.turn_off()
+        self.refresh_top_menu()
+
+    def set_lamp_level(self, level: int):
+        if self.is_running:
+            self.cancel_running_schedule()
+        self.dimmer.enable()
+        self.dimmer.set_level(level)
+        self.refresh_top_menu()
+
+    def change_brightness(self, percent: int):
+        """ Positive percent brightens, negative dims. """
+        if self.is_running:
+            self.cancel_running_schedule()
+        if percent >= 0:
+            self.dimmer.increase_brightness_by_percent(percent)
+        else:
+            self.dimmer.decrease_brightness_by_percent(-percent)
+        self.refresh_top_menu()
+
+    def update_settings(self, changes: Dict[str, Any]):
+        """ Applies a partial settings change, saves it and reschedules.  Raises ValueError if invalid. """
+        self.data.update_settings(changes)
+        if self.tracer:
+            self.tracer.record_settings_change(changes)
+        self.data.save_settings()
+        self.history.append(EventType.schedule_change)
+        if 'auto_off_minutes' in changes and self.disp_thread:
+            self.disp_thread.update_auto_off(self.settings.auto_off_minutes)
+        self.handle_schedule_change()
 
     def update_status(self):
         status_str = "No sunrise scheduled"
         if self.is_running:
-            now = dt.datetime.now()
+            now = self.clock.now()
             elapsed_minutes = (now - self.running_start_time).total_seconds() / 60
             remain_minutes = self.running_duration_minutes - elapsed_minutes
             if elapsed_minutes == 0:
@@ -563,24 +737,60 @@ class SunriseController:
                 pass
 
 
+@dataclass(frozen=True)
+class MenuSpec:
+    """
+    Declarative description of one node of the menu tree.  The whole tree (MENU_TREE) is built into Menu objects
+    once at startup and the same objects are reused for every navigation.
+    """
+    name: MenuName
+    menu_class: type
+    children: tuple = ()
+    # Day of week whose settings the menu edits
+    day: int = MONDAY
+    # Name shown in the hierarchy line, defaults to the menu name
+    label: str | None = None
+    # Name shown when this menu is an item in its parent's list, defaults to the menu name
+    item_label: str | None = None
+
+
 class Menu(ABC):
-    def __init__(self, controller: SunriseController, menu_name: MenuName, previous_menu: Self = None):
+    # Menus that want long-press and auto-repeat events in addition to presses
+    handles_repeat: bool = False
+    # Every menu is built once and lives as long as the process, slots keep each one small.  Subclasses list their own.
+    __slots__ = ('controller', 'spec', 'menu_name', 'label', 'previous_menu', 'children', 'day_of_week',
+                 'hierarchy_line', 'button_actions')
+
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: 'Menu | None' = None):
         self.controller = controller
-        self.menu_name = menu_name
-        self.previous_menu: Self = previous_menu
+        self.spec = spec
+        self.menu_name = spec.name
+        self.label: str = spec.label or spec.name.value
+        self.previous_menu: Menu | None = previous_menu
+        self.children: List[Menu] = []
+        self.day_of_week: int = spec.day
+        # Rendered once, the position of a menu in the tree never changes
+        self.hierarchy_line: str | None = get_hierarchical_menu_string(self)
+        # Button number -> handler, button numbers start at 1
+        self.button_actions: tuple = (None, self.button1, self.button2, self.button3, self.button4)
 
     def get_menu_name(self) -> MenuName:
         return self.menu_name
 
-    def start_duration_menu_factory(self, menu_type, day=MONDAY) -> Self:
-        match menu_type:
-            case MenuName.set_start:
-                return ScheduleSunriseStart(self.controller, self, day)
-            case MenuName.set_duration:
-                return ScheduleSunriseDuration(self.controller, self, day)
+    def back(self) -> 'Menu':
+        """ The menu to go back to.  Only the top menu has no previous menu and it never goes back. """
+        return self.previous_menu or self
 
-        print(f'ERROR: {self.__class__.__name__} Unhandled menu type={menu_type}, returning to top menu')
-        return TopMenu(self.controller)
+    def add_child(self, child: 'Menu'):
+        self.children.append(child)
+
+    def enter(self) -> 'Menu':
+        """ Called when navigating down into this menu.  Menus are reused, so per-visit state is reset here. """
+        self.reset()
+        return self
+
+    def button_handler(self, btn: int, event: ButtonEvent = ButtonEvent.press) -> 'Menu':
+        return self.button_actions[btn](event)
 
     @abstractmethod
     def reset(self):
@@ -591,51 +801,71 @@ class Menu(ABC):
         pass
 
     @abstractmethod
-    def button_handler(self, btn: int) -> Self:
+    def button1(self, event: ButtonEvent) -> 'Menu':
+        pass
+
+    @abstractmethod
+    def button2(self, event: ButtonEvent) -> 'Menu':
         pass
 
+    @abstractmethod
+    def button3(self, event: ButtonEvent) -> 'Menu':
+        pass
 
-def get_hierarchical_menu_string(current_menu: Menu, current_menu_name: str = None) -> str | None:
+    @abstractmethod
+    def button4(self, event: ButtonEvent) -> 'Menu':
+        pass
+
+
+def get_hierarchical_menu_string(current_menu: Menu) -> str | None:
     """
-    Returns back a string representing the current menu and its hierarchy. If current_menu_name is provided, it
-    will be used instead of pulling the name from the current_menu subclass.
+    Returns back a string representing the current menu and its hierarchy.
     E.g., Schedule->Weekday
     :param current_menu: The current Menu subclass.
-    :param current_menu_name: If provided, use this name for the current menu
     :return: string with hierarchy up to and including the current menu.
     """
 
-    # Don't put in anything for the main menu
-    if current_menu.get_menu_name() == MenuName.main:
+    # Don't put in anything for the top and main menus
+    if current_menu.get_menu_name() in (MenuName.top, MenuName.main):
         return None
 
     # Recurse back to root item to get all the previous menus except Top and Main
-    # If a current_menu_name is provided, use it instead of the name from the menu class
-    if current_menu_name:
-        menu_string = current_menu_name
-    else:
-        menu_string = current_menu.get_menu_name().value
+    menu_string = current_menu.label
     menu = current_menu.previous_menu
     while menu and (menu.menu_name != MenuName.top) and (menu.menu_name != MenuName.main):
-        menu_string = menu.get_menu_name().value + '->' + menu_string
+        menu_string = menu.label + '->' + menu_string
         menu = menu.previous_menu
     return menu_string
 
 
+def build_menu(controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None) -> Menu:
+    """ Creates the menu described by spec along with all of its sub-menus. """
+    menu = spec.menu_class(controller, spec, previous_menu)
+    for child_spec in spec.children:
+        menu.add_child(build_menu(controller, child_spec, menu))
+    return menu
+
+
+TOP_LAMP_ON_LABEL = 'Menu  Dim-  Dim+  On'
+TOP_LAMP_OFF_LABEL = 'Menu  Dim-  Dim+  Off'
+
+
 class TopMenu(Menu):
-    def __init__(self, controller):
-        super().__init__(controller, MenuName.top)
-        self.menu_line3 = ''
-        self.menu_line4 = ''
+    handles_repeat = True
+    __slots__ = ('menu_line4',)
 
-        self.reset()
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
+        self.menu_line4 = TOP_LAMP_ON_LABEL
+        self.update_menu_line4()
 
     def reset(self):
-        self.menu_line4 = ''
+        # Leaving the calibration menu without saving leaves the lamp at the duty cycle that was being set
+        self.controller.dimmer.restore_level()
         self.update_menu_line4()
 
     def update_display(self):
-        print('TopMenu:update_display()')
+        logger.debug('TopMenu:update_display()')
         self.update_menu_line4()
         self.controller.disp_thread.line2 = None
         self.controller.disp_thread.line4 = self.menu_line4
@@ -643,330 +873,116 @@ class TopMenu(Menu):
         self.controller.disp_thread.scroll = True
         self.controller.disp_thread.update_display()
 
-    def button_handler(self, btn: int) -> Menu:
-        if btn == 1:
-            self.controller.disp_thread.disable_status()
-            return MainMenu(self.controller, self)
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Menu
+        if event != ButtonEvent.press:
+            return self
+        self.controller.disp_thread.disable_status()
+        return self.children[0].enter()
 
-        # Other buttons cancel a running schedule
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Dim-, also cancels a running schedule
         if self.controller.is_running:
             self.controller.cancel_running_schedule()
-            # Display should now be off so don't take action if On/Off button pushed
-            if btn == 4:
-                self.update_display()
-                return self
 
         dimmer_prev_on: bool = self.controller.dimmer.is_on()
-
-        # Handle other button actions
-        match btn:
-            case 2:
-                self.controller.dimmer.decrease_brightness_by_percent(BRIGHTNESS_CHANGE_PERCENT)
-                dimmer_curr_on = self.controller.dimmer.is_on()
-                # Update display if dimmer now off
-                if dimmer_prev_on and not dimmer_curr_on:
-                    self.controller.disp_thread.update_line4_display('Menu  Dim-  Dim+  On')
-            case 3:
-                self.controller.dimmer.increase_brightness_by_percent(BRIGHTNESS_CHANGE_PERCENT)
-                # Update display if it was off previously
-                if not dimmer_prev_on:
-                    self.controller.disp_thread.update_line4_display('Menu  Dim-  Dim+  Off')
-            case 4:
-                line4 = 'Menu  Dim-  Dim+  On'
-                if self.controller.dimmer.get_level():
-                    print('Turning Lamp OFF')
-                    self.controller.dimmer.turn_off()
-                else:
-                    print('Turning Lamp ON')
-                    line4 = 'Menu  Dim-  Dim+  Off'
-                    self.controller.dimmer.turn_on()
-                self.controller.disp_thread.update_line4_display(line4)
-            case _:
-                print("Invalid button number")
-
+        self.controller.dimmer.decrease_brightness_by_percent(BRIGHTNESS_CHANGE_PERCENT)
+        # Update display if dimmer now off
+        if dimmer_prev_on and not self.controller.dimmer.is_on():
+            self.controller.disp_thread.update_line4_display(TOP_LAMP_ON_LABEL)
         return self
 
-    def update_menu_line4(self):
-        print(f'TopMenu:update_menu_line4() - level={self.controller.dimmer.get_level()}')
-        if self.controller.dimmer.get_level():
-            self.menu_line4 = 'Menu  Dim-  Dim+  Off'
-        else:
-            self.menu_line4 = 'Menu  Dim-  Dim+  On'
-
-
-class MainMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.main, prev_menu)
-
-        self.menu_idx: int = 0
-        self.menus = [MenuName.schedule, MenuName.enable, MenuName.display_timer,
-                      MenuName.set_date, MenuName.network]
-        self.menu_line4 = DEFAULT_BUTTON_LABEL
-
-    def reset(self) -> Dict[Any, Any]:
-        pass
-
-    def update_display(self):
-        print('MainMenu:update_display()')
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(self.menus[self.menu_idx].value)
-        self.controller.disp_thread.line4 = self.menu_line4
-        self.controller.disp_thread.update_display()
-
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Select button pressed, go to new menu
-                return self.new_menu_factory(self.menus[self.menu_idx])
-            case 2:
-                # Left arrow
-                self.menu_idx = (self.menu_idx - 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(self.menus[self.menu_idx].value))
-            case 3:
-                # Right arrow
-                self.menu_idx = (self.menu_idx + 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(self.menus[self.menu_idx].value))
-                pass
-            case 4:
-                # Previous
-                return self.previous_menu
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Dim+, also cancels a running schedule
+        if self.controller.is_running:
+            self.controller.cancel_running_schedule()
 
+        dimmer_prev_on: bool = self.controller.dimmer.is_on()
+        self.controller.dimmer.increase_brightness_by_percent(BRIGHTNESS_CHANGE_PERCENT)
+        # Update display if it was off previously
+        if not dimmer_prev_on:
+            self.controller.disp_thread.update_line4_display(TOP_LAMP_OFF_LABEL)
         return self
 
-    def new_menu_factory(self, menu_type) -> Menu:
-        match menu_type:
-            case MenuName.schedule:
-                return ScheduleMenu(self.controller, self)
-            case MenuName.enable:
-                return EnableMenu(self.controller, self)
-            case MenuName.display_timer:
-                return SetDisplayOffTimeMenu(self.controller, self)
-            case MenuName.set_date:
-                return SetDateMenu(self.controller, self)
-            case MenuName.network:
-                return NetworkMenu(self.controller, self)
-
-        print('ERROR: MainMenu Unhandled menu type, returning to top menu')
-        return TopMenu(self.controller)
-
-
-class ScheduleMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.schedule, prev_menu)
-        self.menu_idx = 0
-        self.menus = [MenuName.set_weekday, MenuName.set_weekend, MenuName.set_daily]
-        self.menu_line4 = DEFAULT_BUTTON_LABEL
-
-        self.set_start_time = False
-        self.start_time: dt = dt.datetime.now()
-        self.set_duration = False
-        self.duration: dt.timedelta = dt.timedelta(0)
-
-    def reset(self):
-        pass
+    def button4(self, event: ButtonEvent) -> Menu:
+        # On/Off
+        if event != ButtonEvent.press:
+            return self
 
-    def update_display(self):
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(self.menus[self.menu_idx].value)
-        self.controller.disp_thread.line4 = self.menu_line4
-        self.controller.disp_thread.update_display()
+        if self.controller.is_running:
+            self.controller.cancel_running_schedule()
+            # Dimmer is now off so don't take action for the On/Off button
+            self.update_display()
+            return self
 
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Select button pressed, go to new menu
-                return self.new_menu_factory(self.menus[self.menu_idx])
-            case 2:
-                # Left
-                self.menu_idx = (self.menu_idx - 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(self.menus[self.menu_idx].value))
-            case 3:
-                # Right
-                self.menu_idx = (self.menu_idx + 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(self.menus[self.menu_idx].value))
-            case 4:
-                # Prev
-                return self.previous_menu
+        if self.controller.dimmer.get_level():
+            logger.info('Turning Lamp OFF')
+            self.controller.dimmer.turn_off()
+            line4 = TOP_LAMP_ON_LABEL
+        else:
+            logger.info('Turning Lamp ON')
+            self.controller.dimmer.turn_on()
+            line4 = TOP_LAMP_OFF_LABEL
+        self.controller.disp_thread.update_line4_display(line4)
         return self
 
-    def new_menu_factory(self, menu_type) -> Menu:
-        match menu_type:
-            case MenuName.set_weekday:
-                return ScheduleWeekdayMenu(self.controller, self)
-            case MenuName.set_weekend:
-                return ScheduleWeekendMenu(self.controller, self)
-            case MenuName.set_daily:
-                return ScheduleDailyMenu(self.controller, self)
+    def update_menu_line4(self):
+        logger.debug('TopMenu:update_menu_line4() - level=%s', self.controller.dimmer.get_level())
+        if self.controller.dimmer.get_level():
+            self.menu_line4 = TOP_LAMP_OFF_LABEL
+        else:
+            self.menu_line4 = TOP_LAMP_ON_LABEL
 
-        print('ERROR: ScheduleMenu Unhandled menu type, returning to top menu')
-        return TopMenu(self.controller)
 
+class ListMenu(Menu):
+    """ Menu that scrolls through its sub-menus with the arrow buttons and enters one with select. """
+    __slots__ = ('menu_idx', 'item_lines', 'menu_line4')
 
-class ScheduleWeekdayMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.set_weekday, prev_menu)
-        self.menu_idx = 0
-        self.menus = [MenuName.set_start, MenuName.set_duration]
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
+        self.menu_idx: int = 0
+        self.item_lines: List[str] = []
         self.menu_line4 = DEFAULT_BUTTON_LABEL
 
-    def reset(self):
-        pass
-
-    def update_display(self):
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(self.menus[self.menu_idx].value)
-        self.controller.disp_thread.line4 = self.menu_line4
-        self.controller.disp_thread.update_display()
-
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Select button pressed, go to new menu
-                return self.start_duration_menu_factory(self.menus[self.menu_idx])
-            case 2:
-                # Left
-                self.menu_idx = (self.menu_idx - 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(self.menus[self.menu_idx].value))
-            case 3:
-                # Right
-                self.menu_idx = (self.menu_idx + 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(self.menus[self.menu_idx].value))
-            case 4:
-                # Prev
-                return self.previous_menu
-
-        return self
-
-
-class ScheduleWeekendMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.set_weekend, prev_menu)
-        self.menu_idx = 0
-        self.menus = [MenuName.set_start, MenuName.set_duration]
-        self.menu_line4 = DEFAULT_BUTTON_LABEL
+    def add_child(self, child: Menu):
+        super().add_child(child)
+        self.item_lines.append(self.controller.center_line(child.spec.item_label or child.label))
 
     def reset(self):
-        pass
-
-    def update_display(self):
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(self.menus[self.menu_idx].value)
-        self.controller.disp_thread.line4 = self.menu_line4
-        self.controller.disp_thread.update_display()
-
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Select button pressed, go to new menu
-                return self.start_duration_menu_factory(self.menus[self.menu_idx])
-            case 2:
-                # Left
-                self.menu_idx = (self.menu_idx - 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(self.menus[self.menu_idx].value))
-            case 3:
-                # Right
-                self.menu_idx = (self.menu_idx + 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(self.menus[self.menu_idx].value))
-            case 4:
-                # Prev
-                return self.previous_menu
-
-        return self
-
-
-class ScheduleDailyMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.set_daily, prev_menu)
         self.menu_idx = 0
-        self.menus = [MenuName.monday, MenuName.tuesday, MenuName.wednesday, MenuName.thursday, MenuName.friday,
-                      MenuName.saturday, MenuName.sunday]
-        self.menu_line4 = DEFAULT_BUTTON_LABEL
-
-    def get_day_of_week(self) -> int:
-        return self.menu_idx
-
-    def reset(self):
-        pass
 
     def update_display(self):
-        print('ScheduleDailyMenu:update_display()')
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
-        self.controller.disp_thread.line3 = cself.controller.disp_thread.center_line(alendar.day_name[self.menu_idx])
+        logger.debug('%s:update_display()', self.label)
+        self.controller.disp_thread.line2 = self.hierarchy_line
+        self.controller.disp_thread.line3 = self.item_lines[self.menu_idx]
         self.controller.disp_thread.line4 = self.menu_line4
         self.controller.disp_thread.update_display()
 
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Select button pressed, go to new menu
-                return DayOfWeek(self.controller, self, self.menu_idx)
-            case 2:
-                # Left
-                self.menu_idx = (self.menu_idx - 1) % len(calendar.day_name)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(calendar.day_name[self.menu_idx]))
-            case 3:
-                # Right
-                self.menu_idx = (self.menu_idx + 1) % len(calendar.day_name)
-                self.controller.disp_thread.update_line3_display(
-                    self.controller.disp_thread.center_line(calendar.day_name[self.menu_idx]))
-            case 4:
-                # Prev
-                return self.previous_menu
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Select button pressed, go to new menu
+        return self.children[self.menu_idx].enter()
 
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Left arrow
+        self.menu_idx = (self.menu_idx - 1) % len(self.children)
+        self.controller.disp_thread.update_line3_display(self.item_lines[self.menu_idx])
         return self
 
-
-class DayOfWeek(Menu):
-    def __init__(self, controller, prev_menu, day):
-        super().__init__(controller, MenuName.day_of_week, prev_menu)
-        self.day = day
-        self.menu_idx = 0
-        self.menus = [MenuName.set_start, MenuName.set_duration]
-        self.menu_line4 = DEFAULT_BUTTON_LABEL
-
-    def reset(self):
-        pass
-
-    def update_display(self):
-        print('DayOfWeek:update_display()')
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self, calendar.day_abbr[self.day])
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(self.menus[self.menu_idx].value)
-        self.controller.disp_thread.line4 = self.menu_line4
-        self.controller.disp_thread.update_display()
-
-    def button_handler(self, btn: int) -> Self:
-        match btn:
-            case 1:
-                # Select button pressed, go to new menu
-                return self.start_duration_menu_factory(self.menus[self.menu_idx], self.day)
-            case 2:
-                # Left
-                self.menu_idx = (self.menu_idx - 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(self.menus[self.menu_idx].value)
-            case 3:
-                # Right
-                self.menu_idx = (self.menu_idx + 1) % len(self.menus)
-                self.controller.disp_thread.update_line3_display(self.menus[self.menu_idx].value)
-            case 4:
-                # Prev
-                return self.previous_menu
-
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Right arrow
+        self.menu_idx = (self.menu_idx + 1) % len(self.children)
+        self.controller.disp_thread.update_line3_display(self.item_lines[self.menu_idx])
         return self
 
+    def button4(self, event: ButtonEvent) -> Menu:
+        # Previous
+        return self.back()
+
 
 def create_12hour_clock_display(hour: int, minute: int, is_pm: bool, field_idx: int) -> str:
     am_pm: str = 'AM'
     if is_pm:
-        am_pm: str = "PM"
+        am_pm = "PM"
 
     match field_idx:
         case 0:
@@ -976,40 +992,39 @@ def create_12hour_clock_display(hour: int, minute: int, is_pm: bool, field_idx:
         case 2:
             return f'     {hour:02d}:{minute:02d} [{am_pm}]'
 
-    print(f'Error - select_new_clock_field() invalid field index = {field_idx}')
+    logger.error('create_12hour_clock_display() invalid field index = %s', field_idx)
     return f'ERROR:Bad field index'
 
 
 class ScheduleSunriseStart(Menu):
-    def __init__(self, controller, prev_menu, day_of_week: int):
-        super().__init__(controller, MenuName.set_start, prev_menu)
-        self.day_of_week: int = day_of_week
+    handles_repeat = True
+    __slots__ = ('clock_field_idx', 'num_clock_fields', 'is_pm', 'hour', 'minute', 'menu_line4')
+
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
         # The clock field index indicates which clock field is being set
         self.clock_field_idx = 0
         self.num_clock_fields = 3
         self.is_pm: bool = False
         self.hour = 12
         self.minute = 0
-        self.menu_line4 = 'Select   -   +   Save'
-        self.load_previous_clock()
+        self.menu_line4 = TIME_SET_BUTTON_LABEL
 
     def load_previous_clock(self):
         """
         Loads the previous clock setting and updates the display with its value
         :return: None
         """
-        print(f'Saved start time: {self.controller.settings.start_time[self.day_of_week]}')
+        logger.debug('Saved start time: %s', self.controller.settings.start_time[self.day_of_week])
         start_time_str = self.controller.settings.start_time[self.day_of_week]
         start_time = dt.datetime.strptime(start_time_str, '%H:%M')
-        if start_time.hour > 12:
-            self.is_pm = True
-            self.hour = start_time.hour - 12
-        else:
-            self.hour = start_time.hour
+        self.is_pm = start_time.hour >= 12
+        self.hour = start_time.hour % 12 or 12
         self.minute = start_time.minute
 
     def reset(self):
-        pass
+        self.clock_field_idx = 0
+        self.load_previous_clock()
 
     def update_display(self):
         self.controller.disp_thread.line3 = (
@@ -1018,111 +1033,124 @@ class ScheduleSunriseStart(Menu):
         self.controller.disp_thread.update_display()
 
     def save_schedule(self):
-        mil_hour = self.hour
-        if self.is_pm and (self.hour < 12):
-            mil_hour = self.hour + 12
-        parent_menu = self.previous_menu.get_menu_name()
+        mil_hour = self.hour % 12
+        if self.is_pm:
+            mil_hour = mil_hour + 12
+        parent_menu = self.back().get_menu_name()
         match parent_menu:
             case MenuName.set_weekday:
-                print('Saving new Weekday start time')
+                logger.info('Saving new Weekday start time')
                 for day in range(MONDAY, FRIDAY + 1):
                     self.controller.data.settings.start_time[day] = f'{mil_hour:02d}:{self.minute:02d}'
             case MenuName.set_weekend:
-                print('Saving new Weekend start time')
+                logger.info('Saving new Weekend start time')
                 for day in range(SATURDAY, SUNDAY + 1):
                     self.controller.data.settings.start_time[day] = f'{mil_hour:02d}:{self.minute:02d}'
             case MenuName.day_of_week:
-                print(f'Saving new Daily start time for {calendar.day_name[self.day_of_week]}')
+                logger.info('Saving new Daily start time for %s', calendar.day_name[self.day_of_week])
                 self.controller.data.settings.start_time[self.day_of_week] = f'{mil_hour:02d}:{self.minute:02d}'
             case _:
-                print(f'ERROR: ScheduleSunriseStart:save_schedule() - invalid parent menu: {parent_menu}')
+                logger.error('ScheduleSunriseStart:save_schedule() - invalid parent menu: %s', parent_menu)
 
         self.controller.data.save_settings()
+        self.controller.history.append(EventType.schedule_change)
         self.controller.handle_schedule_change()
 
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Select - Move to next clock field
-                self.clock_field_idx = (self.clock_field_idx + 1) % self.num_clock_fields
-                self.update_display()
-            case 2 | 3:
-                # Up/Down
-                increment = 1
-                if btn == 2:
-                    increment = -1
-
-                match self.clock_field_idx:
-                    case 0:
-                        self.hour = (self.hour + increment) % 13
-                        if self.hour == 0:
-                            if increment > 0:
-                                self.hour = 1
-                            else:
-                                self.hour = 12
-                    case 1:
-                        self.minute = (self.minute + increment) % 60
-                    case 2:
-                        self.is_pm = not self.is_pm
-                self.update_display()
-            case 4:
-                # Save
-                self.save_schedule()
-                return self.previous_menu
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Select - Move to next clock field
+        if event == ButtonEvent.press:
+            self.clock_field_idx = (self.clock_field_idx + 1) % self.num_clock_fields
+            self.update_display()
+        return self
 
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Down
+        return self.change_clock_field(-1)
+
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Up
+        return self.change_clock_field(1)
+
+    def button4(self, event: ButtonEvent) -> Menu:
+        # Save
+        if event != ButtonEvent.press:
+            return self
+        self.save_schedule()
+        return self.back()
+
+    def change_clock_field(self, increment: int) -> Menu:
+        match self.clock_field_idx:
+            case 0:
+                self.hour = (self.hour + increment) % 13
+                if self.hour == 0:
+                    if increment > 0:
+                        self.hour = 1
+                    else:
+                        self.hour = 12
+            case 1:
+                self.minute = (self.minute + increment) % 60
+            case 2:
+                self.is_pm = not self.is_pm
+        self.update_display()
         return self
 
 
 class ScheduleSunriseDuration(Menu):
-    def __init__(self, controller, prev_menu, day_of_week: int):
-        super().__init__(controller, MenuName.set_duration, prev_menu)
-        self.day_of_week: int = day_of_week
+    handles_repeat = True
+    __slots__ = ('duration_minutes', 'is_pre_select', 'pre_select_idx', 'pre_select_menu', 'duration_lines',
+                 'menu_line4')
+
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
         self.is_pre_select: bool = False
         self.pre_select_idx = 1
         self.pre_select_menu = [15, 30, 60, 90]
         self.duration_minutes = 60
         self.menu_line4 = 'Preset   -   +   Save'
-        self.load_previous_duration()
+        self.duration_lines = [self.controller.center_line(str(minutes)) for minutes in range(MAX_DURATION_MINUTES + 1)]
 
     def reset(self):
-        pass
+        self.is_pre_select = False
+        self.load_previous_duration()
 
     def update_display(self):
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(self.duration_minutes)
+        self.controller.disp_thread.line3 = self.duration_lines[self.duration_minutes]
         self.controller.disp_thread.line4 = self.menu_line4
         self.controller.disp_thread.update_display()
 
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Pre-select
-                if self.is_pre_select:
-                    self.pre_select_idx = (self.pre_select_idx + 1) % len(self.pre_select_menu)
-                else:
-                    self.pre_select_idx = 0
-
-                self.is_pre_select = True
-                self.duration_minutes = self.pre_select_menu[self.pre_select_idx]
-                self.update_display()
-            case 2 | 3:
-                # Down/Up
-                self.is_pre_select = False
-                increment = 1
-                if btn == 2:
-                    increment = -1
-
-                self.duration_minutes = self.duration_minutes + increment
-
-                if self.duration_minutes < 0:
-                    self.duration_minutes = 0
-                if self.duration_minutes > 90:
-                    self.duration_minutes = 90
-                self.update_display()
-            case 4:
-                # Save
-                self.save_duration()
-                return self.previous_menu
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Pre-select
+        if event != ButtonEvent.press:
+            return self
+        if self.is_pre_select:
+            self.pre_select_idx = (self.pre_select_idx + 1) % len(self.pre_select_menu)
+        else:
+            self.pre_select_idx = 0
+
+        self.is_pre_select = True
+        self.duration_minutes = self.pre_select_menu[self.pre_select_idx]
+        self.update_display()
+        return self
 
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Down
+        return self.change_duration(-1)
+
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Up
+        return self.change_duration(1)
+
+    def button4(self, event: ButtonEvent) -> Menu:
+        # Save
+        if event != ButtonEvent.press:
+            return self
+        self.save_duration()
+        return self.back()
+
+    def change_duration(self, increment: int) -> Menu:
+        self.is_pre_select = False
+        self.duration_minutes = min(max(self.duration_minutes + increment, 1), MAX_DURATION_MINUTES)
+        self.update_display()
         return self
 
     def load_previous_duration(self):
@@ -1133,172 +1161,152 @@ class ScheduleSunriseDuration(Menu):
         self.duration_minutes = self.controller.settings.duration_minutes[self.day_of_week]
 
     def save_duration(self):
-        parent_menu = self.previous_menu.get_menu_name()
+        parent_menu = self.back().get_menu_name()
         match parent_menu:
             case MenuName.set_weekday:
-                print('Saving new Weekday start time')
+                logger.info('Saving new Weekday duration')
                 for day in range(MONDAY, FRIDAY + 1):
                     self.controller.data.settings.duration_minutes[day] = self.duration_minutes
             case MenuName.set_weekend:
-                print('Saving new Weekend start time')
+                logger.info('Saving new Weekend duration')
                 for day in range(SATURDAY, SUNDAY + 1):
                     self.controller.data.settings.duration_minutes[day] = self.duration_minutes
             case MenuName.day_of_week:
-                print(f'Saving new Daily start time for {calendar.day_name[self.day_of_week]}')
+                logger.info('Saving new Daily duration for %s', calendar.day_name[self.day_of_week])
                 self.controller.data.settings.duration_minutes[self.day_of_week] = self.duration_minutes
             case _:
-                print(f'ERROR: ScheduleSunriseDuration:save_duration() - invalid parent menu: {parent_menu}')
+                logger.error('ScheduleSunriseDuration:save_duration() - invalid parent menu: %s', parent_menu)
 
         self.controller.data.save_settings()
+        self.controller.history.append(EventType.schedule_change)
         self.controller.handle_schedule_change()
 
 
 class EnableMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.enable, prev_menu)
-        self.weekend_enable_str_idx = 1
-        self.weekday_enable_str_idx = 13
-        self.daily_enable_str_idx = 25
+    __slots__ = ('ec', 'el', 'menu_line4')
+
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
         self.ec = [False, False, False]
         self.el = ['Off', 'Off', 'Off']
-        # self.menu_line3 = 'Weekday  Weekend  Day'
-        self.menu_line3 = '[Run] [Off] [Off]'
         self.menu_line4 = 'Wkdy  Wknd  Day  Save'
-        self.load_previous_enable()
 
     def reset(self):
-        pass
+        self.load_previous_enable()
 
     def update_display(self):
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
+        self.controller.disp_thread.line2 = self.hierarchy_line
         self.controller.disp_thread.line3 = f'{self.el[0]}   {self.el[1]}   {self.el[2]}'
         self.controller.disp_thread.line4 = self.menu_line4
         self.controller.disp_thread.update_display()
 
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Enable/Disable Weekday
-                if self.ec[0]:
-                    # Running, toggle to off
-                    self.ec[0] = False
-                    self.el[0] = 'Off'
-                else:
-                    # Off, toggle to running
-                    self.ec[0] = True
-                    self.el[0] = 'Run'
-                    if self.ec[2]:
-                        self.ec[2] = False
-                        self.el[2] = 'Off'
-                self.update_display()
-            case 2:
-                # Enable/Disable Weekend
-                if self.ec[1]:
-                    # Running, toggle to off
-                    self.ec[1] = False
-                    self.el[1] = 'Off'
-                else:
-                    # Off, toggle to running
-                    self.ec[1] = True
-                    self.el[1] = 'Run'
-                    if self.ec[2]:
-                        self.ec[2] = False
-                        self.el[2] = 'Off'
-                self.update_display()
-            case 3:
-                # Enable/Disable Daily
-                if self.ec[2]:
-                    # Running, toggle to off
-                    self.ec[2] = False
-                    self.el[2] = 'Off'
-                else:
-                    # Off, toggle to running
-                    self.ec[2] = True
-                    self.el[2] = 'Run'
-                    if self.ec[0]:
-                        self.ec[0] = False
-                        self.el[0] = 'Off'
-                    if self.ec[1]:
-                        self.ec[1] = False
-                        self.el[1] = 'Off'
-                self.update_display()
-            case 4:
-                # Save
-                self.save_enable()
-                return self.previous_menu
+    def set_enable(self, idx: int, enable: bool):
+        self.ec[idx] = enable
+        self.el[idx] = 'Run' if enable else 'Off'
 
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Enable/Disable Weekday, daily can't run along with it
+        self.set_enable(0, not self.ec[0])
+        if self.ec[0]:
+            self.set_enable(2, False)
+        self.update_display()
         return self
 
-    def load_previous_enable(self):
-        self.ec[0] = self.controller.data.settings.weekday_sched_enabled
-        if self.ec[0]:
-            self.el[0] = "Run"
-        self.ec[1] = self.controller.data.settings.weekend_sched_enabled
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Enable/Disable Weekend, daily can't run along with it
+        self.set_enable(1, not self.ec[1])
         if self.ec[1]:
-            self.el[1] = "Run"
-        self.ec[2] = self.controller.data.settings.daily_sched_enabled
+            self.set_enable(2, False)
+        self.update_display()
+        return self
+
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Enable/Disable Daily, weekday and weekend can't run along with it
+        self.set_enable(2, not self.ec[2])
         if self.ec[2]:
-            self.el[2] = "Run"
+            self.set_enable(0, False)
+            self.set_enable(1, False)
+        self.update_display()
+        return self
+
+    def button4(self, event: ButtonEvent) -> Menu:
+        # Save
+        self.save_enable()
+        return self.back()
+
+    def load_previous_enable(self):
+        self.set_enable(0, self.controller.data.settings.weekday_sched_enabled)
+        self.set_enable(1, self.controller.data.settings.weekend_sched_enabled)
+        self.set_enable(2, self.controller.data.settings.daily_sched_enabled)
 
     def save_enable(self):
         self.controller.data.settings.weekday_sched_enabled = self.ec[0]
         self.controller.data.settings.weekend_sched_enabled = self.ec[1]
         self.controller.data.settings.daily_sched_enabled = self.ec[2]
         self.controller.data.save_settings()
+        self.controller.history.append(EventType.schedule_change)
         self.controller.handle_schedule_change()
 
 
 class SetDisplayOffTimeMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.display_timer, prev_menu)
+    handles_repeat = True
+    __slots__ = ('auto_off_minutes', 'is_pre_select', 'pre_select_idx', 'pre_select_menu', 'auto_off_lines',
+                 'menu_line4')
+
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
         self.is_pre_select: bool = False
         self.pre_select_idx = 1
         self.pre_select_menu = [1, 3, 5, 7]
         self.auto_off_minutes = 3
         self.menu_line4 = 'Preset   -   +   Save'
-        self.load_auto_off()
+        self.auto_off_lines = [self.controller.center_line(str(minutes))
+                               for minutes in range(MAX_AUTO_OFF_MINUTES + 1)]
 
     def reset(self):
-        pass
+        self.is_pre_select = False
+        self.load_auto_off()
 
     def update_display(self):
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(str(self.auto_off_minutes))
+        self.controller.disp_thread.line2 = self.hierarchy_line
+        self.controller.disp_thread.line3 = self.auto_off_lines[self.auto_off_minutes]
         self.controller.disp_thread.line4 = self.menu_line4
         self.controller.disp_thread.update_display()
 
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Pre-select
-                if self.is_pre_select:
-                    self.pre_select_idx = (self.pre_select_idx + 1) % len(self.pre_select_menu)
-                else:
-                    self.pre_select_idx = 0
-
-                self.is_pre_select = True
-                self.auto_off_minutes = self.pre_select_menu[self.pre_select_idx]
-                self.update_display()
-            case 2 | 3:
-                # Down/Up
-                self.is_pre_select = False
-                increment = 1
-                if btn == 2:
-                    increment = -1
-
-                self.auto_off_minutes = self.auto_off_minutes + increment
-
-                if self.auto_off_minutes < 0:
-                    self.auto_off_minutes = 1
-                if self.auto_off_minutes > 10:
-                    self.auto_off_minutes = 10
-                self.update_display()
-            case 4:
-                # Save
-                self.save_auto_off()
-                self.controller.disp_thread.update_auto_off(self.auto_off_minutes)
-                return self.previous_menu
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Pre-select
+        if event != ButtonEvent.press:
+            return self
+        if self.is_pre_select:
+            self.pre_select_idx = (self.pre_select_idx + 1) % len(self.pre_select_menu)
+        else:
+            self.pre_select_idx = 0
 
+        self.is_pre_select = True
+        self.auto_off_minutes = self.pre_select_menu[self.pre_select_idx]
+        self.update_display()
+        return self
+
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Down
+        return self.change_auto_off(-1)
+
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Up
+        return self.change_auto_off(1)
+
+    def button4(self, event: ButtonEvent) -> Menu:
+        # Save
+        if event != ButtonEvent.press:
+            return self
+        self.save_auto_off()
+        self.controller.disp_thread.update_auto_off(self.auto_off_minutes)
+        return self.back()
+
+    def change_auto_off(self, increment: int) -> Menu:
+        self.is_pre_select = False
+        self.auto_off_minutes = min(max(self.auto_off_minutes + increment, 1), MAX_AUTO_OFF_MINUTES)
+        self.update_display()
         return self
 
     def load_auto_off(self):
@@ -1309,74 +1317,213 @@ class SetDisplayOffTimeMenu(Menu):
         self.auto_off_minutes = self.controller.settings.auto_off_minutes
 
     def save_auto_off(self):
-        print('Saving new auto-off minutes')
+        logger.info('Saving new auto-off minutes')
         self.controller.data.settings.auto_off_minutes = self.auto_off_minutes
         self.controller.data.save_settings()
 
 
-class SetDateMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.set_date, prev_menu)
-        self.menu_line3 = 'Not Implemented'
-        self.menu_line4 = DEFAULT_BUTTON_LABEL
-        self.current_sub_menu = ''
+def create_calibration_display(visible: int, saturated: int, field_idx: int) -> str:
+    if field_idx == 0:
+        return f'  On:[{visible:3d}]  Full: {saturated:3d}'
+    return f'  On: {visible:3d}   Full:[{saturated:3d}]'
+
+
+class DimmerCalibrationMenu(Menu):
+    """
+    Marks the duty cycle where the lamp first gives light and the one where it stops getting brighter.  The lamp shows
+    the duty cycle being set while it is adjusted.  Save applies the calibration to the dimmer levels, see dimmer.py.
+    Holding Next cancels.
+    """
+    handles_repeat = True
+    __slots__ = ('visible', 'saturated', 'field_idx', 'menu_line4')
+
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
+        self.visible = Dimmer.__min_duty_cycle__ + 1
+        self.saturated = Dimmer.__max_duty_cycle__
+        self.field_idx = 0
+        self.menu_line4 = 'Next    -    +   Save'
 
     def reset(self):
-        self.current_sub_menu = ''
+        # The lamp is needed to see the duty cycles, a running sunrise would keep changing it
+        if self.controller.is_running:
+            self.controller.cancel_running_schedule()
+        calibration = self.controller.dimmer.calibration
+        if calibration:
+            self.visible, self.saturated = calibration
+        else:
+            self.visible, self.saturated = Dimmer.__min_duty_cycle__ + 1, Dimmer.__max_duty_cycle__
+        self.field_idx = 0
+        self.show_duty_cycle()
 
     def update_display(self):
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(self.menu_line3)
-        self.controller.disp_thread.line4 = self.controller.disp_thread.center_line(self.menu_line4)
+        self.controller.disp_thread.line2 = self.hierarchy_line
+        self.controller.disp_thread.line3 = create_calibration_display(self.visible, self.saturated, self.field_idx)
+        self.controller.disp_thread.line4 = self.menu_line4
         self.controller.disp_thread.update_display()
 
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Select
-                pass
-            case 2:
-                # Left
-                pass
-            case 3:
-                # Right
-                pass
-            case 4:
-                # Prev
-                return self.previous_menu
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Next field, hold to cancel
+        if event == ButtonEvent.long_press:
+            return self.cancel()
+        if event != ButtonEvent.press:
+            return self
+        self.field_idx = (self.field_idx + 1) % 2
+        self.show_duty_cycle()
+        self.update_display()
+        return self
+
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Down
+        return self.change_duty_cycle(-1)
+
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Up
+        return self.change_duty_cycle(1)
+
+    def button4(self, event: ButtonEvent) -> Menu:
+        # Save
+        if event != ButtonEvent.press:
+            return self
+        logger.info('Saving new dimmer calibration')
+        self.controller.dimmer.turn_off()
+        self.controller.dimmer.calibrate(DimmerCalibration(self.visible, self.saturated))
+        return self.back()
+
+    def cancel(self) -> Menu:
+        """ Leaves without saving, the lamp goes back to the level it had before calibrating. """
+        logger.info('Dimmer calibration cancelled')
+        self.controller.dimmer.restore_level()
+        return self.back()
+
+    def change_duty_cycle(self, increment: int) -> Menu:
+        # The visible duty cycle always stays below the saturation duty cycle
+        if self.field_idx == 0:
+            self.visible = min(max(self.visible + increment, Dimmer.__min_duty_cycle__ + 1), self.saturated - 1)
+        else:
+            self.saturated = min(max(self.saturated + increment, self.visible + 1), Dimmer.__max_duty_cycle__)
+        self.show_duty_cycle()
+        self.controller.disp_thread.update_line3_display(
+            create_calibration_display(self.visible, self.saturated, self.field_idx))
+        return self
+
+    def show_duty_cycle(self):
+        self.controller.dimmer.write_duty_cycle(self.visible if self.field_idx == 0 else self.saturated)
+
 
+class NotImplementedMenu(Menu):
+    """ Placeholder for menus that don't do anything yet, only Prev works. """
+    __slots__ = ('menu_line3', 'menu_line4')
+
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
+        self.menu_line3 = self.controller.center_line('Not Implemented')
+        self.menu_line4 = self.controller.center_line(DEFAULT_BUTTON_LABEL)
+
+    def reset(self):
+        pass
+
+    def update_display(self):
+        self.controller.disp_thread.line2 = self.hierarchy_line
+        self.controller.disp_thread.line3 = self.menu_line3
+        self.controller.disp_thread.line4 = self.menu_line4
+        self.controller.disp_thread.update_display()
+
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Select
         return self
 
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Left
+        return self
+
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Right
+        return self
+
+    def button4(self, event: ButtonEvent) -> Menu:
+        # Prev
+        return self.back()
+
+
+class SetDateMenu(NotImplementedMenu):
+    __slots__ = ()
+
 
 class NetworkMenu(Menu):
-    def __init__(self, controller, prev_menu):
-        super().__init__(controller, MenuName.network, prev_menu)
-        self.menu_line3 = 'Not Implemented'
+    """ Shows how to reach the control API.  Left/right scroll through the address and usage counts. """
+    __slots__ = ('info_idx', 'info_lines', 'menu_line4')
+
+    def __init__(self, controller: SunriseController, spec: MenuSpec, previous_menu: Menu | None = None):
+        super().__init__(controller, spec, previous_menu)
+        self.info_idx = 0
+        self.info_lines: List[str] = []
         self.menu_line4 = DEFAULT_BUTTON_LABEL
-        self.current_sub_menu = ''
 
     def reset(self):
-        self.current_sub_menu = ''
+        self.info_idx = 0
+        self.load_info()
+
+    def load_info(self):
+        api = self.controller.api_server
+        if api is None:
+            self.info_lines = [self.controller.center_line('API not running')]
+            return
+        self.info_lines = [self.controller.center_line(api.address()),
+                           self.controller.center_line(f'{api.num_clients} clients connected'),
+                           self.controller.center_line(f'{api.num_requests} requests')]
 
     def update_display(self):
-        self.controller.disp_thread.line2 = get_hierarchical_menu_string(self)
-        self.controller.disp_thread.line3 = self.controller.disp_thread.center_line(self.menu_line3)
-        self.controller.disp_thread.line4 = self.controller.disp_thread.center_line(self.menu_line4)
+        self.controller.disp_thread.line2 = self.hierarchy_line
+        self.controller.disp_thread.line3 = self.info_lines[self.info_idx]
+        self.controller.disp_thread.line4 = self.menu_line4
         self.controller.disp_thread.update_display()
 
-    def button_handler(self, btn: int) -> Menu:
-        match btn:
-            case 1:
-                # Select
-                pass
-            case 2:
-                # Left
-                pass
-            case 3:
-                # Right
-                pass
-            case 4:
-                # Prev
-                return self.previous_menu
+    def button1(self, event: ButtonEvent) -> Menu:
+        # Select - refresh the counts
+        self.load_info()
+        self.update_display()
+        return self
+
+    def button2(self, event: ButtonEvent) -> Menu:
+        # Left
+        self.info_idx = (self.info_idx - 1) % len(self.info_lines)
+        self.load_info()
+        self.controller.disp_thread.update_line3_display(self.info_lines[self.info_idx])
+        return self
 
+    def button3(self, event: ButtonEvent) -> Menu:
+        # Right
+        self.info_idx = (self.info_idx + 1) % len(self.info_lines)
+        self.load_info()
+        self.controller.disp_thread.update_line3_display(self.info_lines[self.info_idx])
         return self
+
+    def button4(self, event: ButtonEvent) -> Menu:
+        # Prev
+        return self.back()
+
+
+def start_duration_specs(day: int) -> tuple:
+    return (MenuSpec(MenuName.set_start, ScheduleSunriseStart, day=day),
+            MenuSpec(MenuName.set_duration, ScheduleSunriseDuration, day=day))
+
+
+# The complete menu tree.  Sub-menus are listed in the order the arrow buttons scroll through them.
+MENU_TREE = MenuSpec(MenuName.top, TopMenu, (
+    MenuSpec(MenuName.main, ListMenu, (
+        MenuSpec(MenuName.schedule, ListMenu, (
+            MenuSpec(MenuName.set_weekday, ListMenu, start_duration_specs(MONDAY)),
+            MenuSpec(MenuName.set_weekend, ListMenu, start_duration_specs(SATURDAY)),
+            MenuSpec(MenuName.set_daily, ListMenu, tuple(
+                MenuSpec(MenuName.day_of_week, ListMenu, start_duration_specs(day), day=day,
+                         label=calendar.day_abbr[day], item_label=calendar.day_name[day])
+                for day in range(MONDAY, SUNDAY + 1))),
+        )),
+        MenuSpec(MenuName.enable, EnableMenu),
+        MenuSpec(MenuName.display_timer, SetDisplayOffTimeMenu),
+        MenuSpec(MenuName.calibrate, DimmerCalibrationMenu),
+        MenuSpec(MenuName.set_date, SetDateMenu),
+        MenuSpec(MenuName.network, NetworkMenu),
+    )),
+))
@@ -1,20 +1,39 @@
 import datetime as dt
 import json
+import logging
+import time
 
+from sunrise_metrics import registry
+
+settings_write_seconds = registry.histogram('sunrise_settings_write_seconds', 'Time to write the settings file')
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_FILENAME = 'settings.json'
 DEFAULT_START_TIME = '05:00'
+# For a duration or auto off time in the settings file that isn't a number
+DEFAULT_DURATION_MINUTES = 60
+DEFAULT_AUTO_OFF_MINUTES = 3
+MAX_DURATION_MINUTES = 90
+MAX_AUTO_OFF_MINUTES = 10
+NUM_DAYS = 7
+# Settings file keys, also the SunriseSettings attributes
+SETTINGS_FIELDS = ('weekday_sched_enabled', 'weekend_sched_enabled', 'daily_sched_enabled', 'days', 'start_time',
+                   'duration_minutes', 'auto_off_minutes')
 
 
 class SunriseSettings:
+    __slots__ = SETTINGS_FIELDS
 
     def __init__(self, weekday_sched_enabled: bool, weekend_sched_enabled: bool, daily_sched_enabled: bool,
-                 days, start_time: list[str], duration_minutes: list[int], auto_off_minutes):
+                 days: list[str], start_time: list[str], duration_minutes: list[int], auto_off_minutes: int):
         self.weekday_sched_enabled: bool = weekday_sched_enabled
         self.weekend_sched_enabled: bool = weekend_sched_enabled
         self.daily_sched_enabled: bool = daily_sched_enabled
-        self.days: str = days
+        self.days: list[str] = days
         self.start_time: list[str] = start_time
         self.duration_minutes: list[int] = duration_minutes
-        self.auto_off_minutes = auto_off_minutes
+        self.auto_off_minutes: int = auto_off_minutes
 
 
 def setting_decoder(obj):
@@ -25,10 +44,17 @@ def setting_decoder(obj):
     return obj
 
 
+def clamp_minutes(minutes, max_minutes: int, default: int) -> int:
+    """ Whole minutes from 1 to max_minutes, the default if not a number at all. """
+    if isinstance(minutes, bool) or not isinstance(minutes, (int, float)):
+        return default
+    return min(max(int(minutes), 1), max_minutes)
+
+
 class SunriseData:
-    def __init__(self):
+    def __init__(self, filename: str = SETTINGS_FILENAME):
         # self.sunrise_duration_minutes: dt.timedelta = dt.timedelta(minutes=0)
-        self.sunrise_settings_filename = "settings.json"
+        self.sunrise_settings_filename = filename
         self.settings: SunriseSettings = self.load_settings()
         self.consistency_checks()
 
@@ -37,9 +63,9 @@ class SunriseData:
         # Daily schedule can't be enabled with any other schedule type:
         if self.settings.daily_sched_enabled:
             if self.settings.weekday_sched_enabled or self.settings.weekend_sched_enabled:
-                print(f'ERROR: Daily schedule type enabled along with another: weekday:'
-                      f' {self.settings.weekday_sched_enabled}, weekend: {self.settings.weekend_sched_enabled}')
-                print('   Disabling daily schedule')
+                logger.error('Daily schedule type enabled along with another: weekday: %s, weekend: %s - '
+                             'disabling daily schedule',
+                             self.settings.weekday_sched_enabled, self.settings.weekend_sched_enabled)
                 self.settings.daily_sched_enabled = False
                 need_to_save_settings = True
 
@@ -49,23 +75,105 @@ class SunriseData:
             try:
                 _ = dt.datetime.strptime(start_time_str, '%H:%M')
             except ValueError:
-                print(f'ERROR - invalid time format setting for entry {idx}: {start_time_str}')
-                print('   Setting to default time')
+                logger.error('Invalid time format setting for entry %s: %s - setting to default time',
+                             idx, start_time_str)
                 need_to_save_settings = True
                 self.settings.start_time[idx] = DEFAULT_START_TIME
 
+        # Durations and auto off time must be within range, the menus show them by index
+        for idx in range(len(self.settings.duration_minutes)):
+            minutes = self.settings.duration_minutes[idx]
+            valid = clamp_minutes(minutes, MAX_DURATION_MINUTES, DEFAULT_DURATION_MINUTES)
+            if valid != minutes:
+                logger.error('Invalid duration setting for entry %s: %s - setting to %s', idx, minutes, valid)
+                need_to_save_settings = True
+                self.settings.duration_minutes[idx] = valid
+        minutes = self.settings.auto_off_minutes
+        valid = clamp_minutes(minutes, MAX_AUTO_OFF_MINUTES, DEFAULT_AUTO_OFF_MINUTES)
+        if valid != minutes:
+            logger.error('Invalid auto off setting: %s - setting to %s', minutes, valid)
+            need_to_save_settings = True
+            self.settings.auto_off_minutes = valid
+
         if need_to_save_settings:
             self.save_settings()
 
+    def settings_dict(self) -> dict:
+        """ Copy of the settings as plain JSON types. """
+        s = {name: getattr(self.settings, name) for name in SETTINGS_FIELDS}
+        s['start_time'] = list(s['start_time'])
+        s['duration_minutes'] = list(s['duration_minutes'])
+        return s
+
+    def update_settings(self, changes: dict):
+        """
+        Validates and applies a partial settings change.  Start times and durations can be given either as a full list
+        of 7 entries (Monday first) or as a dict of day index to value.  Nothing is applied if any value is invalid.
+        :param changes: Setting names and their new values
+        :raises: ValueError
+        :return: None
+        """
+        new = self.settings_dict()
+        for key, value in changes.items():
+            match key:
+                case 'weekday_sched_enabled' | 'weekend_sched_enabled' | 'daily_sched_enabled':
+                    if not isinstance(value, bool):
+                        raise ValueError(f'{key} must be true or false')
+                    new[key] = value
+                case 'start_time':
+                    for day, start_time in self.day_values(key, value):
+                        try:
+                            dt.datetime.strptime(start_time, '%H:%M')
+                        except (TypeError, ValueError):
+                            raise ValueError(f'invalid start time for day {day}: {start_time}')
+                        new[key][day] = start_time
+                case 'duration_minutes':
+                    for day, minutes in self.day_values(key, value):
+                        if isinstance(minutes, bool) or not isinstance(minutes, int) or not 1 <= minutes <= MAX_DURATION_MINUTES:
+                            raise ValueError(f'duration for day {day} must be 1 to {MAX_DURATION_MINUTES} minutes')
+                        new[key][day] = minutes
+                case 'auto_off_minutes':
+                    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= MAX_AUTO_OFF_MINUTES:
+                        raise ValueError(f'auto_off_minutes must be 1 to {MAX_AUTO_OFF_MINUTES}')
+                    new[key] = value
+                case 'days':
+                    # Day names, read only.  Ignored so that the settings as read can be written back unchanged
+                    pass
+                case _:
+                    raise ValueError(f'unknown setting: {key}')
+
+        if new['daily_sched_enabled'] and (new['weekday_sched_enabled'] or new['weekend_sched_enabled']):
+            raise ValueError('daily schedule can not be enabled along with weekday or weekend schedules')
+
+        for key, value in new.items():
+            setattr(self.settings, key, value)
+
+    @staticmethod
+    def day_values(key: str, value) -> list:
+        if isinstance(value, list):
+            if len(value) != NUM_DAYS:
+                raise ValueError(f'{key} list must have {NUM_DAYS} entries')
+            return list(enumerate(value))
+        if isinstance(value, dict):
+            try:
+                days = [(int(day), v) for day, v in value.items()]
+            except ValueError:
+                raise ValueError(f'{key} days must be 0 (Monday) to 6 (Sunday)')
+            if any(not 0 <= day < NUM_DAYS for day, _ in days):
+                raise ValueError(f'{key} days must be 0 (Monday) to 6 (Sunday)')
+            return days
+        raise ValueError(f'{key} must be a list or a dict of day to value')
+
     def save_settings(self):
+        start_time = time.perf_counter()
         try:
             with open(self.sunrise_settings_filename, 'wt') as out_file:
-                s = vars(self.settings)
-                s["__type__"] = 'SunriseSettings'
+                s = {'__type__': 'SunriseSettings'} | self.settings_dict()
                 json.dump(s, out_file, sort_keys=True, indent=4,
                           ensure_ascii=True)
         except:
             raise FileNotFoundError(f"can't open settings file: {self.sunrise_settings_filename}")
+        settings_write_seconds.observe(time.perf_counter() - start_time)
 
     def load_settings(self):
         with open(self.sunrise_settings_filename, 'r') as in_file:
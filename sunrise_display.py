@@ -0,0 +1,187 @@
+# The display thread.  It owns the view: the controller and its menus set the lines and post messages, and this thread
+# draws frames, scrolls the long line and turns the display off when idle.
+#
+# Kept out of sunrise_controller.py, which can be compiled with mypyc (see sunrise_mypyc.py): a compiled subclass of
+# threading.Thread crashes the interpreter when it is garbage collected.
+
+import logging
+import queue
+import threading
+from enum import Enum
+from typing import Callable, ClassVar, List, TYPE_CHECKING
+
+from sunrise_data import SunriseData
+from sunrise_watchdog import watchdog
+
+if TYPE_CHECKING:
+    from sunrise_view import View
+
+DISPLAY_MSG_Q_SIZE: int = 12
+# Longest the display loop waits between updates while the display is on
+DISPLAY_MAX_WAIT_SEC: float = 2.0
+
+logger = logging.getLogger(__name__)
+
+
+class DisplayThreadMessages(Enum):
+    Wake = 1
+    Update = 2
+    AutoOff = 3
+
+
+class DisplayThread(threading.Thread):
+    def __init__(self, view: 'View', data: SunriseData, event: threading.Event) -> None:
+        threading.Thread.__init__(self)
+        self._view: 'View' = view
+        self.data = data
+        self.event = event
+        self.auto_off_minutes = 1
+        # None or empty shows the view's default for the line
+        self.line1: str | None = ''
+        self.line2: str | None = ''
+        self.line3: str | None = ''
+        self.line4: str | None = ''
+        self.status = ''
+        self.scroll = True
+        self.at_end = False
+        self.update_made = False
+        self.msg_q: queue.Queue[DisplayThreadMessages] = queue.Queue(DISPLAY_MSG_Q_SIZE)
+        self.post_listeners: List[Callable[[DisplayThreadMessages], None]] = []
+        # e.g., catches a hang writing to the display over I2C
+        self.heartbeat = watchdog.heartbeat('display')
+
+    wake: ClassVar[DisplayThreadMessages] = DisplayThreadMessages.Wake
+    update: ClassVar[DisplayThreadMessages] = DisplayThreadMessages.Update
+    auto_off: ClassVar[DisplayThreadMessages] = DisplayThreadMessages.AutoOff
+
+    def run(self):
+        logger.info('DisplayThread started')
+        # Display event loop - updates display while it is on
+        self._view.turn_display_on()
+        self._view.set_display_lines(self.line1, self.line2, self.line3, self.line4)
+        self._view.update_display()
+        self.at_end = False
+        while True:
+            while self._view.is_display_on():
+                self.heartbeat.beat(DISPLAY_MAX_WAIT_SEC)
+                self.update_made = False
+                if self.event.is_set():
+                    logger.info('DisplayThread got event, exiting...')
+                    return
+
+                max_wait_time = 1
+                if self.scroll:
+                    if self.at_end:
+                        incremental_wait_time = DISPLAY_MAX_WAIT_SEC
+                    else:
+                        incremental_wait_time = 0.1
+                    try:
+                        msg = self.msg_q.get(True, incremental_wait_time)
+                        if msg == self.update:
+                            self._view.update_display()
+                            self.update_made = True
+                    except queue.Empty:
+                        # Okay for no display changes
+                        self.at_end = self._view.scroll_line3()
+                        self.update_made = True
+                        pass
+                else:
+                    # Delay display update unless someone gives us a new update
+                    try:
+                        msg = self.msg_q.get(True, max_wait_time)
+                        if msg == self.update:
+                            self._view.update_display()
+                            self.update_made = True
+                        elif msg == self.auto_off:
+                            self._view.set_auto_off_minutes(self.auto_off_minutes)
+                        else:
+                            logger.error('Unknown message received in DisplayThread: %s', msg)
+                    except queue.Empty:
+                        # Okay for no display changes
+                        pass
+
+                # If a non-urgent display update was made, pick it up before starting next scroll
+                self._view.set_display_lines(self.line1, self.line2, self.line3, self.line4)
+                self._view.set_status_display_line(self.status)
+                # If no recent display update, update now to ensure any changes, including clock time are shown
+                if not self.update_made:
+                    self._view.update_display()
+
+                self._view.check_display_idle_off()
+
+            # Wait for something to wake up the display or other message
+            self.heartbeat.idle()
+            msg = self.msg_q.get(True)
+            if msg == self.wake:
+                logger.debug('Waking Display...')
+                self._view.turn_display_on()
+            elif msg == self.auto_off:
+                self._view.set_auto_off_minutes(self.auto_off_minutes)
+            else:
+                logger.error('Unknown message received in DisplayThread: %s', msg)
+
+    def post(self, msg: DisplayThreadMessages):
+        """ Queues a message for the display thread.  Never blocks the caller on a full queue for an update. """
+        for listener in self.post_listeners:
+            listener(msg)
+        try:
+            self.msg_q.put(msg, False)
+        except queue.Full:
+            if msg != self.update:
+                self.msg_q.put(msg, True, DISPLAY_MAX_WAIT_SEC)
+            # Otherwise the updates already queued show the latest lines
+
+    def add_post_listener(self, listener: Callable[[DisplayThreadMessages], None]):
+        """ listener(msg) is called in the poster's thread before each message is queued. """
+        self.post_listeners.append(listener)
+
+    # Send a message to unblock the display thread and start display updates again.
+    def turn_on_display(self):
+        self.post(self.wake)
+
+    def update_auto_off(self, ao_minutes: int):
+        self.auto_off_minutes = ao_minutes
+        self.post(self.auto_off)
+
+    def update_display(self):
+        self._view.set_display_lines(self.line1, self.line2, self.line3, self.line4)
+        self._view.scroll = self.scroll
+        self.post(self.update)
+
+    def update_line2_display(self, line2):
+        self.line2 = line2
+        self._view.set_line2(line2)
+        self.post(self.update)
+
+    def update_line3_display(self, line3):
+        self.line3 = line3
+        self._view.set_line3(line3)
+        self.post(self.update)
+
+    def update_line4_display(self, line4):
+        self.line4 = line4
+        self._view.set_line4(line4)
+        self.post(self.update)
+
+    def update_status_line(self, status):
+        self._view.set_status_display_line(status)
+        self.post(self.update)
+
+    # The progress graph is drawn into the view's bitmap right away, the next frame shows it
+    def start_progress(self, total_sec: float, max_level: int, start_level: int):
+        self._view.start_progress(total_sec, max_level, start_level)
+
+    def update_progress(self, elapsed_sec: float, level: int):
+        self._view.add_progress(elapsed_sec, level)
+
+    def end_progress(self):
+        self._view.end_progress()
+
+    def enable_status(self):
+        self._view.enable_status_display()
+
+    def disable_status(self):
+        self._view.disable_status_display()
+
+    def center_line(self, line: str) -> str:
+        return self._view.center_line(line)
@@ -0,0 +1,259 @@
+# Fleet benchmark.  Before a change to the scheduling or ramp code goes out to every unit, this shows how that code
+# scales: thousands of simulated units (the real SunriseController with SimPi and the headless display, see
+# sunrise_sim.py), each with its own random schedule, all in one process and driven through the same simulated days.
+#
+# Reported per fleet:
+#   - build time and resident memory per unit,
+#   - run CPU time and event throughput (timer calls per CPU second), with the time per call of each timer callback,
+#     so a slower ramp step (periodic_run_sunrise) or sunrise start stands out,
+#   - handle_schedule_change() time per call, measured directly on every unit after the run.
+#
+#   python sunrise_fleet.py --units 2000 --days 7
+#   python sunrise_fleet.py --sizes 250,1000,4000 --days 2     Scaling table, each size in a fresh process
+#
+# The per call costs should not change with the fleet size; growth between sizes is a scaling regression.  The
+# simulator's checks still run on every unit and the first few violations are shown with the unit's settings, random
+# schedules reach corners (e.g., very short sunrises) that the default simulation doesn't.
+#
+# Like sunrise_main.py, the fleet runs the mypyc build if there is an up to date one (see sunrise_mypyc.py), and the
+# result says which build ran.  SUNRISE_NO_MYPYC=1 measures the pure Python sources.
+
+import argparse
+import collections
+import datetime as dt
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Dict, List
+
+from sunrise_mypyc import select_build
+# Before any module that may be compiled is imported
+build_in_use = select_build()
+
+from sunrise_clock import VirtualClock
+from sunrise_data import MAX_DURATION_MINUTES, NUM_DAYS
+from sunrise_log import setup_logging, shutdown_logging
+from sunrise_memory import rss_kb
+from sunrise_sim import Simulation, SIM_SETTINGS
+
+FLEET_UNITS: int = 2000
+FLEET_DAYS: float = 7.0
+# Direct handle_schedule_change() calls per unit after the run
+FLEET_SCHEDULE_CHANGES: int = 10
+FLEET_START: str = '2026-03-02T00:00'
+# Open files per unit: the run journal and the event history
+FLEET_FILES_PER_UNIT: int = 2
+FLEET_VIOLATION_EXAMPLES: int = 5
+
+logger = logging.getLogger(__name__)
+
+
+class TimedClock(VirtualClock):
+    """ A VirtualClock that adds up the time spent in each timer callback, by callback name. """
+
+    def __init__(self, start_epoch: float, seconds: Dict[str, float], calls: Dict[str, int]):
+        VirtualClock.__init__(self, start_epoch)
+        self.seconds = seconds
+        self.calls = calls
+
+    def run_next(self) -> Any:
+        if self.next_time() is None:
+            raise IndexError('no pending calls')
+        name = getattr(self.pending[0][2].fn, '__name__', '?')
+        start_time = time.perf_counter()
+        try:
+            return VirtualClock.run_next(self)
+        finally:
+            self.seconds[name] += time.perf_counter() - start_time
+            self.calls[name] += 1
+
+
+def random_settings(rng: random.Random) -> Dict:
+    """ A random schedule in the same layout as settings.json.  Most units have a schedule enabled. """
+    enabled = rng.choice(['weekday_sched_enabled', 'weekend_sched_enabled', 'daily_sched_enabled', 'both', None])
+    return SIM_SETTINGS | {
+        'weekday_sched_enabled': enabled in ('weekday_sched_enabled', 'both'),
+        'weekend_sched_enabled': enabled in ('weekend_sched_enabled', 'both'),
+        'daily_sched_enabled': enabled == 'daily_sched_enabled',
+        'start_time': [f'{rng.randrange(4, 10):02d}:{rng.randrange(60):02d}' for _ in range(NUM_DAYS)],
+        'duration_minutes': [rng.randint(1, MAX_DURATION_MINUTES) for _ in range(NUM_DAYS)],
+        'auto_off_minutes': rng.randint(1, 5),
+    }
+
+
+def raise_file_limit(units: int):
+    """ Each unit keeps its files open, more than the usual default of 1024 for a large fleet. """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = units * FLEET_FILES_PER_UNIT + 100
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY and hard < needed:
+            raise ValueError(f'{units} units need {needed} open files, the limit is {hard}')
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+
+@dataclass
+class FleetResult:
+    build: str = ''
+    units: int = 0
+    days: float = 0.0
+    build_seconds: float = 0.0
+    rss_per_unit_kb: float = 0.0
+    run_cpu_seconds: float = 0.0
+    run_wall_seconds: float = 0.0
+    timer_calls: int = 0
+    sunrises_started: int = 0
+    ramp_steps: int = 0
+    violations: int = 0
+    schedule_changes: int = 0
+    schedule_change_us: float = 0.0
+    schedule_change_p99_us: float = 0.0
+    # Callback name -> [calls, total seconds]
+    callbacks: Dict[str, List[float]] = field(default_factory=dict)
+    violation_examples: List[str] = field(default_factory=list)
+
+    def ramp_step_us(self) -> float:
+        calls, seconds = self.callbacks.get('periodic_run_sunrise', (0, 0.0))
+        return seconds / calls * 1e6 if calls else 0.0
+
+    def summary(self) -> str:
+        throughput = self.timer_calls / self.run_cpu_seconds if self.run_cpu_seconds else 0
+        lines = [f'Build: {self.build}',
+                 f'{self.units} units built in {self.build_seconds:.2f} s, {self.rss_per_unit_kb:.1f} kB resident '
+                 f'per unit',
+                 f'{self.days:g} days run in {self.run_cpu_seconds:.2f} s CPU ({self.run_wall_seconds:.2f} s wall): '
+                 f'{self.timer_calls:,} timer calls, {throughput:,.0f} per CPU second',
+                 f'{self.sunrises_started:,} sunrises, {self.ramp_steps:,} ramp steps, {self.violations} violations',
+                 f'handle_schedule_change: {self.schedule_changes:,} calls, {self.schedule_change_us:.1f} us each, '
+                 f'p99 {self.schedule_change_p99_us:.1f} us',
+                 f'{"Timer callback":<24} {"Calls":>10} {"Total s":>9} {"us/call":>9}']
+        for name, (calls, seconds) in sorted(self.callbacks.items(), key=lambda c: -c[1][1]):
+            lines.append(f'{name:<24} {calls:>10,.0f} {seconds:>9.2f} {seconds / calls * 1e6:>9.1f}')
+        lines.extend(self.violation_examples)
+        return '\n'.join(lines)
+
+
+def run_fleet(units: int, days: float, seed: int = 0, start: dt.datetime | None = None,
+              changes_per_unit: int = FLEET_SCHEDULE_CHANGES) -> FleetResult:
+    """
+    Builds the fleet, runs it for the given days and then times schedule changes on every unit.
+    :param units: Number of simulated units
+    :param days: Simulated days
+    :param seed: Seed for the schedules and each unit's simulated user
+    :param start: Local start time, FLEET_START by default
+    :param changes_per_unit: Direct handle_schedule_change() calls per unit
+    :return: FleetResult
+    """
+    raise_file_limit(units)
+    start = start or dt.datetime.fromisoformat(FLEET_START)
+    rng = random.Random(seed)
+    result = FleetResult(build=build_in_use, units=units, days=days)
+    seconds: Dict[str, float] = collections.defaultdict(float)
+    calls: Dict[str, int] = collections.defaultdict(int)
+    with tempfile.TemporaryDirectory(prefix='sunrise_fleet_') as directory:
+        gc.collect()
+        rss_before = rss_kb()
+        build_start = time.perf_counter()
+        fleet: List[Simulation] = []
+        for unit in range(units):
+            unit_directory = os.path.join(directory, f'{unit:05d}')
+            os.mkdir(unit_directory)
+            fleet.append(Simulation(start, random_settings(rng), seed=rng.getrandbits(32), directory=unit_directory,
+                                    clock=TimedClock(start.timestamp(), seconds, calls)))
+        result.build_seconds = time.perf_counter() - build_start
+        gc.collect()
+        result.rss_per_unit_kb = (rss_kb() - rss_before) / units
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            for unit, sim in enumerate(fleet):
+                sim_result = sim.run(days)
+                result.timer_calls += sim_result.calls_run
+                result.sunrises_started += sim_result.sunrises_started
+                result.ramp_steps += sim_result.ramp_steps
+                result.violations += len(sim_result.violations)
+                if sim_result.violations and len(result.violation_examples) < FLEET_VIOLATION_EXAMPLES:
+                    settings = sim.ctrl.settings
+                    result.violation_examples.append(
+                        f'Unit {unit} (start {settings.start_time}, minutes {settings.duration_minutes}): '
+                        f'{sim_result.violations[0]}')
+            result.run_cpu_seconds = time.process_time() - cpu_start
+            result.run_wall_seconds = time.perf_counter() - wall_start
+
+            change_times: List[float] = []
+            for sim in fleet:
+                change_times.extend(time_calls(sim.ctrl.handle_schedule_change, changes_per_unit))
+        finally:
+            for sim in fleet:
+                sim.close()
+    change_times.sort()
+    result.schedule_changes = len(change_times)
+    if change_times:
+        result.schedule_change_us = sum(change_times) / len(change_times) * 1e6
+        result.schedule_change_p99_us = change_times[int(len(change_times) * 0.99)] * 1e6
+    result.callbacks = {name: [calls[name], seconds[name]] for name in calls}
+    return result
+
+
+def time_calls(fn: Callable[[], Any], count: int) -> List[float]:
+    times = []
+    for _ in range(count):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def scaling(sizes: List[int], days: float, seed: int) -> int:
+    """ Runs each fleet size in a fresh process, so memory per unit isn't skewed by the previous fleet. """
+    results = []
+    for size in sizes:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--units', str(size), '--days', str(days),
+                              '--seed', str(seed), '--json'], capture_output=True, text=True, check=True)
+        results.append(FleetResult(**json.loads(out.stdout.strip().splitlines()[-1])))
+    print(f'Build: {build_in_use}')
+    print(f'{"Units":>7} {"kB/unit":>8} {"Calls/CPU s":>12} {"Ramp step us":>13} {"Sched change us":>16} '
+          f'{"p99 us":>8} {"Violations":>10}')
+    for r in results:
+        throughput = r.timer_calls / r.run_cpu_seconds if r.run_cpu_seconds else 0
+        print(f'{r.units:>7} {r.rss_per_unit_kb:>8.1f} {throughput:>12,.0f} {r.ramp_step_us():>13.1f} '
+              f'{r.schedule_change_us:>16.1f} {r.schedule_change_p99_us:>8.1f} {r.violations:>10}')
+    return 0
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Run thousands of simulated sunrise controllers in one process')
+    parser.add_argument('--units', type=int, default=FLEET_UNITS)
+    parser.add_argument('--days', type=float, default=FLEET_DAYS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sizes', default=None, help='Comma separated fleet sizes for a scaling table')
+    parser.add_argument('--tz', default=None, help='Time zone, e.g., America/New_York to include DST changes')
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args(argv)
+
+    if args.tz:
+        os.environ['TZ'] = args.tz
+        time.tzset()
+    if args.sizes:
+        return scaling([int(size) for size in args.sizes.split(',')], args.days, args.seed)
+
+    setup_logging(args.log_level, sys.stderr)
+    try:
+        result = run_fleet(args.units, args.days, args.seed)
+    finally:
+        shutdown_logging()
+    print(json.dumps(asdict(result)) if args.json else result.summary())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
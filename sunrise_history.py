@@ -0,0 +1,160 @@
+# Persistent history of what the alarm did.  Events are kept in a fixed-size ring buffer file of fixed-width binary
+# records so that appending is O(1) and the file never grows on the SD card - once full, the oldest events are
+# overwritten.
+
+import calendar
+import datetime as dt
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Callable, Iterable, Iterator, List
+
+HISTORY_FILENAME = 'sunrise_history.bin'
+HISTORY_CAPACITY = 4096
+
+HISTORY_MAGIC = b'SRH1'
+HISTORY_VERSION = 1
+
+# magic, version, capacity, index of next record to write, number of valid records
+_HEADER = struct.Struct('<4sIIII')
+# time of event, event type, source (e.g., button number), small integer argument, two float values
+_RECORD = struct.Struct('<dBBhff')
+
+logger = logging.getLogger(__name__)
+
+
+class EventType(IntEnum):
+    startup = 1
+    sunrise_start = 2
+    sunrise_complete = 3
+    sunrise_cancel = 4
+    sunrise_resume = 5
+    button_press = 6
+    schedule_change = 7
+    # Timing of a finished ramp: source = missed steps, arg = p99 step jitter in ms, value = drift of the last step
+    # from plan in seconds, value2 = end time error vs. the configured duration in seconds
+    ramp_timing = 8
+    # Joined the sunrise of another unit (sync follower): arg = duration minutes, value = level joined at
+    sunrise_follow = 9
+
+
+@dataclass(slots=True)
+class HistoryEvent:
+    epoch: float
+    event_type: EventType
+    source: int
+    arg: int
+    value: float
+    value2: float
+
+    def __str__(self):
+        when = dt.datetime.fromtimestamp(self.epoch).strftime('%Y-%m-%d %H:%M:%S')
+        return f'{when} {self.event_type.name:<17} src={self.source} arg={self.arg} value={self.value:g} ' \
+               f'value2={self.value2:g}'
+
+
+class EventHistory:
+    def __init__(self, filename: str = HISTORY_FILENAME, capacity: int = HISTORY_CAPACITY,
+                 time_fn: Callable[[], float] = time.time):
+        self.filename = filename
+        # Time stamps events that are appended without one
+        self.time_fn = time_fn
+        self.lock = threading.Lock()
+        size = _HEADER.size + capacity * _RECORD.size
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+        magic, version, file_capacity, self.head, self.num_records = _HEADER.unpack_from(self.map, 0)
+        if magic != HISTORY_MAGIC or version != HISTORY_VERSION or file_capacity != capacity:
+            # New file or a different layout - start over
+            logger.info('Initializing event history: %s, %s records', self.filename, capacity)
+            self.map[:] = bytes(size)
+            self.head = 0
+            self.num_records = 0
+            _HEADER.pack_into(self.map, 0, HISTORY_MAGIC, HISTORY_VERSION, capacity, 0, 0)
+            self.map.flush()
+        self.capacity = capacity
+
+    def append(self, event_type: EventType, source: int = 0, arg: int = 0, value: float = 0.0, value2: float = 0.0,
+               epoch: float | None = None):
+        if epoch is None:
+            epoch = self.time_fn()
+        with self.lock:
+            _RECORD.pack_into(self.map, _HEADER.size + self.head * _RECORD.size, epoch, event_type, source, arg,
+                              value, value2)
+            self.head = (self.head + 1) % self.capacity
+            if self.num_records < self.capacity:
+                self.num_records += 1
+            _HEADER.pack_into(self.map, 0, HISTORY_MAGIC, HISTORY_VERSION, self.capacity, self.head,
+                              self.num_records)
+            self.map.flush()
+
+    def __iter__(self) -> Iterator[HistoryEvent]:
+        """ Iterates over a snapshot of the stored events from oldest to newest. """
+        with self.lock:
+            first = (self.head - self.num_records) % self.capacity
+            count = self.num_records
+            start = _HEADER.size + first * _RECORD.size
+            if first + count <= self.capacity:
+                raw = self.map[start:start + count * _RECORD.size]
+            else:
+                # Wrapped around the end of the buffer
+                raw = self.map[start:] + self.map[_HEADER.size:_HEADER.size + self.head * _RECORD.size]
+
+        for epoch, event_type, source, arg, value, value2 in _RECORD.iter_unpack(raw):
+            yield HistoryEvent(epoch, EventType(event_type), source, arg, value, value2)
+
+    def query(self, start_epoch: float | None = None, end_epoch: float | None = None,
+              event_types: Iterable[EventType] | None = None) -> List[HistoryEvent]:
+        """
+        Returns the events, oldest first, that fall within the given time range and match the given types.
+        :param start_epoch: Only include events at or after this time.  None for no lower bound.
+        :param end_epoch: Only include events before this time.  None for no upper bound.
+        :param event_types: Only include these types of events.  None for all event types.
+        :return: List of matching events
+        """
+        types = None if event_types is None else set(event_types)
+        return [e for e in self
+                if (start_epoch is None or e.epoch >= start_epoch)
+                and (end_epoch is None or e.epoch < end_epoch)
+                and (types is None or e.event_type in types)]
+
+    def count(self, event_type: EventType, start_epoch: float | None = None, end_epoch: float | None = None) -> int:
+        return len(self.query(start_epoch, end_epoch, (event_type,)))
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def start_of_month_epoch() -> float:
+    today = dt.date.today()
+    return dt.datetime(today.year, today.month, 1).timestamp()
+
+
+if __name__ == '__main__':
+    # Dump the history, optionally limited to the given event types.  E.g.:
+    #   python sunrise_history.py sunrise_cancel sunrise_complete
+    history = EventHistory()
+    selected = [EventType[name] for name in sys.argv[1:]] or None
+    for event in history.query(event_types=selected):
+        print(event)
+
+    month = calendar.month_name[dt.date.today().month]
+    print(f'Sunrises this month ({month}): '
+          f'{history.count(EventType.sunrise_complete, start_of_month_epoch())} completed, '
+          f'{history.count(EventType.sunrise_cancel, start_of_month_epoch())} cancelled early')
+    timings = history.query(start_of_month_epoch(), event_types=(EventType.ramp_timing,))
+    if timings:
+        print(f'Ramp timing this month: worst drift {max(e.value for e in timings):.3f} s, '
+              f'worst p99 step jitter {max(e.arg for e in timings)} ms, '
+              f'{sum(e.source for e in timings)} missed steps, '
+              f'end error {min(e.value2 for e in timings):.1f} to {max(e.value2 for e in timings):.1f} s')
@@ -0,0 +1,97 @@
+# Crash-safe record of the sunrise that is currently running.  The journal is a small fixed-size file that is
+# memory-mapped so that each ramp step only costs a couple of struct writes into the mapping plus an msync.  If the
+# process dies or the Pi reboots mid-sunrise, the controller reads it back at startup and resumes the ramp exactly
+# where the plan says it should be instead of guessing from the settings.
+
+import mmap
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+
+JOURNAL_FILENAME = 'sunrise_run.journal'
+
+JOURNAL_MAGIC = b'SRJ1'
+JOURNAL_VERSION = 1
+
+# Ramp curve identifiers stored in the journal
+CURVE_LINEAR = 0
+
+STATE_IDLE = 0
+STATE_RUNNING = 1
+
+# magic, version, state, curve, start epoch, duration minutes, start level, step size, seconds per step, current level,
+# time of last update, crc32 of everything before it.
+_RECORD = struct.Struct('<4sBBBxdIHHdHxxxxxxd')
+_CRC = struct.Struct('<I')
+_LEVEL = struct.Struct('<Hxxxxxxd')
+_LEVEL_OFFSET = 4 + 1 + 1 + 1 + 1 + 8 + 4 + 2 + 2 + 8
+_CRC_OFFSET = _RECORD.size
+JOURNAL_SIZE = _RECORD.size + _CRC.size
+
+
+@dataclass(slots=True)
+class RunState:
+    state: int
+    curve: int
+    start_epoch: float
+    duration_minutes: int
+    start_level: int
+    step_size: int
+    sec_per_step: float
+    level: int
+    updated_epoch: float
+
+    def is_running(self) -> bool:
+        return self.state == STATE_RUNNING
+
+    def end_epoch(self) -> float:
+        return self.start_epoch + self.duration_minutes * 60
+
+
+class RunJournal:
+    def __init__(self, filename: str = JOURNAL_FILENAME):
+        self.filename = filename
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != JOURNAL_SIZE:
+            os.ftruncate(self.fd, JOURNAL_SIZE)
+        self.map = mmap.mmap(self.fd, JOURNAL_SIZE)
+
+    def load(self) -> RunState | None:
+        """
+        Reads back the journal.  Returns None if the journal is empty, from another version or fails its checksum
+        (e.g., power was lost in the middle of a write).
+        :return: RunState or None
+        """
+        (crc,) = _CRC.unpack_from(self.map, _CRC_OFFSET)
+        if crc != zlib.crc32(self.map[:_CRC_OFFSET]):
+            return None
+
+        fields = _RECORD.unpack_from(self.map, 0)
+        if fields[0] != JOURNAL_MAGIC or fields[1] != JOURNAL_VERSION:
+            return None
+
+        return RunState(*fields[2:])
+
+    def record_start(self, start_epoch: float, duration_minutes: int, start_level: int, step_size: int,
+                     sec_per_step: float, curve: int = CURVE_LINEAR):
+        _RECORD.pack_into(self.map, 0, JOURNAL_MAGIC, JOURNAL_VERSION, STATE_RUNNING, curve, start_epoch,
+                          duration_minutes, start_level, step_size, sec_per_step, start_level, start_epoch)
+        self._commit()
+
+    def record_level(self, level: int, epoch: float):
+        """ Called at every ramp step, only the level and time of update are rewritten. """
+        _LEVEL.pack_into(self.map, _LEVEL_OFFSET, int(level), epoch)
+        self._commit()
+
+    def clear(self):
+        self.map[:] = bytes(JOURNAL_SIZE)
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def _commit(self):
+        _CRC.pack_into(self.map, _CRC_OFFSET, zlib.crc32(self.map[:_CRC_OFFSET]))
+        self.map.flush()
@@ -0,0 +1,299 @@
+# Button to pixel latency benchmark.  What a user feels is the time from pressing a button until the OLED changes: the
+# debounce settle time, the dispatcher queue, the menu handler, DisplayThread's queue, composing the frame and sending
+# it over I2C.  This runs the real controller, button dispatcher, display thread and OledDisplay with its frame sender,
+# injects button edges the way the pigpio callback does and catches each resulting frame on a headless SSD1306 stand-in
+# that takes as long to send a frame as the I2C bus does.
+#
+# Every menu gets the same presses of its arrow (or -/+) buttons, the top menu On/Off, first with the lamp idle and
+# then with a sunrise ramp running.  The ramp steps every --ramp-step-ms instead of every few seconds, so that ramp
+# steps and their status updates land between the presses.
+#
+#   python sunrise_latency.py                          Headless, 400 kHz I2C
+#   python sunrise_latency.py --presses 100 --i2c-ms 50
+#
+# Latency is from the press edge to the end of sending the first frame composed after the press handler asked for a
+# display update, so it includes BUTTON_SETTLE_SEC.  A press that doesn't change the display (e.g., in Date/Time) has
+# no frame and is only counted.
+
+import argparse
+import bisect
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+from sunrise_mypyc import select_build
+# Before any module that may be compiled is imported
+build_in_use = select_build()
+
+from dimmer import Dimmer
+from sunrise_buttons import BUTTON_SETTLE_SEC, ButtonEvent
+from sunrise_clock import Clock
+from sunrise_controller import SunriseController, Menu, TopMenu, button_map
+from sunrise_data import SunriseData, MAX_AUTO_OFF_MINUTES
+from sunrise_display import DisplayThreadMessages
+from sunrise_history import EventHistory
+from sunrise_journal import RunJournal
+from sunrise_log import setup_logging, shutdown_logging
+from sunrise_ramp import percentile
+from sunrise_sim import SimPi, SIM_SETTINGS
+from sunrise_view import OledDisplay
+
+LATENCY_PRESSES: int = 30
+# 512 bytes of pixels plus addressing at 400 kHz
+LATENCY_I2C_FRAME_SEC: float = 0.013
+LATENCY_RAMP_STEP_SEC: float = 0.1
+# Long enough to settle, well short of a long press
+LATENCY_HOLD_SEC: float = BUTTON_SETTLE_SEC + 0.04
+# Time between releasing a button and the next press, plus up to the same again at random so the presses don't fall
+# into step with the display's scrolling
+LATENCY_GAP_SEC: float = 0.06
+# Lets the display settle after moving to another menu
+LATENCY_MENU_SETTLE_SEC: float = 0.3
+# Duration of the benchmark's sunrise, the steps come every --ramp-step-ms regardless
+LATENCY_RAMP_MINUTES: int = 30
+
+GPIO_BY_BUTTON: Dict[int, int] = {btn: gpio for gpio, btn in button_map.items()}
+
+logger = logging.getLogger(__name__)
+
+
+class CaptureDisplay:
+    """ Stands in for adafruit_ssd1306.SSD1306_I2C.  Sending a frame takes as long as the I2C transfer would. """
+
+    def __init__(self, frame_sec: float, width: int = 128, height: int = 32):
+        self.frame_sec = frame_sec
+        self.width = width
+        self.height = height
+
+    def fill(self, color: int):
+        pass
+
+    def image(self, image):
+        pass
+
+    def show(self):
+        time.sleep(self.frame_sec)
+
+
+class RampClock(Clock):
+    """ The real clock, except that ramp steps come every ramp_step_sec. """
+
+    def __init__(self, ramp_step_sec: float):
+        self.ramp_step_sec = ramp_step_sec
+
+    def call_later(self, delay: float, fn: Callable, *args):
+        if getattr(fn, '__name__', '') == 'periodic_run_sunrise':
+            delay = min(delay, self.ramp_step_sec)
+        return Clock.call_later(self, delay, fn, *args)
+
+
+@dataclass(slots=True)
+class Press:
+    menu: str
+    scenario: str
+    btn: int
+    edge_time: float
+    # When the press handler first asked the display thread for an update, None if it didn't
+    update_time: float | None = None
+
+
+@dataclass
+class LatencyRow:
+    menu: str
+    scenario: str
+    presses: int
+    # Press to frame latencies in seconds, sorted
+    latencies: List[float] = field(default_factory=list)
+
+    def format(self) -> str:
+        row = f'{self.menu:<30} {self.scenario:<5} {self.presses:>7} {len(self.latencies):>7}'
+        if not self.latencies:
+            return row + f' {"-":>7} {"-":>7} {"-":>7} {"-":>7}'
+        ms = [percentile(self.latencies, p) * 1000 for p in (0.5, 0.95, 0.99)]
+        return row + f' {ms[0]:>7.1f} {ms[1]:>7.1f} {ms[2]:>7.1f} {self.latencies[-1] * 1000:>7.1f}'
+
+
+def measured_menus(top: Menu) -> List[Tuple[Menu, List[int], Tuple[int, ...]]]:
+    """
+    Each kind of menu once, with the button presses that reach it from the top menu and the buttons to measure.
+    Menus repeated for every day of the week are only measured for the first day.
+    """
+    menus: List[Tuple[Menu, List[int], Tuple[int, ...]]] = []
+    seen = set()
+
+    def visit(menu: Menu, path: List[int]):
+        key = (type(menu), menu.menu_name)
+        if key in seen:
+            return
+        seen.add(key)
+        # Top menu: On/Off, as Dim-/Dim+ only change the display when the lamp goes on or off.  Elsewhere the arrows.
+        menus.append((menu, path, (4,) if isinstance(menu, TopMenu) else (2, 3)))
+        for i, child in enumerate(menu.children):
+            # The top menu only has Main, entered with Menu.  Lists scroll right to the child and select it.
+            visit(child, path + ([1] if isinstance(menu, TopMenu) else [3] * i + [1]))
+
+    visit(top, [])
+    return menus
+
+
+class LatencyBench:
+    def __init__(self, directory: str, i2c_frame_sec: float, ramp_step_sec: float, seed: int = 0):
+        self.random = random.Random(seed)
+        settings_filename = os.path.join(directory, 'settings.json')
+        # No scheduled sunrise during the run, the display stays on
+        with open(settings_filename, 'wt') as f:
+            json.dump(SIM_SETTINGS | {'weekday_sched_enabled': False, 'weekend_sched_enabled': False,
+                                      'auto_off_minutes': MAX_AUTO_OFF_MINUTES}, f)
+        self.pi = SimPi()
+        self.view = OledDisplay(MAX_AUTO_OFF_MINUTES, False, disp=CaptureDisplay(i2c_frame_sec))
+        self.ctrl = SunriseController(self.view, SunriseData(settings_filename), Dimmer(self.pi),
+                                      clock=RampClock(ramp_step_sec), pi=self.pi,
+                                      journal=RunJournal(os.path.join(directory, 'sunrise_run.journal')),
+                                      history=EventHistory(os.path.join(directory, 'sunrise_history.bin')))
+        self.presses: List[Press] = []
+        # Set while the press being measured is handled
+        self.measuring: Press | None = None
+        self.frame_compose_starts: List[float] = []
+        self.frame_sent: List[float] = []
+        self.view.add_frame_listener(self.frame_sent_listener)
+        dispatcher = self.ctrl.button_dispatcher
+        handler = dispatcher.handler
+
+        def timed_handler(btn: int, event: ButtonEvent):
+            press = self.presses[-1] if self.presses else None
+            if press and event == ButtonEvent.press and btn == press.btn and press.update_time is None:
+                self.measuring = press
+            try:
+                handler(btn, event)
+            finally:
+                self.measuring = None
+
+        def timed_post(msg: DisplayThreadMessages):
+            press = self.measuring
+            if press and msg == DisplayThreadMessages.Update and press.update_time is None:
+                press.update_time = time.perf_counter()
+
+        dispatcher.handler = timed_handler
+        # A listener rather than a replaced method, so that a compiled controller calls it too
+        self.ctrl.disp_thread.add_post_listener(timed_post)
+        # The display thread only exits through the controller's event, which startup() keeps handling
+        self.ctrl.disp_thread.daemon = True
+
+    def frame_sent_listener(self, compose_start: float, sent: float):
+        self.frame_compose_starts.append(compose_start)
+        self.frame_sent.append(sent)
+
+    def start(self):
+        # startup() runs the controller's event loop, which never returns
+        threading.Thread(target=self.ctrl.startup, name='Startup', daemon=True).start()
+        time.sleep(LATENCY_MENU_SETTLE_SEC)
+
+    def stop(self):
+        if self.ctrl.is_running:
+            self.command(self.ctrl.cancel_running_schedule)
+        self.ctrl.button_dispatcher.stop()
+        self.view.sender.stop()
+        self.ctrl.journal.close()
+        self.ctrl.history.close()
+
+    def command(self, fn: Callable, *args):
+        self.ctrl.submit(fn, *args).result()
+
+    def go_to(self, path: List[int]):
+        """ Back to the top menu and down the path, as events rather than edges, those aren't measured. """
+        self.command(self.ctrl.button_event, 4, ButtonEvent.long_press)
+        for btn in path:
+            self.command(self.ctrl.button_event, btn, ButtonEvent.press)
+        time.sleep(LATENCY_MENU_SETTLE_SEC)
+
+    def press(self, label: str, scenario: str, btn: int):
+        gpio = GPIO_BY_BUTTON[btn]
+        dispatcher = self.ctrl.button_dispatcher
+        self.presses.append(Press(label, scenario, btn, time.perf_counter()))
+        dispatcher.put_edge(gpio, 0, 0)
+        time.sleep(LATENCY_HOLD_SEC)
+        dispatcher.put_edge(gpio, 1, 0)
+        time.sleep(LATENCY_GAP_SEC * (1 + self.random.random()))
+
+    def ensure_ramp(self):
+        if not self.ctrl.is_running:
+            self.command(self.ctrl.start_schedule, LATENCY_RAMP_MINUTES)
+
+    def run(self, presses: int) -> List[LatencyRow]:
+        menus = measured_menus(self.ctrl.top_menu)
+        for scenario in ('idle', 'ramp'):
+            for menu, path, buttons in menus:
+                if scenario == 'ramp':
+                    self.ensure_ramp()
+                self.go_to(path)
+                label = menu.hierarchy_line or menu.label
+                for i in range(presses):
+                    if scenario == 'ramp':
+                        # On/Off and entering Dimmer Calibration cancel the sunrise
+                        self.ensure_ramp()
+                    elif self.ctrl.is_running:
+                        self.command(self.ctrl.cancel_running_schedule)
+                    self.press(label, scenario, buttons[i % len(buttons)])
+        time.sleep(LATENCY_MENU_SETTLE_SEC)
+        return self.results(menus)
+
+    def results(self, menus: List[Tuple[Menu, List[int], Tuple[int, ...]]]) -> List[LatencyRow]:
+        rows: Dict[Tuple[str, str], LatencyRow] = {}
+        totals = {scenario: LatencyRow('All menus', scenario, 0) for scenario in ('idle', 'ramp')}
+        for press in self.presses:
+            row = rows.setdefault((press.menu, press.scenario), LatencyRow(press.menu, press.scenario, 0))
+            row.presses += 1
+            totals[press.scenario].presses += 1
+            if press.update_time is None:
+                continue
+            i = bisect.bisect_left(self.frame_compose_starts, press.update_time)
+            if i < len(self.frame_sent):
+                latency = self.frame_sent[i] - press.edge_time
+                row.latencies.append(latency)
+                totals[press.scenario].latencies.append(latency)
+        if not any(row.latencies for row in totals.values()):
+            raise RuntimeError(f'No frames were seen for any of the {len(self.presses)} presses')
+        ordered = sorted(rows.values(), key=lambda r: r.scenario)
+        for row in ordered + list(totals.values()):
+            row.latencies.sort()
+        return ordered + list(totals.values())
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Measure button press to OLED frame latency for each menu')
+    parser.add_argument('--presses', type=int, default=LATENCY_PRESSES, help='Presses per menu and scenario')
+    parser.add_argument('--i2c-ms', type=float, default=LATENCY_I2C_FRAME_SEC * 1000,
+                        help='Time to send one frame to the display')
+    parser.add_argument('--ramp-step-ms', type=float, default=LATENCY_RAMP_STEP_SEC * 1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.log_level, sys.stderr)
+    try:
+        with tempfile.TemporaryDirectory(prefix='sunrise_latency_') as directory:
+            bench = LatencyBench(directory, args.i2c_ms / 1000, args.ramp_step_ms / 1000, args.seed)
+            bench.start()
+            try:
+                rows = bench.run(args.presses)
+            finally:
+                bench.stop()
+    finally:
+        shutdown_logging()
+    print(f'Press to frame latency in ms, I2C frame {args.i2c_ms:g} ms, ramp step {args.ramp_step_ms:g} ms, '
+          f'includes {BUTTON_SETTLE_SEC * 1000:g} ms debounce, {build_in_use}')
+    print(f'{"Menu":<30} {"Lamp":<5} {"Presses":>7} {"Frames":>7} {"p50":>7} {"p95":>7} {"p99":>7} {"max":>7}')
+    for row in rows:
+        print(row.format())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
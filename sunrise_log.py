@@ -0,0 +1,119 @@
+# Logging setup.  Log calls only put the record on a queue; a background listener thread formats the records and
+# writes them out in batches, so a slow console or journald can never block the button, timer or display threads.
+# Hot-path messages are logged at debug level with %-style arguments so they cost only a level check when disabled.
+#
+# Structured fields can be attached to a record with: logger.info('Sunrise complete', extra=fields(duration=30))
+
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from typing import Any, Dict, TextIO
+
+LOG_LEVEL = os.environ.get('SUNRISE_LOG_LEVEL', 'INFO')
+LOG_BATCH_SIZE = 64
+
+_listener: 'BatchingLogListener | None' = None
+
+
+def fields(**kwargs) -> Dict[str, Any]:
+    """ Structured key/value fields for a log record, passed as extra=fields(...). """
+    return {'fields': kwargs}
+
+
+class StructuredFormatter(logging.Formatter):
+    """ Formats records as: time level [thread] logger: message key=value ... """
+
+    def __init__(self):
+        super().__init__('%(asctime)s.%(msecs)03d %(levelname)-7s [%(threadName)s] %(name)s: %(message)s',
+                         '%Y-%m-%d %H:%M:%S')
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        record_fields = getattr(record, 'fields', None)
+        if record_fields:
+            line = line + ' ' + ' '.join(f'{k}={v}' for k, v in record_fields.items())
+        return line
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    The standard QueueHandler formats the message on the logging thread.  Formatting is deferred to the listener
+    instead, which is safe since log arguments here are immutable values.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class BatchingLogListener(threading.Thread):
+    def __init__(self, log_queue: queue.SimpleQueue, stream: TextIO, formatter: logging.Formatter):
+        threading.Thread.__init__(self, name='LogWriter', daemon=True)
+        self.log_queue = log_queue
+        self.stream = stream
+        self.formatter = formatter
+
+    def run(self):
+        while True:
+            record = self.log_queue.get()
+            stop = record is None
+            batch = [] if stop else [record]
+            # Drain whatever else is waiting and write it all at once
+            while not stop and len(batch) < LOG_BATCH_SIZE:
+                try:
+                    record = self.log_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                else:
+                    batch.append(record)
+
+            if batch:
+                self.write_batch(batch)
+            if stop:
+                return
+
+    def write_batch(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception as e:
+                lines.append(f'Unable to format log record {record.msg!r}: {e}')
+        try:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+        except (OSError, ValueError):
+            # Nowhere left to report it
+            pass
+
+    def stop(self):
+        self.log_queue.put(None)
+        self.join()
+
+
+def setup_logging(level: str | int = LOG_LEVEL, stream: TextIO = sys.stdout):
+    """ Routes all logging through the background batching writer. Safe to call more than once. """
+    global _listener
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    if _listener:
+        _listener.stop()
+    _listener = BatchingLogListener(log_queue, stream, StructuredFormatter())
+    _listener.start()
+
+
+def shutdown_logging():
+    """ Writes out anything still queued. """
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
@@ -1,27 +1,61 @@
+import logging
 import os
 import sys
 
-from os import __init__
-from dimmer import Dimmer
+from sunrise_mypyc import select_build
+# Before any module that may be compiled is imported
+build_in_use = select_build()
+
+from dimmer import Dimmer, CALIBRATION_FILENAME
+from sunrise_api import ControlApiServer
 from sunrise_controller import SunriseController
 from sunrise_data import SunriseData
+from sunrise_log import setup_logging, shutdown_logging
+from sunrise_metrics import MetricsServer
+from sunrise_profile import profiler
+from sunrise_renderer import RemoteDisplay
+from sunrise_sync import start_sync
+from sunrise_trace import TraceWriter
 from sunrise_view import OledDisplay
+from sunrise_watchdog import watchdog
 
 
 
 if __name__ == '__main__':
-    ctrl: SunriseController = None
+    ctrl: SunriseController | None = None
+    oled: OledDisplay | RemoteDisplay | None = None
+    setup_logging()
+    logger = logging.getLogger('sunrise_main')
+    logger.info('Running %s', build_in_use)
     try:
-        oled = OledDisplay(1, True)
+        # kill -USR1 starts and stops the sampling profiler
+        profiler.install_signal()
+        MetricsServer().start()
+        # SUNRISE_DISPLAY=process draws the display in its own process, see sunrise_renderer.py
+        if os.environ.get('SUNRISE_DISPLAY', '').lower() == 'process':
+            oled = RemoteDisplay(1)
+        else:
+            oled = OledDisplay(1, True)
         data = SunriseData()
-        dimmer = Dimmer()
-        ctrl = SunriseController(view=oled, data=data, dimmer=dimmer)
+        dimmer = Dimmer(calibration_filename=CALIBRATION_FILENAME)
+        # SUNRISE_TRACE=<file> records every input for replay with sunrise_trace.py
+        trace_filename = os.environ.get('SUNRISE_TRACE')
+        tracer = TraceWriter(trace_filename) if trace_filename else None
+        ctrl = SunriseController(view=oled, data=data, dimmer=dimmer, tracer=tracer)
+        ctrl.api_server = ControlApiServer(ctrl)
+        ctrl.api_server.start()
+        start_sync(ctrl)
+        watchdog.start()
         ctrl.startup()
     except KeyboardInterrupt:
-        print('Interrupted')
+        logger.info('Interrupted')
         try:
             if ctrl:
                 ctrl.shutdown()
+            if oled:
+                # Blanks the display, and stops the renderer process if there is one
+                oled.shutdown()
+            shutdown_logging()
             sys.exit(130)
         except SystemExit:
             os._exit(os.EX_SOFTWARE)
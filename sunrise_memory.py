@@ -0,0 +1,134 @@
+# Memory report.  Shows how much resident memory each of the modules the alarm imports costs, which source files the
+# running controller's allocations come from (tracemalloc) and the process RSS against the budget.  Run on the Pi to
+# see what the real process costs next to pigpiod:
+#
+#   python sunrise_memory.py            Report
+#   python sunrise_memory.py --check    Also exit with status 1 if over budget or a module that should never be
+#                                       loaded (e.g., mypy) was pulled in
+#
+# The controller is built headless with the simulator so the report can run with the display in use by the alarm.
+
+import argparse
+import ast
+import importlib
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from typing import List, Tuple
+
+# Resident set budget for the whole alarm process, including the display stack
+MEMORY_BUDGET_MB: float = 40.0
+# Imported first, in this order, then every module sunrise_main.py imports (see alarm_imports()).  Hardware modules
+# that are not available (e.g., not on a Pi) are reported and skipped.
+MEMORY_IMPORTS: Tuple[str, ...] = ('pigpio', 'PIL.Image', 'PIL.ImageDraw', 'PIL.ImageFont', 'board', 'busio',
+                                   'adafruit_ssd1306')
+MEMORY_MAIN_MODULE: str = 'sunrise_main'
+# Modules that only bloat the resident set and must never be imported by the alarm
+MEMORY_FORBIDDEN_MODULES: Tuple[str, ...] = ('mypy', 'mypyc', 'numpy')
+MEMORY_TOP_FILES: int = 12
+
+
+def rss_kb() -> int:
+    """ Current resident set size of this process. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # Not Linux, peak is the best there is
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def alarm_imports() -> List[str]:
+    """
+    The modules sunrise_main.py imports, read from its source so the list can't fall behind it, in import order and
+    followed by sunrise_main itself, which costs nothing more unless something was missed.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), MEMORY_MAIN_MODULE + '.py')
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    names: List[str] = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.append(node.module)
+    modules = [name for name in dict.fromkeys(names) if name.split('.')[0] not in sys.stdlib_module_names]
+    return modules + [MEMORY_MAIN_MODULE]
+
+
+def import_costs() -> List[Tuple[str, int, int, str]]:
+    """ Imports each module in turn.  Returns (module, RSS increase kB, modules pulled in, error) for each. """
+    costs = []
+    for name in MEMORY_IMPORTS + tuple(alarm_imports()):
+        before_rss = rss_kb()
+        before_modules = len(sys.modules)
+        error = ''
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            # e.g., no I2C board support on this machine
+            error = f'{type(e).__name__}: {e}'
+        costs.append((name, rss_kb() - before_rss, len(sys.modules) - before_modules, error))
+    return costs
+
+
+def controller_allocations(days: float) -> Tuple[List[Tuple[str, int, int]], int]:
+    """
+    Builds a headless controller and runs it for some simulated days while tracing allocations.
+    :return: (file, kB, blocks) of the biggest allocating source files, and the total traced kB
+    """
+    import datetime as dt
+    from sunrise_sim import Simulation
+
+    tracemalloc.start()
+    sim = Simulation(dt.datetime.now(), edit_rate=0.5)
+    sim.run(days)
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    sim.close()
+    stats = snapshot.statistics('filename')
+    total = sum(s.size for s in stats)
+    top = [(os.path.basename(s.traceback[0].filename), s.size // 1024, s.count) for s in stats[:MEMORY_TOP_FILES]]
+    return top, total // 1024
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Report the memory used by the sunrise alarm')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if over budget')
+    parser.add_argument('--budget-mb', type=float, default=MEMORY_BUDGET_MB)
+    parser.add_argument('--days', type=float, default=7, help='Simulated days to run the controller for')
+    args = parser.parse_args(argv)
+
+    start_rss = rss_kb()
+    print(f'Interpreter: {start_rss / 1024:.1f} MB RSS, {len(sys.modules)} modules')
+    print(f'{"Import":<20} {"RSS kB":>8} {"Modules":>8}')
+    for name, kb, modules, error in import_costs():
+        print(f'{name:<20} {kb:>8} {modules:>8}  {error}')
+
+    start_time = time.perf_counter()
+    top, traced_kb = controller_allocations(args.days)
+    print(f'\nAllocations still held after {args.days:g} simulated days '
+          f'({time.perf_counter() - start_time:.1f} s): {traced_kb} kB')
+    print(f'{"File":<36} {"kB":>8} {"Blocks":>8}')
+    for filename, kb, count in top:
+        print(f'{filename:<36} {kb:>8} {count:>8}')
+
+    total_mb = rss_kb() / 1024
+    forbidden = sorted(name for name in sys.modules if name.split('.')[0] in MEMORY_FORBIDDEN_MODULES)
+    print(f'\nTotal: {total_mb:.1f} MB RSS, {len(sys.modules)} modules, budget {args.budget_mb:g} MB')
+    if forbidden:
+        print(f'Modules that should not be loaded: {", ".join(forbidden)}')
+
+    if args.check and (total_mb > args.budget_mb or forbidden):
+        print('FAILED memory check')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
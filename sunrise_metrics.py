@@ -0,0 +1,197 @@
+# Lightweight metrics for a running unit.  Metrics are created once at import time by the modules that use them, so
+# updating one in a hot path is just an attribute update (histograms use a preallocated list of bucket counts).  No
+# locks are taken - an occasional lost update between threads is an acceptable price for keeping the hot paths cheap.
+# The registry is exported in Prometheus text format by MetricsServer over HTTP or a Unix socket.
+
+import bisect
+import http.server
+import logging
+import os
+import socketserver
+import threading
+from typing import Dict, List, Tuple
+
+# Loopback by default, SUNRISE_METRICS_HOST=0.0.0.0 lets a Prometheus server on the network scrape the unit
+METRICS_HOST: str = os.environ.get('SUNRISE_METRICS_HOST', '127.0.0.1')
+METRICS_PORT: int = int(os.environ.get('SUNRISE_METRICS_PORT', 9101))
+
+logger = logging.getLogger(__name__)
+
+# Default histogram buckets in seconds, from sub-millisecond pigpio calls up to multi-second stalls.
+LATENCY_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(labels: Dict[str, str] | None) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'labels', 'value')
+    metric_type = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Dict[str, str] | None = None):
+        self.name = name
+        self.help = help_text
+        self.labels = format_labels(labels)
+        self.value: float = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{self.labels} {self.value}']
+
+
+class Gauge:
+    __slots__ = ('name', 'help', 'labels', 'value')
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: Dict[str, str] | None = None):
+        self.name = name
+        self.help = help_text
+        self.labels = format_labels(labels)
+        self.value: float = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{self.labels} {self.value}']
+
+
+class Histogram:
+    __slots__ = ('name', 'help', 'labels', 'buckets', 'counts', 'sum', 'count')
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                 labels: Dict[str, str] | None = None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket plus the +Inf bucket
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{self.name}_bucket{format_labels(self.labels | {"le": le})} {cumulative}')
+        labels = format_labels(self.labels)
+        lines.append(f'{self.name}_sum{labels} {self.sum}')
+        lines.append(f'{self.name}_count{labels} {self.count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # Metrics with the same name (different labels) are grouped under one HELP/TYPE header
+        self.metrics: Dict[str, List[Counter | Gauge | Histogram]] = {}
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.setdefault(metric.name, []).append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Dict[str, str] | None = None) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Dict[str, str] | None = None) -> Gauge:
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                  labels: Dict[str, str] | None = None) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets, labels))
+
+    def render(self) -> str:
+        """ Returns all metrics in Prometheus text exposition format. """
+        with self.lock:
+            groups = [(name, list(metrics)) for name, metrics in self.metrics.items()]
+
+        lines = []
+        for name, metrics in groups:
+            lines.append(f'# HELP {name} {metrics[0].help}')
+            lines.append(f'# TYPE {name} {metrics[0].metric_type}')
+            for metric in metrics:
+                lines.extend(metric.samples())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+# Process wide registry used by all of the sunrise modules
+registry = MetricsRegistry()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients don't have an address
+        return str(self.client_address) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent, don't log them
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ''
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serves the registry at http://<host>:<port>/metrics, or on a Unix socket if unix_path is given.
+    """
+
+    def __init__(self, port: int = METRICS_PORT, unix_path: str | None = None, host: str = METRICS_HOST):
+        threading.Thread.__init__(self, daemon=True)
+        self.server: socketserver.BaseServer
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            self.server = UnixHTTPServer(unix_path, MetricsRequestHandler)
+            self.address = unix_path
+        else:
+            http_server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+            http_server.daemon_threads = True
+            self.server = http_server
+            self.address = f'{host}:{http_server.server_port}'
+
+    def run(self):
+        logger.info('Serving metrics on %s', self.address)
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,217 @@
+# Optional mypyc build of the controller core.  sunrise_data, dimmer and sunrise_controller (scheduling, ramp and
+# menu logic) are compiled to C extension modules next to their sources.  Python picks an extension module over the
+# .py file of the same name, so nothing else changes; without a build the pure Python sources run as always.
+#
+#   python sunrise_mypyc.py build     Compile (needs mypy from requirements.txt, setuptools and a C compiler)
+#   python sunrise_mypyc.py clean     Remove the compiled modules, back to pure Python
+#   python sunrise_mypyc.py status    Show which modules are compiled and whether any are out of date
+#   python sunrise_mypyc.py bench     Startup time and CPU per button press and per ramp step, interpreted vs compiled
+#
+# A compiled module built from an older source would silently run old code, so the build records a hash of each
+# source and sunrise_main.py calls select_build() first: if any source has changed since the build, or
+# SUNRISE_NO_MYPYC=1 is set, the compiled modules are ignored and the sources are imported instead.  mypy itself is
+# only needed to build, never at run time.
+
+import argparse
+import glob
+import hashlib
+import importlib.machinery
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+# No threading.Thread subclasses in these: a compiled one crashes the interpreter when it is garbage collected
+MYPYC_SOURCES: List[str] = ['sunrise_data.py', 'dimmer.py', 'sunrise_controller.py']
+# The Pi has the display libraries, but without type information
+MYPYC_MYPY_ARGS: List[str] = ['--ignore-missing-imports']
+MYPYC_BENCH_PRESSES: int = 2000
+MYPYC_BENCH_RAMPS: int = 4
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Hash of each source as it was compiled
+_BUILD_RECORD = os.path.join(_DIRECTORY, '.mypyc_build.json')
+
+
+def compiled_files(module: str) -> List[str]:
+    paths = (os.path.join(_DIRECTORY, module + suffix) for suffix in importlib.machinery.EXTENSION_SUFFIXES)
+    return [path for path in paths if os.path.exists(path)]
+
+
+def source_hash(source: str) -> str:
+    with open(os.path.join(_DIRECTORY, source), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_status() -> Dict[str, str]:
+    """ 'compiled', 'stale' (source changed since the build) or 'source' for each compiled module. """
+    try:
+        with open(_BUILD_RECORD) as f:
+            built = json.load(f)
+    except (OSError, ValueError):
+        built = {}
+    status = {}
+    for source in MYPYC_SOURCES:
+        module = source[:-3]
+        if not compiled_files(module):
+            status[module] = 'source'
+        elif built.get(source) != source_hash(source):
+            status[module] = 'stale'
+        else:
+            status[module] = 'compiled'
+    return status
+
+
+def prefer_source():
+    """ Makes imports from this directory ignore extension modules.  Must run before the modules are imported. """
+    loaders = [(importlib.machinery.SourceFileLoader, importlib.machinery.SOURCE_SUFFIXES),
+               (importlib.machinery.SourcelessFileLoader, importlib.machinery.BYTECODE_SUFFIXES)]
+
+    def source_only(path: str) -> importlib.machinery.FileFinder:
+        if os.path.abspath(path or '.') != _DIRECTORY:
+            raise ImportError('not the sunrise directory')
+        return importlib.machinery.FileFinder(path, *loaders)
+
+    sys.path_hooks.insert(0, source_only)
+    sys.path_importer_cache.clear()
+
+
+def select_build() -> str:
+    """
+    Falls back to the pure Python sources if asked to or if the compiled modules are out of date.  Runs before logging
+    is set up, so the choice is returned for the caller to log.
+    :return: Description of the build in use
+    """
+    status = build_status()
+    if os.environ.get('SUNRISE_NO_MYPYC'):
+        prefer_source()
+        return 'pure Python (SUNRISE_NO_MYPYC)'
+    if 'stale' in status.values():
+        prefer_source()
+        return f'pure Python, sources changed since the mypyc build: {status}'
+    if 'compiled' in status.values():
+        return f'compiled modules: {status}'
+    return 'pure Python'
+
+
+def build() -> int:
+    from mypyc.build import mypycify
+    from setuptools import setup
+
+    os.chdir(_DIRECTORY)
+    start_time = time.perf_counter()
+    # Hashed first, a source edited during the build then shows up as stale
+    hashes = {source: source_hash(source) for source in MYPYC_SOURCES}
+    setup(name='sunrise_core', ext_modules=mypycify(MYPYC_MYPY_ARGS + MYPYC_SOURCES, opt_level='3'),
+          script_args=['build_ext', '--inplace'])
+    with open(_BUILD_RECORD, 'wt') as f:
+        json.dump(hashes, f, indent=4)
+    print(f'Built in {time.perf_counter() - start_time:.0f} s: {build_status()}')
+    return 0
+
+
+def clean() -> int:
+    for source in MYPYC_SOURCES:
+        for filename in compiled_files(source[:-3]):
+            os.unlink(filename)
+    # Runtime support library shared by the compiled modules
+    for filename in glob.glob(os.path.join(_DIRECTORY, '*__mypyc.*')):
+        os.unlink(filename)
+    shutil.rmtree(os.path.join(_DIRECTORY, 'build'), ignore_errors=True)
+    if os.path.exists(_BUILD_RECORD):
+        os.unlink(_BUILD_RECORD)
+    print(build_status())
+    return 0
+
+
+def bench_child(interpreted: bool) -> Dict[str, float]:
+    """ Runs in a fresh process so startup includes the imports. """
+    if interpreted:
+        prefer_source()
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    import datetime as dt
+    from sunrise_buttons import ButtonEvent
+    from sunrise_sim import Simulation
+    import sunrise_controller
+    sim = Simulation(dt.datetime(2026, 3, 2, 5, 0), cancel_rate=0.0, edit_rate=0.0)
+    ctrl = sim.ctrl
+    sim.run(0)
+    startup = time.perf_counter() - start
+    startup_cpu = time.process_time() - start_cpu
+
+    # Random walk through the menus, the same for both builds
+    rng = random.Random(1)
+    press_cpu = 0.0
+    for _ in range(MYPYC_BENCH_PRESSES):
+        btn = rng.randint(1, 4)
+        before = time.process_time()
+        ctrl.button_event(btn, ButtonEvent.press)
+        press_cpu += time.process_time() - before
+        sim.pump_display()
+
+    steps = 0
+    step_cpu = 0.0
+    for _ in range(MYPYC_BENCH_RAMPS):
+        ctrl.start_schedule(60)
+        while ctrl.is_running:
+            before = time.process_time()
+            sim.clock.run_next()
+            step_cpu += time.process_time() - before
+            steps += 1
+            sim.pump_display()
+    sim.close()
+
+    from sunrise_memory import rss_kb
+    return {'compiled': not sunrise_controller.__file__.endswith('.py'),
+            'startup_ms': startup * 1000, 'startup_cpu_ms': startup_cpu * 1000,
+            'press_us': press_cpu / MYPYC_BENCH_PRESSES * 1e6, 'step_us': step_cpu / steps * 1e6,
+            'rss_mb': rss_kb() / 1024}
+
+
+def bench() -> int:
+    results = {}
+    for name, args in (('interpreted', ['--interpreted']), ('compiled', [])):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), 'bench-child'] + args,
+                             capture_output=True, text=True, check=True, cwd=_DIRECTORY)
+        results[name] = json.loads(out.stdout.strip().splitlines()[-1])
+    if not results['compiled']['compiled']:
+        print('Not built, run "python sunrise_mypyc.py build" first.  Interpreted only:')
+        del results['compiled']
+
+    print(f'{"":<12} {"Startup ms":>11} {"(CPU ms)":>9} {"Press us":>9} {"Ramp step us":>13} {"RSS MB":>7}')
+    for name, r in results.items():
+        print(f'{name:<12} {r["startup_ms"]:>11.0f} {r["startup_cpu_ms"]:>9.0f} {r["press_us"]:>9.1f} '
+              f'{r["step_us"]:>13.1f} {r["rss_mb"]:>7.1f}')
+    if len(results) == 2:
+        i, c = results['interpreted'], results['compiled']
+        print(f'{"speedup":<12} {i["startup_ms"] / c["startup_ms"]:>10.2f}x {"":>9} {i["press_us"] / c["press_us"]:>8.2f}x '
+              f'{i["step_us"] / c["step_us"]:>12.2f}x')
+    return 0
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Optional mypyc build of the sunrise controller core')
+    parser.add_argument('command', choices=('build', 'clean', 'status', 'bench', 'bench-child'))
+    parser.add_argument('--interpreted', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        return build()
+    if args.command == 'clean':
+        return clean()
+    if args.command == 'status':
+        print(build_status())
+        return 0
+    if args.command == 'bench-child':
+        print(json.dumps(bench_child(args.interpreted)))
+        return 0
+    return bench()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
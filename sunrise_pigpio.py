@@ -0,0 +1,179 @@
+# Shared pigpio daemon connection.  The dimmer and the button callbacks use one connection instead of one each, and
+# PWM writes no longer block the caller on a socket round trip:
+#   - set_PWM_dutycycle() queues the write and returns.  A write of the level the output already has is dropped, and a
+#     write replacing one still waiting in the queue takes its place, since only the last level is ever seen.
+#   - The writer thread sends everything queued in one go and then reads all of the replies, so a burst of commands
+#     (e.g., rapid Dim+/Dim- presses) costs one round trip to the daemon instead of one each.
+#   - Every command's latency, from being queued until its reply, is kept per command in
+#     sunrise_pigpio_command_seconds.
+#
+# The pipelined commands are written to the pi's command socket under the pi's own lock, so other pigpio calls
+# (callbacks, pull ups, PWM frequency) can still be made directly on connection.pi from any thread.  A pi that isn't a
+# connected pigpio.pi, e.g., the simulator's SimPi, gets every write directly and synchronously.
+
+import logging
+import socket
+import struct
+import threading
+import time
+from typing import Dict, List, NamedTuple
+
+import pigpio
+
+from sunrise_metrics import registry, Histogram
+
+# Commands sent in one round trip at most
+PIGPIO_PIPELINE_MAX: int = 32
+# A flush waiting longer than this means the daemon is not answering
+PIGPIO_FLUSH_TIMEOUT_SEC: float = 2.0
+
+# Command and reply are both four 32 bit words: command, p1, p2, p3 / command, p1, p2, result
+_COMMAND = struct.Struct('IIII')
+_REPLY = struct.Struct('IIIi')
+_COMMAND_NAMES = {pigpio._PI_CMD_PWM: 'PWM'}
+
+pigpio_round_trip_seconds = registry.histogram('sunrise_pigpio_call_seconds',
+                                               'Round trip time of a batch of pipelined pigpio commands')
+pigpio_batch_commands = registry.histogram('sunrise_pigpio_batch_commands', 'Commands sent in one round trip',
+                                           buckets=(1, 2, 4, 8, 16, 32))
+pigpio_writes_skipped = registry.counter('sunrise_pigpio_writes_skipped_total',
+                                         'PWM writes dropped because the output already had that level')
+pigpio_writes_coalesced = registry.counter('sunrise_pigpio_writes_coalesced_total',
+                                           'Queued PWM writes replaced by a newer write before they were sent')
+pigpio_errors = registry.counter('sunrise_pigpio_errors_total', 'pigpio commands that failed or were not sent')
+
+logger = logging.getLogger(__name__)
+
+
+class PendingCommand(NamedTuple):
+    cmd: int
+    p1: int
+    p2: int
+    queued: float
+
+
+class PigpioConnection(threading.Thread):
+    """ One pigpio connection, shared by everything that needs the daemon.  See the top of the file. """
+
+    def __init__(self, pi: pigpio.pi | None = None):
+        threading.Thread.__init__(self, name='PigpioWriter', daemon=True)
+        self.pi = pi or pigpio.pi()
+        # Pipelining needs the command socket of a connected pigpio.pi
+        self.pipelined = isinstance(getattr(getattr(self.pi, 'sl', None), 's', None), socket.socket)
+        self.condition = threading.Condition()
+        self.pending: List[PendingCommand] = []
+        self.sending = False
+        self.stopping = False
+        # Last duty cycle written (or queued) per GPIO
+        self.pwm_levels: Dict[int, int] = {}
+        self.command_seconds: Dict[int, Histogram] = {}
+        if self.pipelined:
+            self.start()
+
+    def set_PWM_dutycycle(self, gpio: int, duty_cycle: int):
+        """ Same as pigpio.pi.set_PWM_dutycycle(), but queued unless the output already has this duty cycle. """
+        with self.condition:
+            if self.pwm_levels.get(gpio) == duty_cycle:
+                pigpio_writes_skipped.inc()
+                return
+            self.pwm_levels[gpio] = duty_cycle
+            if not self.pipelined:
+                self.pi.set_PWM_dutycycle(gpio, duty_cycle)
+                return
+            for i, pending in enumerate(self.pending):
+                if pending.cmd == pigpio._PI_CMD_PWM and pending.p1 == gpio:
+                    # Latency counts from the first write the new one replaced
+                    self.pending[i] = pending._replace(p2=duty_cycle)
+                    pigpio_writes_coalesced.inc()
+                    return
+            self.pending.append(PendingCommand(pigpio._PI_CMD_PWM, gpio, duty_cycle, time.perf_counter()))
+            self.condition.notify()
+
+    def forget_levels(self):
+        """ The next write to every output is sent, e.g., after it was changed directly on connection.pi. """
+        with self.condition:
+            self.pwm_levels.clear()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch = self.pending[:PIGPIO_PIPELINE_MAX]
+                del self.pending[:PIGPIO_PIPELINE_MAX]
+                self.sending = True
+            try:
+                self.send(batch)
+            finally:
+                with self.condition:
+                    self.sending = False
+                    self.condition.notify_all()
+
+    def send(self, batch: List[PendingCommand]):
+        """ Sends the commands back to back and then collects the replies, one round trip for all of them. """
+        request = b''.join(_COMMAND.pack(c.cmd, c.p1, c.p2, 0) for c in batch)
+        start_time = time.perf_counter()
+        try:
+            with self.pi.sl.l:
+                sock = self.pi.sl.s
+                sock.sendall(request)
+                replies = bytearray()
+                while len(replies) < len(request):
+                    data = sock.recv(len(request) - len(replies))
+                    if not data:
+                        raise ConnectionError('pigpio daemon closed the connection')
+                    replies += data
+        except (OSError, AttributeError) as e:
+            # AttributeError: the connection was stopped
+            logger.error('Unable to send %s pigpio commands: %s', len(batch), e)
+            pigpio_errors.inc(len(batch))
+            # What the outputs are at is no longer known
+            self.forget_levels()
+            return
+        now = time.perf_counter()
+        pigpio_round_trip_seconds.observe(now - start_time)
+        pigpio_batch_commands.observe(len(batch))
+        for command, (_, _, _, result) in zip(batch, _REPLY.iter_unpack(replies)):
+            self.command_histogram(command.cmd).observe(now - command.queued)
+            if result < 0:
+                pigpio_errors.inc()
+                logger.error('pigpio %s(%s, %s) failed: %s', _COMMAND_NAMES.get(command.cmd, command.cmd),
+                             command.p1, command.p2, pigpio.error_text(result))
+
+    def command_histogram(self, cmd: int) -> Histogram:
+        histogram = self.command_seconds.get(cmd)
+        if histogram is None:
+            histogram = registry.histogram('sunrise_pigpio_command_seconds',
+                                           'Time from queueing a pigpio command until its reply',
+                                           labels={'command': _COMMAND_NAMES.get(cmd, str(cmd))})
+            self.command_seconds[cmd] = histogram
+        return histogram
+
+    def flush(self, timeout: float = PIGPIO_FLUSH_TIMEOUT_SEC) -> bool:
+        """ Waits for the queued commands to be sent.  Returns False on timeout. """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.sending, timeout)
+
+    def stop(self):
+        """ Sends what is queued and closes the connection. """
+        if self.pipelined:
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            self.join(PIGPIO_FLUSH_TIMEOUT_SEC)
+        self.pi.stop()
+
+
+_shared_connection: PigpioConnection | None = None
+_shared_lock = threading.Lock()
+
+
+def shared_connection() -> PigpioConnection:
+    """ The process wide connection to the local pigpio daemon, opened on first use. """
+    global _shared_connection
+    with _shared_lock:
+        if _shared_connection is None:
+            _shared_connection = PigpioConnection()
+        return _shared_connection
@@ -0,0 +1,142 @@
+# On demand sampling profiler.  A unit that feels sluggish can be profiled as it is, without a restart under a
+# profiler losing the state that makes it slow.  Started and stopped by SIGUSR1 (kill -USR1 <pid>, installed by
+# sunrise_main.py) or by holding Menu and On/Off together.
+#
+# While on, a thread takes the stack of every other thread (display, scheduler, ramp timers, pigpio callbacks, button
+# dispatcher, API loop, ...) every PROFILE_INTERVAL_SEC for up to PROFILE_WINDOW_SEC and counts identical stacks.  At
+# the end the counts are written as collapsed stacks, one "thread;outer;...;inner count" line per stack, which
+# flamegraph.pl or speedscope turn into a flame graph:
+#
+#   kill -USR1 $(pgrep -f sunrise_main.py)    # start, and again to stop early
+#   flamegraph.pl sunrise-profile-20260302-061502.folded > profile.svg
+#
+# Only the sampling thread does any work, so the cost is the time it takes to walk the stacks, which is logged with
+# the result.  Nothing runs while the profiler is off.
+
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from types import CodeType, FrameType
+from typing import Dict, List
+
+from sunrise_metrics import registry
+
+PROFILE_INTERVAL_SEC: float = 0.01
+PROFILE_WINDOW_SEC: float = float(os.environ.get('SUNRISE_PROFILE_SEC', 30))
+PROFILE_DIRECTORY: str = os.environ.get('SUNRISE_PROFILE_DIR', '.')
+# Stacks deeper than this are cut at the outer end, the inner frames are the interesting ones
+PROFILE_MAX_DEPTH: int = 64
+
+profile_samples = registry.counter('sunrise_profile_samples_total', 'Stack samples taken by the profiler')
+profile_sample_seconds = registry.histogram('sunrise_profile_sample_seconds', 'Time to sample every thread once')
+
+logger = logging.getLogger(__name__)
+
+
+def thread_label(thread: threading.Thread | None, ident: int) -> str:
+    """ Root frame of a thread's stacks.  Unnamed threads (e.g., each ramp Timer) are grouped by their class. """
+    if thread is None:
+        return f'thread-{ident}'
+    if thread.name.startswith('Thread-'):
+        return type(thread).__name__
+    return thread.name
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL_SEC, window: float = PROFILE_WINDOW_SEC,
+                 directory: str = PROFILE_DIRECTORY):
+        self.interval = interval
+        self.window = window
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+        self.stop_event = threading.Event()
+        # Frame labels by code object, so each function is only formatted once
+        self.labels: Dict[CodeType, str] = {}
+        self.last_filename: str | None = None
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def toggle(self):
+        """ Starts a profile, or stops the running one early.  Safe to call from a signal handler. """
+        # Not blocking, the signal handler may have interrupted a toggle on the main thread
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.is_running():
+                self.stop_event.set()
+                return
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name='Profiler', daemon=True)
+            self.thread.start()
+        finally:
+            self.lock.release()
+
+    def handle_signal(self, signum: int, frame: FrameType | None):
+        self.toggle()
+
+    def install_signal(self, signum: int = signal.SIGUSR1):
+        signal.signal(signum, self.handle_signal)
+
+    def run(self) -> None:
+        logger.info('Profiling all threads for up to %.0f s', self.window)
+        stacks: collections.Counter[str] = collections.Counter()
+        own_ident = threading.get_ident()
+        start_time = time.perf_counter()
+        deadline = start_time + self.window
+        sample_time = 0.0
+        num_samples = 0
+        while not self.stop_event.wait(self.interval) and time.perf_counter() < deadline:
+            sample_start = time.perf_counter()
+            self.sample(stacks, own_ident)
+            elapsed = time.perf_counter() - sample_start
+            profile_sample_seconds.observe(elapsed)
+            sample_time += elapsed
+            num_samples += 1
+        profile_samples.inc(num_samples)
+        wall_time = time.perf_counter() - start_time
+        filename = self.write(stacks)
+        logger.info('Profile of %s samples over %.1f s written to %s, sampling took %.1f%% of one CPU',
+                    num_samples, wall_time, filename, 100 * sample_time / wall_time if wall_time else 0)
+
+    def sample(self, stacks: 'collections.Counter[str]', own_ident: int):
+        threads = {t.ident: t for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            names: List[str] = []
+            current: FrameType | None = frame
+            while current is not None and len(names) < PROFILE_MAX_DEPTH:
+                names.append(self.label(current.f_code))
+                current = current.f_back
+            names.append(thread_label(threads.get(ident), ident))
+            stacks[';'.join(reversed(names))] += 1
+
+    def label(self, code: CodeType) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            name = getattr(code, 'co_qualname', code.co_name)
+            label = f'{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            self.labels[code] = label
+        return label
+
+    def write(self, stacks: 'collections.Counter[str]') -> str | None:
+        filename = os.path.join(self.directory, time.strftime('sunrise-profile-%Y%m%d-%H%M%S.folded'))
+        try:
+            with open(filename, 'wt') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+        except OSError as e:
+            logger.error('Unable to write profile: %s', e)
+            return None
+        self.last_filename = filename
+        return filename
+
+
+# Process wide profiler, the signal handler is installed by sunrise_main
+profiler = SamplingProfiler()
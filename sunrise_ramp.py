@@ -0,0 +1,118 @@
+# Ramp timing recorder.  Every step of a sunrise ramp records when it was planned to run, when it actually ran and the
+# level it set, into arrays that are allocated once, so recording a step is three array stores.  When the sunrise ends,
+# a summary of step jitter, drift and missed steps is logged and added to the event history.
+#
+# The plan is the ramp's own step grid: start time + step number * seconds per step.  Since each step timer is only
+# started once the previous step's work is done, lateness adds up from step to step; that shows up as drift.  The end
+# error compares the last step with the start time plus the configured duration, which also shows the time lost to
+# whole-second step times.
+
+import logging
+from array import array
+from dataclasses import dataclass
+
+from sunrise_metrics import registry
+
+# Enough for a full 0-255 ramp plus a resumed ramp's starting step
+RAMP_MAX_STEPS: int = 512
+
+ramp_drift_seconds = registry.histogram('sunrise_ramp_drift_seconds', 'How far behind plan the last ramp step ran',
+                                        (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+ramp_missed_steps = registry.counter('sunrise_ramp_missed_steps_total', 'Ramp steps that ran a full step late')
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """ Nearest rank percentile of an already sorted list. """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+@dataclass(slots=True)
+class RampSummary:
+    steps: int
+    # Steps that ran at least a whole step late, i.e., the ramp fell a step behind
+    missed_steps: int
+    # Deviation of the time between steps from seconds per step
+    jitter_p50: float
+    jitter_p90: float
+    jitter_p99: float
+    jitter_max: float
+    # How late the last step ran compared to its plan
+    drift: float
+    # When the last step ran compared to start + duration, negative if early
+    end_error: float
+    completed: bool
+
+    def __str__(self):
+        return (f'{self.steps} steps, {self.missed_steps} missed, jitter p50 {self.jitter_p50 * 1000:.1f} ms '
+                f'p90 {self.jitter_p90 * 1000:.1f} ms p99 {self.jitter_p99 * 1000:.1f} ms '
+                f'max {self.jitter_max * 1000:.1f} ms, drift {self.drift:.3f} s, end error {self.end_error:.1f} s')
+
+
+class RampRecorder:
+    __slots__ = ('planned', 'actual', 'levels', 'num_steps', 'start_epoch', 'sec_per_step', 'first_step',
+                 'duration_minutes')
+
+    def __init__(self, max_steps: int = RAMP_MAX_STEPS):
+        self.planned = array('d', bytes(8 * max_steps))
+        self.actual = array('d', bytes(8 * max_steps))
+        self.levels = array('H', bytes(2 * max_steps))
+        self.num_steps = 0
+        self.start_epoch = 0.0
+        self.sec_per_step = 0.0
+        self.first_step = 0
+        self.duration_minutes = 0
+
+    def start(self, start_epoch: float, sec_per_step: float, duration_minutes: int, first_step: int = 0):
+        """
+        Starts recording a ramp.
+        :param start_epoch: When step 0 of the ramp was planned to run
+        :param sec_per_step: Seconds between steps
+        :param duration_minutes: Configured sunrise duration
+        :param first_step: Number of the first step that will be recorded, non-zero for a resumed ramp
+        :return: None
+        """
+        self.num_steps = 0
+        self.start_epoch = start_epoch
+        self.sec_per_step = sec_per_step
+        self.duration_minutes = duration_minutes
+        self.first_step = first_step
+
+    def is_recording(self) -> bool:
+        return self.sec_per_step > 0
+
+    def record(self, level: int, epoch: float):
+        """ Records the next step.  Steps past the end of the arrays are dropped. """
+        i = self.num_steps
+        if i < len(self.actual):
+            self.planned[i] = self.start_epoch + (self.first_step + i) * self.sec_per_step
+            self.actual[i] = epoch
+            self.levels[i] = level
+            self.num_steps = i + 1
+
+    def finish(self, completed: bool) -> RampSummary | None:
+        """ Stops recording and summarizes the ramp.  Returns None if nothing was recorded. """
+        n = self.num_steps
+        sec_per_step = self.sec_per_step
+        self.sec_per_step = 0.0
+        if n == 0 or sec_per_step <= 0:
+            return None
+
+        planned, actual = self.planned, self.actual
+        jitter = sorted(abs(actual[i] - actual[i - 1] - sec_per_step) for i in range(1, n))
+        missed = sum(1 for i in range(n) if actual[i] - planned[i] >= sec_per_step)
+        summary = RampSummary(steps=n, missed_steps=missed, jitter_p50=percentile(jitter, 0.5),
+                              jitter_p90=percentile(jitter, 0.9), jitter_p99=percentile(jitter, 0.99),
+                              jitter_max=jitter[-1] if jitter else 0.0, drift=actual[n - 1] - planned[n - 1],
+                              end_error=actual[n - 1] - (self.start_epoch + self.duration_minutes * 60),
+                              completed=completed)
+        ramp_drift_seconds.observe(max(0.0, summary.drift))
+        ramp_missed_steps.inc(missed)
+        return summary
+
+    def steps(self) -> list:
+        """ (planned, actual, level) of each recorded step. """
+        return [(self.planned[i], self.actual[i], self.levels[i]) for i in range(self.num_steps)]
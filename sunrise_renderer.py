@@ -0,0 +1,316 @@
+# Display rendering in its own process.  PIL text rendering, frame conversion and the I2C transfers otherwise run in
+# the controller's interpreter and compete for the GIL with the ramp timers and button callbacks.  With
+# SUNRISE_DISPLAY=process the controller gets a RemoteDisplay instead of an OledDisplay: it keeps the display state
+# (lines, status, on/off, progress graph levels) and publishes it into a small shared memory region.  A renderer
+# process owns the I2C bus and an OledDisplay, reads the state straight out of the shared buffer and draws it,
+# scrolling the long line itself.
+#
+# The region is a seqlock: the single writer makes the sequence number odd, writes the state and makes it even again.
+# The renderer reads the sequence number, the state and the sequence number again, and reads again if the number was
+# odd or changed.  The controller never waits for the renderer: after each publish it writes a byte to a non-blocking
+# pipe to wake the renderer, and closes the pipe to stop it.  Nothing is shared that a renderer killed part way could
+# leave locked, and a renderer whose controller went away sees the pipe close and exits.
+#
+# Layout, little endian:
+#   sequence      uint32
+#   flags         uint8    RENDER_FLAG_*
+#   max_level     uint8    lamp level at the top of the progress graph
+#   5 x line      uint8 length, RENDER_LINE_BYTES of UTF-8: line1-4 and the status line
+#   levels        OLED_WIDTH x uint8, progress graph level of each column
+
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, List, Tuple
+
+from sunrise_log import setup_logging, shutdown_logging, LOG_LEVEL
+from sunrise_metrics import registry
+from sunrise_view import OledDisplay, ProgressGraph, GRAPH_HEIGHT, OLED_WIDTH
+
+RENDER_LINE_BYTES: int = 128
+RENDER_LINES: int = 5
+# Time between scroll steps of the long line, then the pause once it has scrolled all the way
+RENDER_SCROLL_SEC: float = 0.1
+RENDER_SCROLL_END_SEC: float = 2.0
+# Reads torn by a publish before giving up until the next wake up
+RENDER_READ_RETRIES: int = 100
+RENDER_STOP_SEC: float = 2.0
+# Wake up bytes drained at a time, any number of publishes is one wake up
+RENDER_WAKE_BYTES: int = 4096
+
+RENDER_FLAG_DISPLAY_ON: int = 0x01
+RENDER_FLAG_STATUS_DISPLAY: int = 0x02
+RENDER_FLAG_SCROLL: int = 0x04
+RENDER_FLAG_PROGRESS: int = 0x08
+
+_SEQUENCE = struct.Struct('<I')
+_STATE = struct.Struct('<BB' + f'B{RENDER_LINE_BYTES}s' * RENDER_LINES + f'{OLED_WIDTH}s')
+RENDER_STATE_SIZE: int = _SEQUENCE.size + _STATE.size
+
+display_publishes = registry.counter('sunrise_display_publishes_total', 'Display states published to the renderer')
+display_renderer_restarts = registry.counter('sunrise_display_renderer_restarts_total',
+                                             'Renderer processes restarted after exiting')
+
+logger = logging.getLogger(__name__)
+
+
+def encode_line(line: str | None) -> Tuple[int, bytes]:
+    """ Length and UTF-8 of a line, cut to RENDER_LINE_BYTES.  A character cut in half is dropped when read. """
+    encoded = (line or '').encode()[:RENDER_LINE_BYTES]
+    return len(encoded), encoded
+
+
+class RenderState:
+    """ The shared region.  publish() is only ever called by one writer at a time, read() by one reader. """
+
+    def __init__(self, buf: memoryview | None):
+        if buf is None:
+            raise ValueError('Shared memory is closed')
+        self.buf: memoryview = buf
+
+    def publish(self, flags: int, max_level: int, lines: List[str | None], levels: bytes):
+        fields: list = [flags, min(max(max_level, 0), 255)]
+        for line in lines:
+            fields.extend(encode_line(line))
+        fields.append(levels)
+        sequence = _SEQUENCE.unpack_from(self.buf)[0]
+        _SEQUENCE.pack_into(self.buf, 0, (sequence + 1) & 0xFFFFFFFF)
+        _STATE.pack_into(self.buf, _SEQUENCE.size, *fields)
+        _SEQUENCE.pack_into(self.buf, 0, (sequence + 2) & 0xFFFFFFFF)
+
+    def read(self) -> tuple | None:
+        """ (sequence, flags, max_level, lines, levels), or None if every read was torn by a publish. """
+        for _ in range(RENDER_READ_RETRIES):
+            sequence = _SEQUENCE.unpack_from(self.buf)[0]
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            fields = _STATE.unpack_from(self.buf, _SEQUENCE.size)
+            if _SEQUENCE.unpack_from(self.buf)[0] != sequence:
+                continue
+            lines = [fields[i + 1][:fields[i]].decode(errors='ignore') for i in range(2, 2 + 2 * RENDER_LINES, 2)]
+            return sequence, fields[0], fields[1], lines, fields[-1]
+        return None
+
+
+def run_renderer(name: str, wake, disp_factory: Callable | None, log_level: str | int):
+    """
+    Renderer process: draws each published state on the OLED and scrolls the long line between publishes.
+    :param name: Shared memory name
+    :param wake: Read end of the pipe written after each publish and closed to stop
+    :param disp_factory: Makes the display to draw on, None for the PiOLED
+    :param log_level: Log level for this process
+    :return: None
+    """
+    setup_logging(log_level)
+    shm = SharedMemory(name)
+    state = RenderState(shm.buf)
+    oled = OledDisplay(1, False, disp=disp_factory() if disp_factory else None)
+    logger.info('Display renderer started')
+    sequence_shown = None
+    at_end = True
+    try:
+        while True:
+            scrolling = oled.is_display_on() and oled.scroll and not at_end
+            if wake.poll(RENDER_SCROLL_SEC if scrolling else RENDER_SCROLL_END_SEC):
+                if not os.read(wake.fileno(), RENDER_WAKE_BYTES):
+                    break
+            snapshot = state.read()
+            if snapshot is None or snapshot[0] == sequence_shown:
+                at_end = oled.scroll_line3()
+                continue
+            sequence_shown, flags, max_level, lines, levels = snapshot
+            oled.set_display_lines(*lines[:4])
+            oled.set_status_display_line(lines[4])
+            oled.scroll = bool(flags & RENDER_FLAG_SCROLL)
+            if flags & RENDER_FLAG_STATUS_DISPLAY:
+                oled.enable_status_display()
+            else:
+                oled.disable_status_display()
+            oled.graph.copy_from(levels, max_level, bool(flags & RENDER_FLAG_PROGRESS))
+            if flags & RENDER_FLAG_DISPLAY_ON:
+                oled.display_on = True
+                oled.update_display()
+            elif oled.is_display_on():
+                oled.turn_display_off()
+            at_end = False
+    finally:
+        oled.shutdown()
+        # The buffer's memoryview has to go before the shared memory can close
+        del state
+        shm.close()
+        logger.info('Display renderer stopped')
+        shutdown_logging()
+
+
+class RemoteDisplay:
+    """
+    Stands in for OledDisplay in the controller's process.  Keeps the display state and publishes it for the renderer
+    process on every update; drawing, scrolling and the I2C bus are the renderer's.
+    """
+    __max_line_len__ = 21
+
+    def __init__(self, display_auto_power_off_minutes: int, disp_factory: Callable | None = None):
+        """
+        :param display_auto_power_off_minutes:
+        :param disp_factory: Picklable callable the renderer calls to make its display, None for the PiOLED
+        """
+        self.display_on: bool = True
+        self.display_auto_power_off_minutes: float = display_auto_power_off_minutes
+        self.start_display_time: float = time.time()
+        self.line1: str | None = ''
+        self.line2: str | None = ''
+        self.line3: str | None = ''
+        self.line4: str | None = ''
+        self.scroll: bool = True
+        self.is_status_display = True
+        self.status_display_line = ''
+        self.graph = ProgressGraph(OLED_WIDTH, GRAPH_HEIGHT, drawn=False)
+        self.disp_factory = disp_factory
+        # Progress comes from the dispatcher, everything else from the display thread
+        self.lock = threading.Lock()
+        self.shm = SharedMemory(create=True, size=RENDER_STATE_SIZE)
+        self.state = RenderState(self.shm.buf)
+        # Spawned, a fork would copy the controller's threads and locks mid use
+        self.context = multiprocessing.get_context('spawn')
+        self.process: multiprocessing.process.BaseProcess | None = None
+        self.wake_fd = -1
+        self.stopping = False
+        self.publish()
+        self.start_renderer()
+
+    def start_renderer(self):
+        """ Starts a renderer with a new wake up pipe.  Called with the lock held once there is a renderer. """
+        if self.wake_fd >= 0:
+            os.close(self.wake_fd)
+        reader, writer = self.context.Pipe(duplex=False)
+        self.process = self.context.Process(target=run_renderer, name='DisplayRenderer', daemon=True,
+                                            args=(self.shm.name, reader, self.disp_factory,
+                                                  logging.getLogger().level or LOG_LEVEL))
+        self.process.start()
+        # The renderer has its own copy now
+        reader.close()
+        self.wake_fd = os.dup(writer.fileno())
+        writer.close()
+        os.set_blocking(self.wake_fd, False)
+
+    def publish(self):
+        flags = ((RENDER_FLAG_DISPLAY_ON if self.display_on else 0) |
+                 (RENDER_FLAG_STATUS_DISPLAY if self.is_status_display else 0) |
+                 (RENDER_FLAG_SCROLL if self.scroll else 0) |
+                 (RENDER_FLAG_PROGRESS if self.graph.active else 0))
+        with self.lock:
+            if self.stopping:
+                return
+            self.state.publish(flags, self.graph.max_level,
+                               [self.line1, self.line2, self.line3, self.line4, self.status_display_line],
+                               self.graph.levels)
+            if self.process is None:
+                # The first state, the renderer reads it when it starts
+                return
+            if not self.process.is_alive():
+                logger.error('Display renderer exited with %s, restarting', self.process.exitcode)
+                display_renderer_restarts.inc()
+                self.start_renderer()
+            try:
+                os.write(self.wake_fd, b'\0')
+            except (BlockingIOError, BrokenPipeError):
+                # Already has a wake up waiting, or it just exited and is restarted on the next publish
+                pass
+        display_publishes.inc()
+
+    def set_auto_off_minutes(self, ao_minutes: int):
+        self.display_auto_power_off_minutes = ao_minutes
+
+    def set_display_lines(self, line1: str | None, line2: str | None, line3: str | None, line4: str | None):
+        self.line1, self.line2, self.line3, self.line4 = line1, line2, line3, line4
+
+    def set_line1(self, line1):
+        self.line1 = line1
+
+    def set_line2(self, line2):
+        self.line2 = line2
+
+    def set_line3(self, line3):
+        self.line3 = line3
+
+    def set_line4(self, line4):
+        self.line4 = line4
+
+    def set_status_display_line(self, status):
+        self.status_display_line = status
+
+    def enable_status_display(self):
+        self.is_status_display = True
+
+    def disable_status_display(self):
+        self.is_status_display = False
+
+    def center_line(self, line) -> str:
+        pad = int((self.__max_line_len__ - len(line)) / 2)
+        return f'{" " * pad}{line}'
+
+    def start_progress(self, total_sec: float, max_level: int, start_level: int):
+        self.graph.start(total_sec, max_level, start_level)
+        self.publish()
+
+    def add_progress(self, elapsed_sec: float, level: int):
+        self.graph.add(elapsed_sec, level)
+        self.publish()
+
+    def end_progress(self):
+        self.graph.stop()
+        self.publish()
+
+    def is_progress_shown(self) -> bool:
+        return self.graph.active and self.is_status_display
+
+    def update_display(self) -> None:
+        if self.display_on:
+            self.publish()
+
+    def scroll_line3(self) -> bool:
+        # The renderer scrolls, nothing to do here until the next update
+        return True
+
+    def display_idle_time_reset(self):
+        self.start_display_time = time.time()
+
+    def check_display_idle_off(self):
+        if not self.display_on:
+            return
+        if int((time.time() - self.start_display_time) / 60) < self.display_auto_power_off_minutes:
+            return
+        logger.debug('Auto off display')
+        self.turn_display_off()
+
+    def is_display_on(self):
+        return self.display_on
+
+    def turn_display_on(self):
+        self.start_display_time = time.time()
+        self.display_on = True
+        self.publish()
+
+    def turn_display_off(self):
+        self.display_on = False
+        self.publish()
+
+    def shutdown(self):
+        """ Stops the renderer, which blanks the display, and frees the shared memory. """
+        with self.lock:
+            self.stopping = True
+            if self.wake_fd >= 0:
+                os.close(self.wake_fd)
+                self.wake_fd = -1
+        if self.process:
+            self.process.join(RENDER_STOP_SEC)
+            if self.process.is_alive():
+                self.process.terminate()
+        del self.state
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,413 @@
+# Time-warp simulation of the whole controller.  The real SunriseController, menus, journal and history run against a
+# VirtualClock, a simulated pigpio and a headless display, so weeks of scheduled sunrises, ramps, button cancels,
+# settings edits and daylight saving time changes run in seconds and always the same way for a given seed.
+#
+# While it runs, the simulation checks that:
+#   - the next sunrise is always scheduled for the time the settings say it should be,
+#   - each sunrise starts at its scheduled wall clock time,
+#   - the lamp only gets brighter during a ramp and a ramp that isn't cancelled ends on time with the lamp off,
+# and prints a summary plus any violations.  The exit status is 1 if there were violations.
+#
+#   python sunrise_sim.py --days 28 --start 2026-03-02 --tz America/New_York --seed 7
+
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+from dimmer import Dimmer
+from sunrise_buttons import ButtonEvent
+from sunrise_clock import VirtualClock
+from sunrise_controller import SunriseController
+from sunrise_data import SunriseData, MAX_DURATION_MINUTES, NUM_DAYS
+from sunrise_display import DisplayThread
+from sunrise_history import EventHistory, EventType
+from sunrise_journal import RunJournal
+from sunrise_log import setup_logging, shutdown_logging
+
+SIM_DAYS: int = 14
+SIM_CANCEL_RATE: float = 0.2
+SIM_EDIT_RATE: float = 0.3
+# How far a ramp may end from its duration, for the sum of fractional step times
+SIM_RAMP_END_TOLERANCE_SEC: float = 1.0
+# Default schedule: weekdays at 6:30 for 30 minutes, weekends at 8:00 for 45 minutes, weekend disabled
+SIM_SETTINGS: Dict = {
+    '__type__': 'SunriseSettings',
+    'weekday_sched_enabled': True,
+    'weekend_sched_enabled': False,
+    'daily_sched_enabled': False,
+    'days': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+    'start_time': ['06:30'] * 5 + ['08:00'] * 2,
+    'duration_minutes': [30] * 5 + [45] * 2,
+    'auto_off_minutes': 3,
+}
+# Button numbers used by the simulated user
+ON_OFF_BUTTON = 4
+
+logger = logging.getLogger(__name__)
+
+
+class SimPi:
+    """ Stands in for pigpio.pi.  Keeps the PWM duty cycle so the lamp level can be checked. """
+
+    def __init__(self) -> None:
+        self.connected = True
+        self.duty_cycle: Dict[int, int] = {}
+        self.num_writes = 0
+
+    def set_PWM_dutycycle(self, gpio: int, duty_cycle: int):
+        self.duty_cycle[gpio] = duty_cycle
+        self.num_writes += 1
+
+    def set_PWM_frequency(self, gpio: int, frequency: int):
+        pass
+
+    def set_pull_up_down(self, gpio: int, pud: int):
+        pass
+
+    def set_glitch_filter(self, gpio: int, steady: int):
+        pass
+
+    def callback(self, gpio: int, edge: int, fn: Callable):
+        # Button presses are injected straight into the controller
+        pass
+
+    def stop(self):
+        pass
+
+
+class HeadlessDisplay:
+    """ Stands in for OledDisplay.  Keeps the lines instead of drawing them and uses the simulated clock. """
+    __max_line_len__ = 21
+
+    def __init__(self, clock: VirtualClock, display_auto_power_off_minutes: int):
+        self.clock = clock
+        self.display_on: bool = True
+        self.display_auto_power_off_minutes: float = display_auto_power_off_minutes
+        self.start_display_time: float = clock.time()
+        self.line1: str | None = ''
+        self.line2: str | None = ''
+        self.line3: str | None = ''
+        self.line4: str | None = ''
+        self.scroll: bool = True
+        self.is_status_display = True
+        self.status_display_line = ''
+        self.num_frames = 0
+        self.progress_active = False
+        self.progress_points = 0
+
+    def set_auto_off_minutes(self, ao_minutes: int):
+        self.display_auto_power_off_minutes = ao_minutes
+
+    def set_display_lines(self, line1: str | None, line2: str | None, line3: str | None, line4: str | None):
+        self.line1, self.line2, self.line3, self.line4 = line1, line2, line3, line4
+
+    def set_line1(self, line1):
+        self.line1 = line1
+
+    def set_line2(self, line2):
+        self.line2 = line2
+
+    def set_line3(self, line3):
+        self.line3 = line3
+
+    def set_line4(self, line4):
+        self.line4 = line4
+
+    def set_status_display_line(self, status):
+        self.status_display_line = status
+
+    def enable_status_display(self):
+        self.is_status_display = True
+
+    def disable_status_display(self):
+        self.is_status_display = False
+
+    def center_line(self, line) -> str:
+        pad = int((self.__max_line_len__ - len(line)) / 2)
+        return f'{" " * pad}{line}'
+
+    def start_progress(self, total_sec: float, max_level: int, start_level: int):
+        self.progress_active = True
+        self.progress_points = 1
+
+    def add_progress(self, elapsed_sec: float, level: int):
+        if self.progress_active:
+            self.progress_points += 1
+
+    def end_progress(self):
+        self.progress_active = False
+
+    def update_display(self):
+        if self.display_on:
+            self.num_frames += 1
+
+    def scroll_line3(self) -> bool:
+        return False
+
+    def display_idle_time_reset(self):
+        self.start_display_time = self.clock.time()
+
+    def check_display_idle_off(self):
+        if self.display_on and (self.clock.time() - self.start_display_time) / 60 >= self.display_auto_power_off_minutes:
+            self.display_on = False
+
+    def is_display_on(self):
+        return self.display_on
+
+    def turn_display_on(self):
+        self.start_display_time = self.clock.time()
+        self.display_on = True
+        self.update_display()
+
+    def shutdown(self):
+        pass
+
+
+@dataclass
+class SimResult:
+    virtual_seconds: float = 0.0
+    wall_seconds: float = 0.0
+    calls_run: int = 0
+    sunrises_started: int = 0
+    sunrises_completed: int = 0
+    sunrises_cancelled: int = 0
+    schedule_edits: int = 0
+    ramp_steps: int = 0
+    violations: List[str] = field(default_factory=list)
+
+    def summary(self) -> str:
+        speedup = self.virtual_seconds / self.wall_seconds if self.wall_seconds else 0
+        lines = [f'Simulated {self.virtual_seconds / 86400:.1f} days in {self.wall_seconds:.2f} s '
+                 f'({speedup:,.0f}x real time, {self.calls_run} timer calls)',
+                 f'Sunrises: {self.sunrises_started} started, {self.sunrises_completed} completed, '
+                 f'{self.sunrises_cancelled} cancelled; {self.ramp_steps} ramp steps, {self.schedule_edits} edits',
+                 f'Violations: {len(self.violations)}']
+        lines.extend(f'  {v}' for v in self.violations)
+        return '\n'.join(lines)
+
+
+class Simulation:
+    def __init__(self, start: dt.datetime, settings: Dict | None = None, seed: int = 0,
+                 cancel_rate: float = SIM_CANCEL_RATE, edit_rate: float = SIM_EDIT_RATE, directory: str | None = None,
+                 clock: VirtualClock | None = None):
+        """
+        :param start: Local time the simulation starts at
+        :param settings: Initial settings, same layout as settings.json
+        :param seed: Random seed for the simulated user's cancels and edits
+        :param cancel_rate: Chance that a sunrise is cancelled part way through with the On/Off button
+        :param edit_rate: Chance per day of a random schedule edit
+        :param directory: Where the settings, journal and history files go, a temporary directory by default
+        :param clock: Clock to run on, e.g., one that times the calls, a VirtualClock at start by default
+        """
+        self.random = random.Random(seed)
+        self.cancel_rate = cancel_rate
+        self.edit_rate = edit_rate
+        self.result = SimResult()
+        if directory is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix='sunrise_sim_')
+            directory = self.tmp_dir.name
+        settings_filename = os.path.join(directory, 'settings.json')
+        with open(settings_filename, 'wt') as f:
+            json.dump(settings or SIM_SETTINGS, f)
+
+        self.clock = clock or VirtualClock(start.timestamp())
+        self.pi = SimPi()
+        data = SunriseData(settings_filename)
+        self.view = HeadlessDisplay(self.clock, data.settings.auto_off_minutes)
+        self.ctrl = SunriseController(self.view, data, Dimmer(self.pi), clock=self.clock, pi=self.pi,
+                                      journal=RunJournal(os.path.join(directory, 'sunrise_run.journal')),
+                                      history=EventHistory(os.path.join(directory, 'sunrise_history.bin'),
+                                                           time_fn=self.clock.time))
+        # The display thread is not started, its messages are handled after each timer call instead
+        self.ctrl.disp_thread = DisplayThread(self.view, data, self.ctrl.ctrl_event)
+        self.ctrl.add_state_listener(self.state_changed)
+        self.ramp_start: float | None = None
+        self.ramp_duration_minutes = 0
+        self.ramp_level = 0
+        self.cancel_pending = False
+
+    def run(self, days: float) -> SimResult:
+        wall_start = time.perf_counter()
+        start_epoch = self.clock.time()
+        end_epoch = start_epoch + days * 86400
+        self.ctrl.startup_check_schedule()
+        self.pump_display()
+        self.check_next_scheduled()
+        # One possible edit per simulated day, at a random time of day
+        day_start = start_epoch
+        while day_start < end_epoch:
+            if self.random.random() < self.edit_rate:
+                self.clock.call_at(day_start + self.random.uniform(0, 86400), self.random_edit)
+            day_start += 86400
+        self.clock.run_until(end_epoch, self.after_call)
+
+        r = self.result
+        r.virtual_seconds = end_epoch - start_epoch
+        r.wall_seconds = time.perf_counter() - wall_start
+        r.calls_run = self.clock.calls_run
+        history = self.ctrl.history
+        r.sunrises_started = history.count(EventType.sunrise_start, start_epoch, end_epoch)
+        r.sunrises_completed = history.count(EventType.sunrise_complete, start_epoch, end_epoch)
+        r.sunrises_cancelled = history.count(EventType.sunrise_cancel, start_epoch, end_epoch)
+        r.schedule_edits = history.count(EventType.schedule_change, start_epoch, end_epoch)
+        return r
+
+    def violation(self, message: str):
+        when = self.clock.now().strftime('%a %Y-%m-%d %H:%M:%S')
+        self.result.violations.append(f'{when}: {message}')
+
+    def after_call(self):
+        self.pump_display()
+        if not self.ctrl.is_running:
+            self.check_next_scheduled()
+
+    def pump_display(self):
+        """ Handles the display thread's messages the way its run loop would. """
+        disp_thread = self.ctrl.disp_thread
+        while not disp_thread.msg_q.empty():
+            msg = disp_thread.msg_q.get_nowait()
+            if msg == disp_thread.wake:
+                self.view.turn_display_on()
+            elif msg == disp_thread.auto_off:
+                self.view.set_auto_off_minutes(disp_thread.auto_off_minutes)
+        self.view.check_display_idle_off()
+
+    def expected_next_start(self) -> dt.datetime | None:
+        """ Works out the next sunrise from the settings, independently of the controller's scheduling code. """
+        settings = self.ctrl.settings
+        now = self.clock.now()
+        for day_offset in range(NUM_DAYS + 1):
+            day = now.date() + dt.timedelta(days=day_offset)
+            if not self.ctrl.is_schedule_enabled_for_day(day.weekday()) or not self.ctrl.is_schedule_enabled():
+                continue
+            start = dt.datetime.combine(day, dt.datetime.strptime(settings.start_time[day.weekday()], '%H:%M').time())
+            if start > now:
+                return start
+        return None
+
+    def check_next_scheduled(self):
+        expected = self.expected_next_start()
+        event = self.ctrl.sunrise_event
+        if expected is None:
+            if event is not None and not event.cancelled:
+                self.violation(f'sunrise scheduled at {dt.datetime.fromtimestamp(event.when)} but none expected')
+        elif event is None or event.cancelled:
+            self.violation(f'no sunrise scheduled, expected {expected}')
+        elif event.when != expected.timestamp():
+            self.violation(f'sunrise scheduled at {dt.datetime.fromtimestamp(event.when)}, expected {expected}')
+
+    def state_changed(self):
+        level = self.ctrl.dimmer.get_level()
+        if self.ctrl.is_running and self.ramp_start is None:
+            self.sunrise_started()
+        elif self.ctrl.is_running:
+            if level < self.ramp_level:
+                self.violation(f'lamp level went down during sunrise: {self.ramp_level} -> {level}')
+            self.result.ramp_steps += level != self.ramp_level
+        elif self.ramp_start is not None:
+            self.sunrise_ended()
+        self.ramp_level = level
+
+    def sunrise_started(self):
+        now = self.clock.now()
+        settings = self.ctrl.settings
+        self.ramp_start = self.clock.time()
+        # The running state changes before the controller records the duration
+        self.ramp_duration_minutes = settings.duration_minutes[now.weekday()]
+        expected = settings.start_time[now.weekday()]
+        expected_start = dt.datetime.combine(now.date(), dt.datetime.strptime(expected, '%H:%M').time())
+        # Compared as epoch time, a start time skipped by a daylight saving change runs an hour later on the clock
+        if self.clock.time() != expected_start.timestamp():
+            self.violation(f'sunrise started at {now.strftime("%H:%M:%S")}, settings say {expected}')
+        if self.random.random() < self.cancel_rate:
+            self.cancel_pending = True
+            self.clock.call_later(self.random.uniform(0, self.ramp_duration_minutes * 60), self.press_on_off)
+
+    def sunrise_ended(self):
+        elapsed = self.clock.time() - self.ramp_start
+        if self.cancel_pending:
+            self.cancel_pending = False
+        elif abs(elapsed - self.ramp_duration_minutes * 60) > SIM_RAMP_END_TOLERANCE_SEC:
+            self.violation(f'{self.ramp_duration_minutes} minute sunrise took {elapsed / 60:.1f} minutes')
+        if self.ctrl.dimmer.is_on():
+            # The lamp is turned off just after the running state changes
+            self.clock.call_later(0, self.check_lamp_off)
+        self.ramp_start = None
+
+    def check_lamp_off(self):
+        if self.ctrl.dimmer.is_on():
+            self.violation('lamp still on after sunrise ended')
+
+    def press_on_off(self):
+        if not self.ctrl.is_running:
+            # Already over
+            self.cancel_pending = False
+            return
+        if not self.view.is_display_on():
+            # The first press only wakes up the display
+            self.ctrl.button_event(ON_OFF_BUTTON, ButtonEvent.press)
+            self.pump_display()
+        self.ctrl.button_event(ON_OFF_BUTTON, ButtonEvent.press)
+
+    def random_edit(self):
+        day = self.random.randrange(NUM_DAYS)
+        change = self.random.choice(['start_time', 'duration_minutes', 'enable'])
+        if change == 'start_time':
+            changes = {'start_time': {day: f'{self.random.randrange(24):02d}:{self.random.randrange(60):02d}'}}
+        elif change == 'duration_minutes':
+            changes = {'duration_minutes': {day: self.random.randint(1, MAX_DURATION_MINUTES)}}
+        else:
+            enable = self.random.choice(['weekday_sched_enabled', 'weekend_sched_enabled', 'daily_sched_enabled'])
+            changes = {key: key == enable for key in
+                       ('weekday_sched_enabled', 'weekend_sched_enabled', 'daily_sched_enabled')}
+        logger.info('Settings edit: %s', changes)
+        self.ctrl.update_settings(changes)
+
+    def close(self):
+        self.ctrl.journal.close()
+        self.ctrl.history.close()
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Run the sunrise controller against a simulated clock')
+    parser.add_argument('--days', type=float, default=SIM_DAYS, help='Days to simulate')
+    parser.add_argument('--start', default=None, help='Local start time, e.g., 2026-03-02 or 2026-03-02T05:00. '
+                                                      'Defaults to now')
+    parser.add_argument('--tz', default=None, help='Time zone, e.g., America/New_York to include DST changes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cancel-rate', type=float, default=SIM_CANCEL_RATE)
+    parser.add_argument('--edit-rate', type=float, default=SIM_EDIT_RATE)
+    parser.add_argument('--settings', default=None, help='Settings file to start with instead of the default')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    if args.tz:
+        os.environ['TZ'] = args.tz
+        time.tzset()
+    start = dt.datetime.fromisoformat(args.start) if args.start else dt.datetime.now()
+    settings = None
+    if args.settings:
+        with open(args.settings) as f:
+            settings = json.load(f)
+
+    setup_logging(args.log_level, sys.stderr)
+    sim = Simulation(start, settings, args.seed, args.cancel_rate, args.edit_rate)
+    try:
+        result = sim.run(args.days)
+    finally:
+        sim.close()
+        shutdown_logging()
+    print(result.summary())
+    return 1 if result.violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
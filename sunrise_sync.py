@@ -0,0 +1,251 @@
+# Synchronized sunrises across rooms.  One unit is the leader: whenever its sunrise starts or stops it multicasts its
+# ramp plan, and while the sunrise runs it sends a progress beacon every SYNC_BEACON_SEC.  Followers that hear a plan
+# join the ramp on the same step grid (converted to their own clock), so their lamps step together with the leader's.
+# Each beacon carries the leader's current level; a follower that is off by more than SYNC_MAX_LEVEL_ERROR snaps to it,
+# which bounds the error even if a follower's timers run late.  If the leader goes quiet, followers finish the ramp
+# on their own from the plan they have.
+#
+# Every message is the same 48 byte datagram, so a beacon a second is negligible traffic.  Multicast is sent with a
+# TTL of 1 (local network only) and loopback enabled, so several units can also run on one machine for testing with
+# interface='127.0.0.1'.
+#
+# Configured from the environment by start_sync(): SUNRISE_SYNC=leader|follower, SUNRISE_SYNC_GROUP,
+# SUNRISE_SYNC_PORT and SUNRISE_SYNC_INTERFACE.
+
+import collections
+import logging
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+from sunrise_journal import RunState, STATE_RUNNING, CURVE_LINEAR
+from sunrise_metrics import registry
+
+SYNC_GROUP: str = '239.255.77.77'
+SYNC_PORT: int = 5077
+SYNC_BEACON_SEC: float = 1.0
+# Follower gives up on a leader it hasn't heard from for this long, and keeps going on the last plan
+SYNC_LEADER_TIMEOUT_SEC: float = 5.0
+# Allowed level difference from the leader, in addition to one step of the ramp (the two can be either side of a step)
+SYNC_MAX_LEVEL_ERROR: int = 2
+# Number of recent beacons used to estimate the leader's clock offset
+SYNC_OFFSET_WINDOW: int = 16
+
+SYNC_MAGIC = b'SRS1'
+SYNC_VERSION = 1
+MSG_PLAN = 1
+MSG_BEACON = 2
+
+# magic, version, message type, running, unit id, sequence, time sent, ramp start, seconds per step, duration minutes,
+# start level, step size, current level
+_MESSAGE = struct.Struct('<4sBBBxIIdddHHHH')
+
+sync_sent = registry.counter('sunrise_sync_messages_sent_total', 'Sync plans and beacons sent')
+sync_received = registry.counter('sunrise_sync_messages_received_total', 'Sync plans and beacons received')
+sync_corrections = registry.counter('sunrise_sync_corrections_total', 'Follower level corrections')
+sync_level_error = registry.gauge('sunrise_sync_level_error', 'Follower level minus leader level at the last beacon')
+
+logger = logging.getLogger(__name__)
+
+
+class SyncMessage:
+    __slots__ = ('msg_type', 'running', 'unit_id', 'sequence', 'sent_epoch', 'start_epoch', 'sec_per_step',
+                 'duration_minutes', 'start_level', 'step_size', 'level')
+
+    def __init__(self, msg_type: int, running: bool, unit_id: int, sequence: int, sent_epoch: float,
+                 start_epoch: float = 0.0, sec_per_step: float = 0.0, duration_minutes: int = 0, start_level: int = 0,
+                 step_size: int = 0, level: int = 0):
+        self.msg_type = msg_type
+        self.running = running
+        self.unit_id = unit_id
+        self.sequence = sequence
+        self.sent_epoch = sent_epoch
+        self.start_epoch = start_epoch
+        self.sec_per_step = sec_per_step
+        self.duration_minutes = duration_minutes
+        self.start_level = start_level
+        self.step_size = step_size
+        self.level = level
+
+    def pack(self) -> bytes:
+        return _MESSAGE.pack(SYNC_MAGIC, SYNC_VERSION, self.msg_type, self.running, self.unit_id, self.sequence,
+                             self.sent_epoch, self.start_epoch, self.sec_per_step, self.duration_minutes,
+                             self.start_level, self.step_size, self.level)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> 'SyncMessage | None':
+        """ Returns None for anything that isn't a sync message of our version. """
+        if len(data) != _MESSAGE.size:
+            return None
+        magic, version, msg_type, running, *rest = _MESSAGE.unpack(data)
+        if magic != SYNC_MAGIC or version != SYNC_VERSION:
+            return None
+        return cls(msg_type, bool(running), *rest)
+
+    def plan(self, offset: float) -> RunState:
+        """ The leader's ramp with its times moved onto our clock. """
+        return RunState(STATE_RUNNING, CURVE_LINEAR, self.start_epoch + offset, self.duration_minutes,
+                        self.start_level, self.step_size, self.sec_per_step, self.level, self.sent_epoch + offset)
+
+
+def open_socket(group: str, port: int, interface: str, receive: bool) -> socket.socket:
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    if receive:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # More than one unit on the same machine
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(('', port))
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                     socket.inet_aton(group) + socket.inet_aton(interface))
+    return s
+
+
+class SyncLeader(threading.Thread):
+    def __init__(self, controller, group: str = SYNC_GROUP, port: int = SYNC_PORT, interface: str = '0.0.0.0'):
+        threading.Thread.__init__(self, name='SyncLeader', daemon=True)
+        self.controller = controller
+        self.address = (group, port)
+        self.socket = open_socket(group, port, interface, receive=False)
+        self.unit_id = random.getrandbits(32)
+        self.sequence = 0
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.last_running = False
+        controller.add_state_listener(self.state_changed)
+
+    def state_changed(self):
+        # Called on every ramp step, only a start or stop needs an immediate message
+        if self.controller.is_running != self.last_running:
+            self.wake.set()
+
+    def run(self):
+        logger.info('Sync leader %08x sending to %s:%s', self.unit_id, *self.address)
+        while not self.stop_event.is_set():
+            woken = self.wake.wait(SYNC_BEACON_SEC)
+            self.wake.clear()
+            running = self.controller.is_running
+            if running or running != self.last_running:
+                self.send(MSG_PLAN if woken else MSG_BEACON)
+            self.last_running = running
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake.set()
+
+    def message(self, msg_type: int) -> SyncMessage:
+        self.sequence += 1
+        now = self.controller.clock.time()
+        state = self.controller.journal.load() if self.controller.is_running else None
+        if state is None or not state.is_running():
+            return SyncMessage(msg_type, False, self.unit_id, self.sequence, now)
+        return SyncMessage(msg_type, True, self.unit_id, self.sequence, now, state.start_epoch, state.sec_per_step,
+                           state.duration_minutes, state.start_level, state.step_size,
+                           self.controller.dimmer.get_level())
+
+    def send(self, msg_type: int):
+        try:
+            self.socket.sendto(self.message(msg_type).pack(), self.address)
+            sync_sent.inc()
+        except OSError as e:
+            # e.g., network not up yet, try again with the next beacon
+            logger.warning('Unable to send sync message: %s', e)
+
+
+class SyncFollower(threading.Thread):
+    def __init__(self, controller, group: str = SYNC_GROUP, port: int = SYNC_PORT, interface: str = '0.0.0.0'):
+        threading.Thread.__init__(self, name='SyncFollower', daemon=True)
+        self.controller = controller
+        self.socket = open_socket(group, port, interface, receive=True)
+        self.socket.settimeout(SYNC_BEACON_SEC)
+        self.leader_id: int | None = None
+        self.leader_heard = 0.0
+        # The leader ramp being followed, on our clock
+        self.followed_plan: RunState | None = None
+        # Our clock minus the leader's, including the network delay.  The smallest recent value is the best estimate.
+        self.offsets: collections.deque[float] = collections.deque(maxlen=SYNC_OFFSET_WINDOW)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        logger.info('Sync follower listening on port %s', self.socket.getsockname()[1])
+        while not self.stop_event.is_set():
+            try:
+                data = self.socket.recv(_MESSAGE.size + 1)
+            except socket.timeout:
+                self.check_leader()
+                continue
+            message = SyncMessage.unpack(data)
+            if message is not None:
+                sync_received.inc()
+                self.handle(message, self.controller.clock.time())
+
+    def stop(self):
+        self.stop_event.set()
+
+    def check_leader(self):
+        if self.leader_id is not None and time.monotonic() - self.leader_heard > SYNC_LEADER_TIMEOUT_SEC:
+            logger.warning('Lost sync leader %08x, continuing on its last plan', self.leader_id)
+            self.leader_id = None
+            self.offsets.clear()
+
+    def handle(self, message: SyncMessage, received_epoch: float):
+        if self.leader_id is None:
+            logger.info('Following sync leader %08x', message.unit_id)
+            self.leader_id = message.unit_id
+        elif message.unit_id != self.leader_id:
+            return
+        self.leader_heard = time.monotonic()
+        self.offsets.append(received_epoch - message.sent_epoch)
+        offset = min(self.offsets)
+
+        if not message.running:
+            plan = self.followed_plan
+            self.followed_plan = None
+            # A leader that finished its ramp is at most a step ahead of us, let ours finish on its own
+            if plan is not None and message.sent_epoch + offset < plan.end_epoch() - plan.sec_per_step:
+                self.controller.submit(self.controller.stop_following)
+            return
+
+        plan = message.plan(offset)
+        if self.followed_plan is None or abs(plan.start_epoch - self.followed_plan.start_epoch) > plan.sec_per_step:
+            # A new sunrise, not just a better offset estimate.  Only joined once, so a sunrise turned off here
+            # stays off.
+            self.followed_plan = plan
+            self.controller.submit(self.controller.follow_ramp, plan)
+            return
+        if not self.controller.following:
+            return
+
+        # Lamps can be a step apart around a step boundary, anything more gets corrected
+        error = self.controller.dimmer.get_level() - message.level
+        sync_level_error.set(error)
+        if abs(error) > message.step_size + SYNC_MAX_LEVEL_ERROR:
+            sync_corrections.inc()
+            logger.debug('Correcting level by %s to %s', -error, message.level)
+            self.controller.submit(self.controller.set_followed_level, message.level)
+
+
+def start_sync(controller) -> SyncLeader | SyncFollower | None:
+    """ Starts sync if configured by SUNRISE_SYNC=leader|follower. """
+    role = os.environ.get('SUNRISE_SYNC', '').lower()
+    if not role:
+        return None
+    group = os.environ.get('SUNRISE_SYNC_GROUP', SYNC_GROUP)
+    port = int(os.environ.get('SUNRISE_SYNC_PORT', SYNC_PORT))
+    interface = os.environ.get('SUNRISE_SYNC_INTERFACE', '0.0.0.0')
+    sync: SyncLeader | SyncFollower
+    if role == 'leader':
+        sync = SyncLeader(controller, group, port, interface)
+    elif role == 'follower':
+        sync = SyncFollower(controller, group, port, interface)
+    else:
+        logger.error('Unknown SUNRISE_SYNC role: %s', role)
+        return None
+    sync.start()
+    return sync
@@ -0,0 +1,285 @@
+# Input trace recording and replay.  Bugs that depend on the exact order of button edges, ramp timer firings and the
+# sunrise start can't be reproduced by hand, so the controller can record every external input to a compact binary
+# trace (SUNRISE_TRACE=<file> for sunrise_main.py):
+#   - the settings and the run journal as loaded at startup,
+#   - every button edge with its pigpio tick,
+#   - every ramp timer and sunrise start scheduler firing, in the order they actually ran,
+#   - settings changes from the control API.
+# Other control API commands and sync are not recorded.
+#
+# Replay feeds the trace back into a real SunriseController on the simulator's VirtualClock.  Time jumps straight from
+# one input to the next, edges go through the same debouncer as on the Pi, and timers fire in the recorded order
+# instead of whenever they fall due, so a replay runs the same way every time and as fast as the controller can go.
+# A recorded firing that the replayed controller has no timer for is reported as a divergence.
+#
+#   python sunrise_trace.py dump trace.bin
+#   python sunrise_trace.py replay trace.bin [--repeat 10]
+#
+# File layout: magic and version, then records of a fixed header (type, gpio, level or payload length, tick, epoch)
+# followed by the payload: JSON for settings and journal, the callback name for timers.
+
+import argparse
+import dataclasses
+import datetime as dt
+import json
+import logging
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Iterator, List, NamedTuple
+
+from sunrise_buttons import ButtonDebouncer
+from sunrise_clock import Clock
+from sunrise_data import SunriseData
+from sunrise_journal import RunState
+
+TRACE_MAGIC = b'SRT1'
+TRACE_VERSION = 1
+
+REC_SETTINGS = 1
+REC_JOURNAL = 2
+REC_STARTUP = 3
+REC_EDGE = 4
+REC_TIMER = 5
+REC_SCHEDULED = 6
+REC_SETTINGS_CHANGE = 7
+REC_NAMES = {REC_SETTINGS: 'settings', REC_JOURNAL: 'journal', REC_STARTUP: 'startup', REC_EDGE: 'edge',
+             REC_TIMER: 'timer', REC_SCHEDULED: 'scheduled', REC_SETTINGS_CHANGE: 'settings_change'}
+
+_HEADER = struct.Struct('<4sH')
+# type, gpio, level (edges) or payload length, tick, epoch
+_RECORD = struct.Struct('<BBHId')
+
+logger = logging.getLogger(__name__)
+
+
+class TraceRecord(NamedTuple):
+    rec_type: int
+    gpio: int
+    level: int
+    tick: int
+    epoch: float
+    payload: bytes
+
+    def __str__(self):
+        text = f'{self.epoch:.6f} {REC_NAMES.get(self.rec_type, self.rec_type)}'
+        if self.rec_type == REC_EDGE:
+            return f'{text} gpio {self.gpio} level {self.level} tick {self.tick}'
+        return f'{text} {self.payload.decode()}' if self.payload else text
+
+
+class TraceWriter:
+    """ Appends records to a trace file.  Safe to call from the pigpio callback, timer and scheduler threads. """
+
+    def __init__(self, filename: str, time_fn: Callable[[], float] = time.time):
+        self.filename = filename
+        self.time_fn = time_fn
+        self.lock = threading.Lock()
+        self.file = open(filename, 'wb')
+        self.file.write(_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self.num_records = 0
+
+    def record(self, rec_type: int, gpio: int = 0, level: int = 0, tick: int = 0, payload: bytes = b''):
+        if payload:
+            level = len(payload)
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(_RECORD.pack(rec_type, gpio, level, tick, self.time_fn()) + payload)
+            # Each record goes to the OS right away so a trace survives the crash it is meant to explain
+            self.file.flush()
+            self.num_records += 1
+
+    def record_settings(self, data: SunriseData):
+        s = {'__type__': 'SunriseSettings'} | data.settings_dict()
+        self.record(REC_SETTINGS, payload=json.dumps(s, separators=(',', ':')).encode())
+
+    def record_settings_change(self, changes: dict):
+        self.record(REC_SETTINGS_CHANGE, payload=json.dumps(changes, separators=(',', ':')).encode())
+
+    def record_journal(self, state: RunState | None):
+        if state is not None:
+            self.record(REC_JOURNAL, payload=json.dumps(dataclasses.asdict(state), separators=(',', ':')).encode())
+
+    def edge_callback(self, put_edge: Callable[[int, int, int], None]) -> Callable[[int, int, int], None]:
+        """ Wraps a pigpio edge callback so every edge is recorded before it is handled. """
+        def traced_edge(gpio: int, level: int, tick: int):
+            self.record(REC_EDGE, gpio, level, tick)
+            put_edge(gpio, level, tick)
+        return traced_edge
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class TracingClock(Clock):
+    """ Passes everything to another clock and records when each of its calls actually runs. """
+
+    def __init__(self, clock: Clock, writer: TraceWriter):
+        self.clock = clock
+        self.writer = writer
+
+    def time(self) -> float:
+        return self.clock.time()
+
+    def now(self):
+        return self.clock.now()
+
+    def call_later(self, delay: float, fn: Callable, *args):
+        return self.clock.call_later(delay, self.traced(REC_TIMER, fn), *args)
+
+    def call_at(self, epoch: float, fn: Callable, *args):
+        return self.clock.call_at(epoch, self.traced(REC_SCHEDULED, fn), *args)
+
+    def traced(self, rec_type: int, fn: Callable) -> Callable:
+        name = fn.__name__.encode()
+
+        def traced_call(*args):
+            self.writer.record(rec_type, payload=name)
+            return fn(*args)
+        return traced_call
+
+
+def read_trace(filename: str) -> Iterator[TraceRecord]:
+    with open(filename, 'rb') as f:
+        header = f.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise ValueError(f'{filename} is not a sunrise trace')
+        magic, version = _HEADER.unpack(header)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError(f'{filename} is not a version {TRACE_VERSION} sunrise trace')
+        while raw := f.read(_RECORD.size):
+            if len(raw) != _RECORD.size:
+                # Cut short by a crash, everything before it is good
+                return
+            rec_type, gpio, level, tick, epoch = _RECORD.unpack(raw)
+            payload = b''
+            if rec_type != REC_EDGE and level:
+                payload = f.read(level)
+                if len(payload) != level:
+                    return
+            yield TraceRecord(rec_type, gpio, level, tick, epoch, payload)
+
+
+class Replay:
+    """ Runs a recorded trace through a controller on the simulator's virtual clock. """
+
+    def __init__(self, records: List[TraceRecord]):
+        # Import here, the simulator pulls in the controller which imports this module for tracing
+        from sunrise_controller import button_map
+        from sunrise_sim import Simulation
+
+        if not records or records[0].rec_type != REC_SETTINGS:
+            raise ValueError('Trace does not start with the settings')
+        self.records = records
+        self.sim = Simulation(dt.datetime.fromtimestamp(records[0].epoch), json.loads(records[0].payload),
+                              cancel_rate=0.0, edit_rate=0.0)
+        self.ctrl = self.sim.ctrl
+        self.clock = self.sim.clock
+        self.debouncers = {gpio: ButtonDebouncer(btn) for gpio, btn in button_map.items()}
+        self.divergences: List[str] = []
+        self.timers_fired = 0
+        # Largest difference between when a timer was planned and when it fired on the recording
+        self.max_timer_lateness = 0.0
+
+    def run(self) -> 'Replay':
+        for record in self.records[1:]:
+            self.advance(record.epoch)
+            if record.rec_type == REC_JOURNAL:
+                state = RunState(**json.loads(record.payload))
+                self.ctrl.journal.record_start(state.start_epoch, state.duration_minutes, state.start_level,
+                                               state.step_size, state.sec_per_step)
+                self.ctrl.journal.record_level(state.level, state.updated_epoch)
+            elif record.rec_type == REC_STARTUP:
+                self.ctrl.startup_check_schedule()
+            elif record.rec_type == REC_EDGE:
+                debouncer = self.debouncers.get(record.gpio)
+                if debouncer:
+                    debouncer.edge(record.level, record.epoch)
+            elif record.rec_type in (REC_TIMER, REC_SCHEDULED):
+                self.fire(record)
+            elif record.rec_type == REC_SETTINGS_CHANGE:
+                self.ctrl.update_settings(json.loads(record.payload))
+            self.sim.after_call()
+        return self
+
+    def advance(self, epoch: float):
+        """ Handles everything not in the trace that falls due before the next record: debounced button events and
+        the simulator's own checks. """
+        while True:
+            deadlines = [d.deadline for d in self.debouncers.values() if d.deadline is not None]
+            button_due = min(deadlines) if deadlines else None
+            untraced = self.clock.find_call(lambda t: t.when <= epoch and getattr(t.fn, '__self__', None)
+                                            is not self.ctrl)
+            if untraced and (button_due is None or untraced.when <= button_due) and untraced.when <= epoch:
+                self.clock.set_time(untraced.when)
+                self.clock.run_call(untraced)
+            elif button_due is not None and button_due <= epoch:
+                self.clock.set_time(button_due)
+                for debouncer in self.debouncers.values():
+                    event = debouncer.poll(button_due)
+                    if event:
+                        self.ctrl.button_event(debouncer.btn, event)
+            else:
+                break
+            self.sim.after_call()
+        self.clock.set_time(epoch)
+
+    def fire(self, record: TraceRecord):
+        name = record.payload.decode()
+        timer = self.clock.find_call(lambda t: getattr(t.fn, '__name__', '') == name)
+        if timer is None:
+            self.divergences.append(f'{record.epoch:.3f}: recorded {name} but the controller had no such call')
+            return
+        self.max_timer_lateness = max(self.max_timer_lateness, record.epoch - timer.when)
+        self.timers_fired += 1
+        self.clock.run_call(timer)
+
+    def close(self):
+        self.sim.close()
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Show or replay a sunrise input trace')
+    parser.add_argument('command', choices=('dump', 'replay'))
+    parser.add_argument('trace')
+    parser.add_argument('--repeat', type=int, default=1, help='Replay this many times, for timing')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    records = list(read_trace(args.trace))
+    if args.command == 'dump':
+        for record in records:
+            print(record)
+        return 0
+
+    from sunrise_log import setup_logging, shutdown_logging
+    setup_logging(args.log_level, sys.stderr)
+    wall_times: List[float] = []
+    replays: List[Replay] = []
+    try:
+        for _ in range(max(1, args.repeat)):
+            start_time = time.perf_counter()
+            replays.append(Replay(records).run())
+            wall_times.append(time.perf_counter() - start_time)
+            replays[-1].close()
+    finally:
+        shutdown_logging()
+    replay = replays[-1]
+    span = records[-1].epoch - records[0].epoch
+    print(f'Replayed {len(records)} records ({span:.0f} s recorded) in {min(wall_times) * 1000:.1f} ms best of '
+          f'{len(wall_times)}, {replay.timers_fired} timer calls, max recorded timer lateness '
+          f'{replay.max_timer_lateness * 1000:.1f} ms')
+    print(f'Divergences: {len(replay.divergences)}')
+    for divergence in replay.divergences:
+        print(f'  {divergence}')
+    print(f'Violations: {len(replay.sim.result.violations)}')
+    for violation in replay.sim.result.violations:
+        print(f'  {violation}')
+    return 1 if replay.divergences or replay.sim.result.violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,55 +8,337 @@
 # Do not use the RPi.GPIO python module - it is NOT supported by Raspberry Pi Ltd.
 # Instead, use rpi-lgpio which is supported and emulates all the RPi.GPIO calls
 
-import subprocess
+import logging
+import threading
 import time
+from typing import Callable, List, Protocol
 
-import adafruit_ssd1306
-import busio
 from PIL import Image, ImageDraw, ImageFont
-from board import SCL, SDA
+
+from sunrise_metrics import registry
+from sunrise_watchdog import watchdog
+
+display_frames = registry.counter('sunrise_display_frames_total', 'Frames sent to the OLED display')
+display_frame_seconds = registry.histogram('sunrise_display_frame_seconds',
+                                           'Time from starting to compose a frame until it was sent')
+display_render_seconds = registry.histogram('sunrise_display_render_seconds', 'Time to compose a frame')
+display_transmit_seconds = registry.histogram('sunrise_display_transmit_seconds', 'Time to send a frame over I2C')
+display_frames_dropped = registry.counter('sunrise_display_frames_dropped_total',
+                                          'Composed frames replaced by a newer frame before they were sent')
+
+logger = logging.getLogger(__name__)
 
 LINE_1_SPACE = 0
 LINE_2_SPACE = 7
 LINE_3_SPACE = 15
 LINE_4_SPACE = 24
+# Same format as `date "+%a, %b %d %I:%M %p"`, without starting a process for every frame
+DATE_FORMAT = '%a, %b %d %I:%M %p'
+# A frame taking longer than this to go out means the I2C bus is stuck
+DISPLAY_SEND_MAX_SEC: float = 2.0
+# Rows used by the sunrise progress graph, in place of the date and status lines
+GRAPH_TOP: int = 7
+GRAPH_HEIGHT: int = 15
+# PiOLED pixels
+OLED_WIDTH: int = 128
+OLED_HEIGHT: int = 32
+
+
+class View(Protocol):
+    """ What the controller and its DisplayThread use of a display: OledDisplay, RemoteDisplay or HeadlessDisplay. """
+    scroll: bool
+
+    def set_auto_off_minutes(self, ao_minutes: int): ...
+
+    def set_display_lines(self, line1: str | None, line2: str | None, line3: str | None, line4: str | None): ...
+
+    def set_line2(self, line2): ...
+
+    def set_line3(self, line3): ...
+
+    def set_line4(self, line4): ...
+
+    def set_status_display_line(self, status): ...
+
+    def enable_status_display(self): ...
+
+    def disable_status_display(self): ...
+
+    def center_line(self, line) -> str: ...
+
+    def start_progress(self, total_sec: float, max_level: int, start_level: int): ...
+
+    def add_progress(self, elapsed_sec: float, level: int): ...
+
+    def end_progress(self): ...
+
+    def update_display(self): ...
+
+    def scroll_line3(self) -> bool: ...
+
+    def display_idle_time_reset(self): ...
+
+    def check_display_idle_off(self): ...
+
+    def is_display_on(self): ...
+
+    def turn_display_on(self): ...
+
+
+class ProgressGraph:
+    """
+    Brightness curve of the running sunrise, kept as a bitmap.  Each ramp step only draws the columns from the previous
+    step up to its own, and a frame pastes the whole bitmap, so the curve is never redrawn.  add() is called from the
+    ramp timer thread, paste() from the display thread.
+    """
+
+    def __init__(self, width: int, height: int, drawn: bool = True):
+        """
+        :param width: Columns, the whole sunrise is spread over them
+        :param height: Rows for the full lamp level
+        :param drawn: False only keeps the level of each column, for a display drawn in another process
+        """
+        self.width = width
+        self.height = height
+        self.image = Image.new('1', (width, height)) if drawn else None
+        self.draw = ImageDraw.Draw(self.image) if self.image else None
+        # Lamp level shown in each column
+        self.levels = bytearray(width)
+        self.lock = threading.Lock()
+        self.active = False
+        self.total_sec = 0.0
+        self.max_level = 1
+        self.last_x = 0
+        self.last_level = 0
+        # Changes on every update, so the display knows when it has a new graph to show
+        self.version = 0
+
+    def start(self, total_sec: float, max_level: int, start_level: int):
+        with self.lock:
+            if self.draw:
+                self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
+            self.levels[:] = bytes(self.width)
+            self.total_sec = total_sec
+            self.max_level = max(1, max_level)
+            self.last_x = 0
+            self.last_level = start_level
+            self.column(0, start_level)
+            self.active = True
+            self.version += 1
+
+    def add(self, elapsed_sec: float, level: int):
+        """
+        Draws the curve up to a new point.
+        :param elapsed_sec: Time since the start of the sunrise
+        :param level: Lamp level at that time
+        :return: None
+        """
+        x = min(self.width - 1, int(elapsed_sec / self.total_sec * self.width)) if self.total_sec > 0 else 0
+        with self.lock:
+            if not self.active:
+                return
+            if x <= self.last_x:
+                self.column(self.last_x, level)
+            else:
+                # Usually a single column.  Points further apart (joining a ramp part way) are joined up linearly.
+                span = x - self.last_x
+                for column in range(self.last_x + 1, x + 1):
+                    self.column(column, self.last_level + (level - self.last_level) * (column - self.last_x) // span)
+                self.last_x = x
+            self.last_level = level
+            self.version += 1
+
+    def column(self, x: int, level: int):
+        self.levels[x] = min(max(level, 0), 255)
+        if not self.draw:
+            return
+        filled = round(level / self.max_level * self.height)
+        self.draw.line((x, 0, x, self.height - 1 - filled), fill=0)
+        if filled:
+            self.draw.line((x, self.height - filled, x, self.height - 1), fill=255)
+
+    def stop(self):
+        with self.lock:
+            self.active = False
+            self.version += 1
+
+    def copy_from(self, levels: bytes, max_level: int, active: bool):
+        """
+        Makes this graph show another graph's levels, e.g., one kept in the controller's process for a renderer process.
+        Only the columns that changed are drawn.
+        """
+        with self.lock:
+            redraw = max(1, max_level) != self.max_level
+            self.max_level = max(1, max_level)
+            changed = False
+            for x in range(self.width):
+                if redraw or levels[x] != self.levels[x]:
+                    self.column(x, levels[x])
+                    changed = True
+            if changed or active != self.active:
+                self.active = active
+                self.version += 1
+
+    def paste(self, sender: 'FrameSender', top: int) -> int:
+        """ Copies the graph into the frame being composed.  Returns the version pasted. """
+        with self.lock:
+            if self.image:
+                sender.paste(self.image, (0, top))
+            return self.version
+
+
+class FrameSender(threading.Thread):
+    """
+    Transmit stage of the display.  Frames are composed into the back buffer while the front buffer is on the I2C bus,
+    so composing the next frame no longer waits for the previous one to be sent.  Once a frame is sent the buffers
+    swap.  If a newer frame is composed before a waiting frame goes out, the waiting one is dropped; only the latest
+    frame is worth the bus time.
+    """
+
+    def __init__(self, disp, width: int, height: int):
+        threading.Thread.__init__(self, name='FrameSender', daemon=True)
+        self.disp = disp
+        self.width = width
+        self.height = height
+        front = Image.new('1', (width, height))
+        back = Image.new('1', (width, height))
+        self.front: tuple = (front, ImageDraw.Draw(front))
+        self.back: tuple = (back, ImageDraw.Draw(back))
+        self.condition = threading.Condition()
+        # Back buffer holds a composed frame that hasn't been picked up yet
+        self.back_ready = False
+        self.back_compose_start = 0.0
+        self.sending = False
+        self.stopping = False
+        self.heartbeat = watchdog.heartbeat('display_bus')
+        # Called on this thread after each frame with when it started to be composed and when it was sent
+        self.frame_listeners: List[Callable[[float, float], None]] = []
+
+    def begin_frame(self) -> ImageDraw.ImageDraw:
+        """ Clears the back buffer and returns its drawing.  Only ever called from one thread. """
+        with self.condition:
+            if self.back_ready:
+                self.back_ready = False
+                display_frames_dropped.inc()
+            draw = self.back[1]
+        draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
+        return draw
+
+    def paste(self, image: Image.Image, position: tuple):
+        """ Copies a bitmap into the frame being composed, between begin_frame() and end_frame(). """
+        self.back[0].paste(image, position)
+
+    def end_frame(self, compose_start: float):
+        """
+        Hands the composed back buffer to the sender.
+        :param compose_start: perf_counter() when composing began
+        :return: None
+        """
+        display_render_seconds.observe(time.perf_counter() - compose_start)
+        with self.condition:
+            self.back_ready = True
+            self.back_compose_start = compose_start
+            self.condition.notify()
+        if self.heartbeat.due is None:
+            self.heartbeat.expect(DISPLAY_SEND_MAX_SEC)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.back_ready and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                self.front, self.back = self.back, self.front
+                self.back_ready = False
+                self.sending = True
+                compose_start = self.back_compose_start
+
+            transmit_start = time.perf_counter()
+            try:
+                self.disp.image(self.front[0])
+                self.disp.show()
+            except OSError as e:
+                # e.g., I2C glitch, the next frame tries again
+                logger.warning('Unable to send frame to display: %s', e)
+            now = time.perf_counter()
+            display_transmit_seconds.observe(now - transmit_start)
+            display_frame_seconds.observe(now - compose_start)
+            display_frames.inc()
+            for listener in self.frame_listeners:
+                listener(compose_start, now)
+
+            with self.condition:
+                self.sending = False
+                self.condition.notify_all()
+                if self.back_ready:
+                    self.heartbeat.beat(DISPLAY_SEND_MAX_SEC)
+                else:
+                    self.heartbeat.beat()
+
+    def flush(self, timeout: float = DISPLAY_SEND_MAX_SEC) -> bool:
+        """ Waits for frames already composed to be sent.  Returns False on timeout. """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.back_ready and not self.sending, timeout)
+
+    def stop(self):
+        """ Sends what is waiting and stops.  Afterwards the display can be written directly. """
+        self.flush()
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.join(DISPLAY_SEND_MAX_SEC)
+
 
 class OledDisplay:
     __max_line_len__ = 21
 
-    def __init__(self, display_auto_power_off_minutes: int, debug: bool):
+    def __init__(self, display_auto_power_off_minutes: int, debug: bool, disp=None):
+        """
+        :param display_auto_power_off_minutes:
+        :param debug:
+        :param disp: Something with the adafruit_ssd1306.SSD1306 interface to draw on instead of the PiOLED, e.g., to
+            benchmark the display without the hardware (see sunrise_latency.py)
+        """
         self.debug = debug
         self.display_on: bool = True
         self.display_auto_power_off_minutes: float = display_auto_power_off_minutes
         self.start_display_time: float = time.time()
         self.x_pos: int = 0
-        self.line1: str = ''
-        self.line2: str = ''
-        self.line3: str = ''
-        self.line4 : str= ''
+        self.line1: str | None = ''
+        self.line2: str | None = ''
+        self.line3: str | None = ''
+        self.line4: str | None = ''
         self.scroll_idx = 0
         self.scroll: bool = True
         self.debug = False
         self.is_status_display = True
         self.status_display_line = ''
 
-        # Create the I2C interface.
-        self.i2c = busio.I2C(SCL, SDA)
+        if disp is None:
+            # Only needed, and only installed, on the Pi
+            import adafruit_ssd1306
+            import busio
+            from board import SCL, SDA
+
+            # Create the I2C interface.
+            self.i2c = busio.I2C(SCL, SDA)
 
-        # Create the SSD1306 OLED class.
-        # The first two parameters are the pixel width and pixel height.  Change these
-        # to the right size for your display!
-        self.disp = adafruit_ssd1306.SSD1306_I2C(128, 32, self.i2c)
+            # Create the SSD1306 OLED class.
+            # The first two parameters are the pixel width and pixel height.  Change these
+            # to the right size for your display!
+            disp = adafruit_ssd1306.SSD1306_I2C(OLED_WIDTH, OLED_HEIGHT, self.i2c)
+        self.disp = disp
 
-        # Create blank image for drawing.
-        # Make sure to create image with mode '1' for 1-bit color.
+        # Frames are drawn into the sender's back buffer, with mode '1' for 1-bit color, and sent on its own thread.
         self.width = self.disp.width
         self.height = self.disp.height
         self.padding = -2
-        self.image = Image.new("1", (self.width, self.height))
-
-        # Get drawing object to draw on image.
-        self.draw: ImageDraw = ImageDraw.Draw(self.image)
+        self.sender = FrameSender(self.disp, self.width, self.height)
+        self.sender.start()
+        # Shown instead of the status text while a sunrise runs
+        self.graph = ProgressGraph(self.width, GRAPH_HEIGHT)
+        self.graph_version_shown = -1
 
         # Load default font.
         self.font = ImageFont.load_default()
@@ -72,11 +354,17 @@ class OledDisplay:
     def set_auto_off_minutes(self, ao_minutes:int):
         self.display_auto_power_off_minutes = ao_minutes
 
+    def add_frame_listener(self, listener: Callable[[float, float], None]):
+        """ listener(compose_start, sent) is called after each frame is sent, with perf_counter() times. """
+        self.sender.frame_listeners.append(listener)
+
     def clear_display(self):
-        self.disp.fill(0)
-        self.disp.show()
+        # A blank frame, through the sender so the bus is only ever used by one thread
+        compose_start = time.perf_counter()
+        self.sender.begin_frame()
+        self.sender.end_frame(compose_start)
 
-    def set_display_lines(self, line1: str, line2: str, line3: str, line4: str):
+    def set_display_lines(self, line1: str | None, line2: str | None, line3: str | None, line4: str | None):
         self.line1 = line1
         self.line2 = line2
         self.line3 = line3
@@ -107,15 +395,28 @@ class OledDisplay:
         pad = int((self.__max_line_len__ - len(line)) /  2)
         return f'{" " * pad}{line}'
 
-    def update_display(self):
+    def start_progress(self, total_sec: float, max_level: int, start_level: int):
+        self.graph.start(total_sec, max_level, start_level)
+
+    def add_progress(self, elapsed_sec: float, level: int):
+        self.graph.add(elapsed_sec, level)
+
+    def end_progress(self):
+        self.graph.stop()
+
+    def is_progress_shown(self) -> bool:
+        return self.graph.active and self.is_status_display
+
+    def update_display(self) -> None:
         # See if auto-power off
         if not self.is_display_on():
             return
 
         third_line: str
         top = self.padding
-        # Draw a black filled box to clear the image.
-        self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
+        frame_start = time.perf_counter()
+        # Cleared back buffer to draw the frame in
+        draw = self.sender.begin_frame()
 
         # Set display lines using defaults for empty lines
         if not self.line1:
@@ -123,27 +424,27 @@ class OledDisplay:
         else:
             first_line = self.line1
         if not self.line2:
-            cmd = "date \"+%a, %b %d %I:%M %p\""
-            date = subprocess.check_output(cmd, shell=True).decode("utf-8")
-            second_line = date
+            second_line = time.strftime(DATE_FORMAT)
         else:
             second_line = self.line2
 
         if self.is_status_display:
             third_line = self.status_display_line
         else:
-            third_line = self.line3
-        fourth_line = self.line4
+            third_line = self.line3 or ''
+        fourth_line = self.line4 or ''
 
-        # Write four lines of text.
-        self.draw.text((0, top + LINE_1_SPACE), first_line, font=self.font, fill=255)
-        self.draw.text((0, top + LINE_2_SPACE), second_line, font=self.font, fill=255)
-        self.draw.text((0, top + LINE_3_SPACE), third_line[self.x_pos:], font=self.font, fill=255)
-        self.draw.text((0, top + LINE_4_SPACE), fourth_line, font=self.font, fill=255)
+        # Write four lines of text, or the progress graph in place of the middle two
+        draw.text((0, top + LINE_1_SPACE), first_line, font=self.font, fill=255)
+        if self.is_progress_shown():
+            self.graph_version_shown = self.graph.paste(self.sender, GRAPH_TOP)
+        else:
+            draw.text((0, top + LINE_2_SPACE), second_line, font=self.font, fill=255)
+            draw.text((0, top + LINE_3_SPACE), third_line[self.x_pos:], font=self.font, fill=255)
+        draw.text((0, top + LINE_4_SPACE), fourth_line, font=self.font, fill=255)
 
-        # Display image.
-        self.disp.image(self.image)
-        self.disp.show()
+        # Display image, sent while the next frame is composed
+        self.sender.end_frame(frame_start)
 
     def scroll_line3(self) -> bool:
 
@@ -152,33 +453,34 @@ class OledDisplay:
         if self.is_status_display:
             third_line = self.status_display_line
         else:
-            third_line = self.line3
+            third_line = self.line3 or ''
 
         # See if auto-power off
         if not self.is_display_on():
             return at_end
 
+        if self.is_progress_shown():
+            # Nothing scrolls, a new frame only when a ramp step added to the graph
+            if self.graph.version != self.graph_version_shown:
+                self.update_display()
+            return at_end
+
         if not self.scroll or len(third_line) <= self.__max_line_len__:
             return at_end
 
         top = self.padding
-        # No way to clear just one line - everything is additive and spaces don't overwrite anything
-        # Draw a black filled box to clear the image.
-        self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
-
+        frame_start = time.perf_counter()
         # Set display lines using defaults for empty lines
         if not self.line1:
             first_line = 'Sunrise Alarm'
         else:
             first_line = self.line1
         if not self.line2:
-            cmd = "date \"+%a, %b %d %I:%M %p\""
-            date = subprocess.check_output(cmd, shell=True).decode("utf-8")
-            second_line = date
+            second_line = time.strftime(DATE_FORMAT)
         else:
             second_line = self.line2
 
-        fourth_line = self.line4
+        fourth_line = self.line4 or ''
 
         self.scroll_idx = self.scroll_idx + 1
         if self.scroll_idx > len(third_line):
@@ -187,15 +489,16 @@ class OledDisplay:
 
         # Wrap back around to zero index
         idx = self.scroll_idx % len(third_line)
-        self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
-        self.draw.text((0, top + LINE_1_SPACE), first_line, font=self.font, fill=255)
-        self.draw.text((0, top + LINE_2_SPACE), second_line, font=self.font, fill=255)
-        self.draw.text((0, top + LINE_3_SPACE), third_line[idx:], font=self.font, fill=255)
-        self.draw.text((0, top + LINE_4_SPACE), fourth_line, font=self.font, fill=255)
-
-        # Display image.
-        self.disp.image(self.image)
-        self.disp.show()
+        # No way to clear just one line - everything is additive and spaces don't overwrite anything
+        # Cleared back buffer to draw the frame in
+        draw = self.sender.begin_frame()
+        draw.text((0, top + LINE_1_SPACE), first_line, font=self.font, fill=255)
+        draw.text((0, top + LINE_2_SPACE), second_line, font=self.font, fill=255)
+        draw.text((0, top + LINE_3_SPACE), third_line[idx:], font=self.font, fill=255)
+        draw.text((0, top + LINE_4_SPACE), fourth_line, font=self.font, fill=255)
+
+        # Display image, sent while the next frame is composed
+        self.sender.end_frame(frame_start)
 
         return at_end
 
@@ -215,9 +518,8 @@ class OledDisplay:
             return
 
         # Display needs to be turned off
-        print('Auto off display')
-        self.display_on = False
-        self.clear_display()
+        logger.debug('Auto off display')
+        self.turn_display_off()
 
     def is_display_on(self):
         if self.display_on:
@@ -231,7 +533,12 @@ class OledDisplay:
         self.display_on = True
         self.update_display()
 
+    def turn_display_off(self):
+        self.display_on = False
+        self.clear_display()
+
     def shutdown(self):
-        # Blank display on stop
+        # Blank display on stop, once the sender is done with the bus
+        self.sender.stop()
         self.disp.fill(0)
         self.disp.show()
@@ -0,0 +1,206 @@
+# Stall watchdog.  Each path that has to keep running for a sunrise to happen (display thread, sunrise start scheduler,
+# ramp timer, button dispatcher, control API event loop) has a Heartbeat.  A path either beats on its own and says
+# when the next beat is due, or is probed: the watchdog hands it a callback to run and waits for it to come back.
+# Either way the watchdog thread knows when each path is overdue.
+#
+# How late each beat is compared to when it was due is recorded as scheduling lag.  A path that is overdue by more
+# than its tolerance is reported as stalled: a metric, an error log with the stack of the thread that last beat, and
+# a status message to systemd.  While anything is stalled the systemd WATCHDOG=1 pings stop, so with WatchdogSec= set
+# in the unit file systemd restarts the service (and the run journal resumes any sunrise that was in progress).
+
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List
+
+from sunrise_metrics import registry
+
+WATCHDOG_CHECK_SEC: float = 1.0
+# How often the probed paths are checked
+WATCHDOG_PROBE_SEC: float = 5.0
+WATCHDOG_DEFAULT_TOLERANCE_SEC: float = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+def sd_notify(state: str) -> bool:
+    """
+    Sends a state update (e.g., READY=1 or WATCHDOG=1) to systemd.  Does nothing when not run by systemd.
+    :return: True if the message was sent
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.connect(address)
+            s.sendall(state.encode('utf-8'))
+        return True
+    except OSError as e:
+        logger.warning('Unable to notify systemd: %s', e)
+        return False
+
+
+def systemd_watchdog_interval() -> float | None:
+    """ How often systemd expects WATCHDOG=1, half of WatchdogSec to leave some slack.  None if not enabled. """
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    return int(usec) / 1e6 / 2
+
+
+class Heartbeat:
+    """
+    Liveness of one path.  beat() is cheap enough for hot paths: a clock read, a few attribute writes and, when a
+    beat is late, a histogram update.
+    """
+
+    def __init__(self, name: str, tolerance: float = WATCHDOG_DEFAULT_TOLERANCE_SEC,
+                 probe: Callable[[Callable[[], None]], Any] | None = None):
+        """
+        :param name: Path name used in metrics and logs
+        :param tolerance: How far past due a beat can be before the path counts as stalled
+        :param probe: For paths that don't beat on their own, called with a callback that the path has to run
+        """
+        self.name = name
+        self.tolerance = tolerance
+        self.probe = probe
+        # Monotonic time the next beat is due, None while the path is idle and not expected to beat
+        self.due: float | None = None
+        self.last_beat: float = time.monotonic()
+        self.thread_id: int | None = None
+        self.stalled = False
+        self.lag_seconds = registry.histogram('sunrise_watchdog_lag_seconds', 'How late a heartbeat was',
+                                              labels={'path': name})
+        self.stalls = registry.counter('sunrise_watchdog_stalls_total', 'Stalls detected', {'path': name})
+        self.stalled_gauge = registry.gauge('sunrise_watchdog_stalled', '1 while a path is stalled', {'path': name})
+
+    def beat(self, next_due_sec: float | None = None):
+        """
+        Records that the path is alive.
+        :param next_due_sec: Seconds until the next beat is due, None if the path is now idle
+        :return: None
+        """
+        now = time.monotonic()
+        if self.due is not None and now > self.due:
+            self.lag_seconds.observe(now - self.due)
+        self.last_beat = now
+        self.thread_id = threading.get_ident()
+        self.due = None if next_due_sec is None else now + next_due_sec
+
+    def expect(self, next_due_sec: float):
+        """ The next beat is due in the given time, without counting this as a beat (e.g., a newly scheduled start). """
+        self.due = time.monotonic() + next_due_sec
+
+    def idle(self):
+        """ Nothing is expected from the path until it beats or expects again. """
+        self.due = None
+
+    def send_probe(self):
+        self.expect(0.0)
+        self.probe(self.beat)
+
+    def overdue(self, now: float) -> float:
+        """ Seconds past due plus tolerance, 0 if not stalled. """
+        if self.due is None:
+            return 0.0
+        return max(0.0, now - self.due - self.tolerance)
+
+
+class Watchdog(threading.Thread):
+    def __init__(self, check_interval: float = WATCHDOG_CHECK_SEC, probe_interval: float = WATCHDOG_PROBE_SEC):
+        threading.Thread.__init__(self, name='Watchdog', daemon=True)
+        self.check_interval = check_interval
+        self.probe_interval = probe_interval
+        self.heartbeats: Dict[str, Heartbeat] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.ping_interval = systemd_watchdog_interval()
+
+    def heartbeat(self, name: str, tolerance: float = WATCHDOG_DEFAULT_TOLERANCE_SEC,
+                  probe: Callable[[Callable[[], None]], Any] | None = None) -> Heartbeat:
+        """ Returns the heartbeat for a path, creating it the first time. """
+        with self.lock:
+            heartbeat = self.heartbeats.get(name)
+            if heartbeat is None:
+                heartbeat = Heartbeat(name, tolerance, probe)
+                self.heartbeats[name] = heartbeat
+            elif probe:
+                # e.g., a restarted API server registering its new event loop
+                heartbeat.probe = probe
+            return heartbeat
+
+    def run(self):
+        if self.ping_interval:
+            logger.info('Sending systemd watchdog pings every %.1f s', self.ping_interval)
+        sd_notify('READY=1')
+        next_probe = next_ping = time.monotonic()
+        while not self.stop_event.wait(min(self.check_interval, self.ping_interval or self.check_interval)):
+            now = time.monotonic()
+            if now >= next_probe:
+                self.send_probes()
+                next_probe = now + self.probe_interval
+            stalled = self.check()
+            if self.ping_interval and not stalled and now >= next_ping:
+                sd_notify('WATCHDOG=1')
+                next_ping = now + self.ping_interval
+
+    def stop(self):
+        self.stop_event.set()
+
+    def send_probes(self):
+        with self.lock:
+            heartbeats = list(self.heartbeats.values())
+        for heartbeat in heartbeats:
+            # Don't pile up probes on a path that hasn't answered the last one
+            if heartbeat.probe and heartbeat.due is None:
+                try:
+                    heartbeat.send_probe()
+                except Exception as e:
+                    logger.warning('Watchdog probe of %s failed: %s', heartbeat.name, e)
+
+    def check(self) -> List[str]:
+        """ Updates the stalled state of every path.  Returns the names of the stalled paths. """
+        now = time.monotonic()
+        with self.lock:
+            heartbeats = list(self.heartbeats.values())
+        stalled = []
+        for heartbeat in heartbeats:
+            overdue = heartbeat.overdue(now)
+            if overdue and not heartbeat.stalled:
+                heartbeat.stalled = True
+                heartbeat.stalls.inc()
+                heartbeat.stalled_gauge.set(1)
+                logger.error('%s stalled, %.1f s overdue, last beat %.1f s ago\n%s', heartbeat.name, overdue,
+                             now - heartbeat.last_beat, self.thread_stack(heartbeat.thread_id))
+                sd_notify(f'STATUS=Stalled: {heartbeat.name}')
+            elif not overdue and heartbeat.stalled:
+                heartbeat.stalled = False
+                heartbeat.stalled_gauge.set(0)
+                logger.warning('%s recovered', heartbeat.name)
+                sd_notify('STATUS=Running')
+            if heartbeat.stalled:
+                stalled.append(heartbeat.name)
+        return stalled
+
+    @staticmethod
+    def thread_stack(thread_id: int | None) -> str:
+        """ Stack of the given thread, or of every thread if it isn't known or has gone away. """
+        frames = sys._current_frames()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        if thread_id in frames:
+            frames = {thread_id: frames[thread_id]}
+        return '\n'.join(f'Thread {names.get(ident, ident)}:\n' + ''.join(traceback.format_stack(frame))
+                         for ident, frame in frames.items())
+
+
+# Process wide watchdog, started by sunrise_main
+watchdog = Watchdog()